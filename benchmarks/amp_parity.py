@@ -0,0 +1,90 @@
+r""" 在cpu上用同样的随机种子和数据训练model_topic_control若干步，比较float32和bf16混合精度的损失曲线和耗时
+
+python -m benchmarks.amp_parity --batch_size 16 --steps 20
+"""
+import argparse
+import copy
+import json
+import random
+import time
+import torch
+import torch.nn.functional as F
+from model.util.config import Config
+from model.model_topic_control import Model
+from model.Optim import Optim
+from model.util.amp import MixedPrecision
+from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', dest='batch_size', default=16, type=int, help='每个batch的样本数')
+parser.add_argument('--steps', dest='steps', default=20, type=int, help='训练步数')
+parser.add_argument('--lr', dest='lr', default=0.001, type=float, help='学习率，比默认大一些让参数在短时间内有明显变化')
+parser.add_argument('--threads', dest='threads', default=0, type=int, help='cpu线程数，0为torch默认')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+
+def compute_loss(outputs, feed_data, config, global_step):
+    r""" 和cvae_topic_globle_control.compute_loss相同的损失，返回batch平均 """
+    output_vocab, _mu, _logvar, mu, logvar = [o.float() for o in outputs]
+    labels = feed_data['responses'][:, 1:]
+    masks = feed_data['masks']
+    nll_loss = F.nll_loss(output_vocab.reshape(-1, config.num_vocab).clamp_min(1e-12).log(), labels.reshape(-1),
+                          reduction='none')
+    nll_loss = (nll_loss * masks.reshape(-1)).reshape(-1, masks.size(1)).sum(1)  # [batch]
+    kld_loss = 0.5 * torch.sum(_logvar - logvar - 1 + logvar.exp() / _logvar.exp()
+                               + (_mu - mu).pow(2) / _logvar.exp(), 1)  # [batch]
+    kld_weight = min(1.0 * (global_step % (2 * config.kl_step)) / config.kl_step, 1)
+    return (nll_loss + kld_weight * kld_loss).mean()
+
+
+def run(model, config, word2vec, batches, amp):
+    r""" 训练len(batches)步，返回每步的损失和平均每步耗时 """
+    optim = Optim(config.method, args.lr, config.lr_decay, config.weight_decay, config.max_grad_norm)
+    optim.set_parameters(model.parameters())
+    model.train()
+    losses = []
+    start_time = time.time()
+    for global_step, feed_data in enumerate(batches, 1):
+        with amp.autocast():
+            outputs = model(feed_data, word2vec, gpu=False)[:5]
+        loss = compute_loss(outputs, feed_data, config, global_step)
+        amp.backward(loss)
+        optim.step(amp.scaler)
+        optim.optimizer.zero_grad()
+        losses.append(loss.item())
+    return losses, (time.time() - start_time) / len(batches)
+
+
+def main():
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    config = Config()
+    config.kl_step = max(args.steps, 1)  # 短时间内也能看到kl项
+    word2vec = SyntheticWord2Vec()
+    model = Model(config)
+    batches = [topic_feed_data(args.batch_size, config) for _ in range(args.steps)]
+
+    torch.manual_seed(args.seed)  # 两次训练的dropout相同
+    fp32_losses, fp32_time = run(copy.deepcopy(model), config, word2vec, batches, MixedPrecision(False, False))
+    torch.manual_seed(args.seed)
+    bf16_losses, bf16_time = run(copy.deepcopy(model), config, word2vec, batches, MixedPrecision(True, False))
+
+    relative = [abs(a - b) / abs(a) for a, b in zip(fp32_losses, bf16_losses)]
+    for step, (a, b) in enumerate(zip(fp32_losses, bf16_losses), 1):
+        print('step {:3d}: float32 {:.4f}, bf16 {:.4f}, 相对差 {:.4%}'.format(step, a, b, relative[step - 1]))
+    print('float32: {:.3f}s/step, bf16: {:.3f}s/step, 最大相对差 {:.4%}, 最后一步相对差 {:.4%}'
+          .format(fp32_time, bf16_time, max(relative), relative[-1]))
+
+    if args.output:
+        results = {'batch_size': args.batch_size, 'steps': args.steps, 'float32': fp32_losses, 'bf16': bf16_losses,
+                   'float32_time': fp32_time, 'bf16_time': bf16_time, 'max_relative_diff': max(relative)}
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+r""" model_topic_control训练时每隔几步保存一次模型，比较同步保存和AsyncCheckpointWriter后台保存时保存那一步的耗时
+
+python -m benchmarks.async_checkpoint --steps 20 --save_every 5
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import torch
+import torch.nn.functional as F
+from model.util.config import Config
+from model.model_topic_control import Model
+from model.Optim import Optim
+from model.util.async_checkpoint import AsyncCheckpointWriter
+from model.util.checkpoint import CheckpointReader
+from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', dest='batch_size', default=8, type=int, help='每个batch的样本数')
+parser.add_argument('--steps', dest='steps', default=20, type=int, help='训练步数')
+parser.add_argument('--save_every', dest='save_every', default=5, type=int, help='每多少步保存一次')
+parser.add_argument('--save_in_flight', dest='save_in_flight', default=2, type=int, help='最多同时有几次保存没写完')
+parser.add_argument('--keep_last', dest='keep_last', default=2, type=int, help='只保留最近几个模型文件')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+
+def compute_loss(outputs, feed_data, config):
+    r""" 同cvae_topic_globle_control.compute_loss，kl权重取1 """
+    output_vocab, _mu, _logvar, mu, logvar = outputs
+    masks = feed_data['masks']
+    nll_loss = F.nll_loss(output_vocab.reshape(-1, config.num_vocab).clamp_min(1e-12).log(),
+                          feed_data['responses'][:, 1:].reshape(-1), reduction='none')
+    nll_loss = (nll_loss * masks.reshape(-1)).reshape(-1, masks.size(1)).sum(1)
+    kld_loss = 0.5 * torch.sum(_logvar - logvar - 1 + logvar.exp() / _logvar.exp()
+                               + (_mu - mu).pow(2) / _logvar.exp(), 1)
+    return (nll_loss + kld_loss).mean()
+
+
+def run(enabled, config, word2vec, batches):
+    r""" 返回保存那一步和其他步的平均耗时、总耗时和保存的文件 """
+    torch.manual_seed(args.seed)
+    model = Model(config)
+    model.train()
+    optim = Optim(config.method, config.lr, config.lr_decay, config.weight_decay, config.max_grad_norm)
+    optim.set_parameters(model.parameters())
+    writer = AsyncCheckpointWriter(args.save_in_flight, args.keep_last, enabled=enabled)
+    log_dir = tempfile.mkdtemp()
+    save_steps, other_steps = [], []
+    start_time = time.time()
+    for global_step, feed_data in enumerate(batches, 1):
+        step_start = time.time()
+        loss = compute_loss(model(feed_data, word2vec, gpu=False)[:5], feed_data, config)
+        loss.backward()
+        optim.step()
+        optim.optimizer.zero_grad()
+        if global_step % args.save_every == 0:
+            writer.save(model, 0, global_step, os.path.join(log_dir, '{:012d}.model'.format(global_step)))
+            save_steps.append(time.time() - step_start)
+        else:
+            other_steps.append(time.time() - step_start)
+    writer.close()
+    total = time.time() - start_time
+    # 最后一个文件应该和训练结束时的参数一致
+    reader = CheckpointReader(writer.saved_paths[-1])
+    match = all(torch.equal(reader['decoder'][key], value) for key, value in model.decoder.state_dict().items())
+    return {'async': enabled, 'save_step': sum(save_steps) / len(save_steps),
+            'other_step': sum(other_steps) / max(len(other_steps), 1), 'total': total,
+            'blocking_time': writer.snapshot_time, 'files': sorted(os.listdir(log_dir)), 'last_file_matches': match}
+
+
+def main():
+    random.seed(args.seed)
+    config = Config()
+    word2vec = SyntheticWord2Vec()
+    batches = [topic_feed_data(args.batch_size, config) for _ in range(args.steps)]
+    results = [run(False, config, word2vec, batches), run(True, config, word2vec, batches)]
+    for result in results:
+        print('{}: 保存那一步{:.3f}s, 其他步{:.3f}s, 训练线程上保存用时{:.3f}s, 共{:.2f}s, 保留的文件{}, 最后一个文件和参数一致: {}'
+              .format('后台保存' if result['async'] else '同步保存', result['save_step'], result['other_step'],
+                      result['blocking_time'], result['total'], result['files'], result['last_file_matches']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
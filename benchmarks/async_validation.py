@@ -0,0 +1,108 @@
+r""" model_topic_control训练时每隔几步验证一次，比较同步验证和AsyncValidator在另一个进程里验证时训练的总耗时，
+并检查后台验证的结果和在当前进程里验证同一份参数的结果是否一致
+
+python -m benchmarks.async_validation --steps 20 --valid_every 5
+"""
+import argparse
+import copy
+import json
+import random
+import time
+import torch
+import torch.nn.functional as F
+from model.util.config import Config
+from model.model_topic_control import Model
+from model.Optim import Optim
+from model.util.async_validation import AsyncValidator
+from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', dest='batch_size', default=8, type=int, help='每个batch的样本数')
+parser.add_argument('--steps', dest='steps', default=20, type=int, help='训练步数')
+parser.add_argument('--valid_every', dest='valid_every', default=5, type=int, help='每多少步验证一次')
+parser.add_argument('--valid_batches', dest='valid_batches', default=8, type=int, help='验证集的batch数')
+parser.add_argument('--quick_batches', dest='quick_batches', default=2, type=int, help='抽样验证的batch数')
+parser.add_argument('--valid_in_flight', dest='valid_in_flight', default=2, type=int, help='最多有几份参数快照等着验证')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+
+def compute_loss(outputs, feed_data, config):
+    r""" 同cvae_topic_globle_control.compute_loss，kl权重取1，返回每个样本的nll和kl """
+    output_vocab, _mu, _logvar, mu, logvar = outputs
+    masks = feed_data['masks']
+    nll_loss = F.nll_loss(output_vocab.reshape(-1, config.num_vocab).clamp_min(1e-12).log(),
+                          feed_data['responses'][:, 1:].reshape(-1), reduction='none')
+    nll_loss = (nll_loss * masks.reshape(-1)).reshape(-1, masks.size(1)).sum(1)
+    kld_loss = 0.5 * torch.sum(_logvar - logvar - 1 + logvar.exp() / _logvar.exp()
+                               + (_mu - mu).pow(2) / _logvar.exp(), 1)
+    return nll_loss, kld_loss
+
+
+def evaluate(model, batches, word2vec, config, global_step, quick):
+    r""" AsyncValidator调用，返回验证集上平均的nll和kl """
+    torch.manual_seed(global_step)  # 同步和后台验证用同样的随机数
+    nll_losses, kld_losses = [], []
+    for feed_data in batches[:args.quick_batches] if quick else batches:
+        nll_loss, kld_loss = compute_loss(model(feed_data, word2vec, gpu=False)[:5], feed_data, config)
+        nll_losses.append(nll_loss)
+        kld_losses.append(kld_loss)
+    return torch.cat(nll_losses).mean().item(), torch.cat(kld_losses).mean().item()
+
+
+def run(enabled, config, word2vec, batches, valid_batches):
+    r""" 返回训练总耗时、训练线程上验证花的时间、每次验证的结果和当前进程里重新验证同一份参数的最大差 """
+    torch.manual_seed(args.seed)
+    model = Model(config)
+    model.train()
+    optim = Optim(config.method, config.lr, config.lr_decay, config.weight_decay, config.max_grad_norm)
+    optim.set_parameters(model.parameters())
+    validator = AsyncValidator(model, evaluate, (valid_batches, word2vec, config), args.valid_in_flight,
+                               enabled=enabled)
+    results, blocking_time, snapshots = [], 0, {}
+    start_time = time.time()
+    for global_step, feed_data in enumerate(batches, 1):
+        nll_loss, kld_loss = compute_loss(model(feed_data, word2vec, gpu=False)[:5], feed_data, config)
+        (nll_loss + kld_loss).mean().backward()
+        optim.step()
+        optim.optimizer.zero_grad()
+        if global_step % args.valid_every == 0:
+            valid_start = time.time()
+            validator.submit(model, global_step, quick=global_step < len(batches))  # 中途抽样验证，最后一步用全部
+            blocking_time += time.time() - valid_start
+            snapshots[global_step] = copy.deepcopy(model.state_dict())  # 不计时，之后用来核对结果
+        results.extend(validator.poll())
+    train_time = time.time() - start_time
+    results.extend(validator.close())
+    total_time = time.time() - start_time
+    model.eval()
+    max_diff = 0  # 模型的Attn.v没有初始化，两次运行的参数不同，只能和同一次运行的快照比
+    with torch.no_grad():
+        for global_step, quick, metrics in results:
+            model.load_state_dict(snapshots[global_step])
+            expected = evaluate(model, valid_batches, word2vec, config, global_step, quick)
+            max_diff = max([max_diff] + [abs(a - b) for a, b in zip(metrics, expected)])
+    return {'async': enabled, 'train_time': train_time, 'total_time': total_time,
+            'blocking_time': blocking_time, 'results': sorted(results), 'max_diff': max_diff}
+
+
+def main():
+    random.seed(args.seed)
+    config = Config()
+    word2vec = SyntheticWord2Vec()
+    batches = [topic_feed_data(args.batch_size, config) for _ in range(args.steps)]
+    valid_batches = [topic_feed_data(args.batch_size, config) for _ in range(args.valid_batches)]
+    results = [run(False, config, word2vec, batches, valid_batches), run(True, config, word2vec, batches, valid_batches)]
+    for result in results:
+        print('{}: 训练{:.2f}s(其中等验证{:.2f}s), 验证全部完成{:.2f}s, 验证的global_step: {}, 和重新验证的最大差{:.2e}'
+              .format('后台验证' if result['async'] else '同步验证', result['train_time'], result['blocking_time'],
+                      result['total_time'], [r[0] for r in result['results']], result['max_diff']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+r""" model_topic_control测试时的冷启动：新进程里import、建模型、载入模型文件、生成一个batch的耗时和之后的常驻内存，
+比较旧的torch.save格式、model.util.checkpoint格式(全部载入/只载入生成用的部分)和export_inference导出的模型(float32/float16)
+
+python -m benchmarks.checkpoint_load --repeat 3
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--repeat', dest='repeat', default=3, type=int, help='每种格式起几次新进程，取中位数')
+parser.add_argument('--batch_size', dest='batch_size', default=8, type=int, help='生成的batch大小')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--child', dest='child', default='', type=str, help='内部使用：子进程要测的格式')
+parser.add_argument('--path', dest='path', default='', type=str, help='内部使用：子进程载入的模型文件')
+args = parser.parse_args()
+
+
+def resident_memory():
+    r""" 当前进程的常驻内存字节数，非linux时用峰值代替 """
+    try:
+        with open('/proc/self/statm', 'r') as fr:
+            return int(fr.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def child():
+    r""" 在新进程里计时，结果以json打印到标准输出 """
+    start_time = time.time()
+    import torch
+    from model.util.config import Config
+    from model.model_topic_control import Model
+    from model.util.checkpoint import drop_training_only
+    from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data
+    model = Model(Config())
+    build_time = time.time()
+    inference = args.child != 'legacy' and args.child != 'full'
+    model.load_model(args.path, inference=inference)
+    if inference:
+        drop_training_only(model)
+    load_time = time.time()
+    model.eval()
+    with torch.no_grad():
+        model(topic_feed_data(args.batch_size), SyntheticWord2Vec(), inference=True, max_len=10, gpu=False)
+    print(json.dumps({'import_build': build_time - start_time, 'load': load_time - build_time,
+                      'first_batch': time.time() - load_time, 'total': time.time() - start_time,
+                      'resident_bytes': resident_memory()}))
+
+
+def save_files(directory):
+    r""" 训练一步后分别用旧格式和新格式保存同一个模型 """
+    import torch
+    from model.util.config import Config
+    from model.model_topic_control import Model
+    from model.util.checkpoint import export_inference
+    from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data
+    model = Model(Config())
+    model(topic_feed_data(args.batch_size), SyntheticWord2Vec(), gpu=False)  # 让mu1/sigma1有值
+    legacy_path = os.path.join(directory, 'legacy.model')
+    checkpoint = {name: module.state_dict() for name, module in model.checkpoint_modules().items()}
+    checkpoint.update({'pi_': model.pi_, 'mu_c': model.mu_c, 'log_sigma2_c': model.log_sigma2_c,
+                       'mu1': model.mu1, 'sigma1': model.sigma1, 'epoch': 0, 'global_step': 0})
+    torch.save(checkpoint, legacy_path)  # 原来save_model的写法
+    new_path = os.path.join(directory, 'new.model')
+    model.save_model(0, 0, new_path)
+    slim_path = os.path.join(directory, 'slim.model')
+    export_inference(model, slim_path)
+    half_path = os.path.join(directory, 'slim_half.model')
+    export_inference(model, half_path, half=True)
+    return legacy_path, new_path, slim_path, half_path
+
+
+def main():
+    legacy_path, new_path, slim_path, half_path = save_files(tempfile.mkdtemp())
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.getcwd(), os.environ.get('PYTHONPATH', '')]))
+    results = []
+    for mode, path in [('legacy', legacy_path), ('full', new_path), ('inference', new_path), ('slim', slim_path),
+                       ('slim_half', half_path)]:
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.check_output([sys.executable, '-m', 'benchmarks.checkpoint_load', '--child', mode,
+                                              '--path', path, '--batch_size', str(args.batch_size)], env=env)
+            runs.append(json.loads(output.decode('utf8').strip().splitlines()[-1]))
+        result = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        result.update({'mode': mode, 'file_bytes': os.path.getsize(path)})
+        results.append(result)
+        print('{:9s}: 文件{:.1f}MB, import和建模型{:.2f}s, 载入{:.3f}s, 第一个batch {:.2f}s, 共{:.2f}s, 常驻内存{:.0f}MB'
+              .format(mode, result['file_bytes'] / 2**20, result['import_build'], result['load'],
+                      result['first_batch'], result['total'], result['resident_bytes'] / 2**20))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    if args.child:
+        child()
+    else:
+        main()
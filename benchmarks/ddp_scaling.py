@@ -0,0 +1,99 @@
+r""" model_topic_control在cpu上用1/2/4/8个进程(gloo后端DistributedDataParallel)训练的吞吐和扩展效率，
+每个进程的线程数为总线程数除以进程数
+
+python -m benchmarks.ddp_scaling --num_processes 1,2,4,8 --batch_size 8 --steps 10
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import torch
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+from model.util.config import Config
+from model.model_topic_control import Model
+from model.Optim import Optim
+from model.util.distributed import init_distributed, is_main_process, all_reduce_sum, barrier, launch
+from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_processes', dest='num_processes', default='1,2,4,8', type=str, help='比较的进程数')
+parser.add_argument('--batch_size', dest='batch_size', default=8, type=int, help='每个进程每步的样本数')
+parser.add_argument('--steps', dest='steps', default=10, type=int, help='计时的参数更新次数')
+parser.add_argument('--threads', dest='threads', default=0, type=int, help='所有进程共用的cpu线程数，0为cpu核数')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+
+def compute_loss(outputs, feed_data, config):
+    r""" 同cvae_topic_globle_control.compute_loss，kl权重取1 """
+    output_vocab, _mu, _logvar, mu, logvar = outputs
+    masks = feed_data['masks']
+    nll_loss = F.nll_loss(output_vocab.reshape(-1, config.num_vocab).clamp_min(1e-12).log(),
+                          feed_data['responses'][:, 1:].reshape(-1), reduction='none')
+    nll_loss = (nll_loss * masks.reshape(-1)).reshape(-1, masks.size(1)).sum(1)
+    kld_loss = 0.5 * torch.sum(_logvar - logvar - 1 + logvar.exp() / _logvar.exp()
+                               + (_mu - mu).pow(2) / _logvar.exp(), 1)
+    return (nll_loss + kld_loss).mean()
+
+
+def worker(num_threads, result_path):
+    rank, world_size = init_distributed()
+    torch.set_num_threads(num_threads)
+    random.seed(args.seed + rank)  # 每个进程不同的数据
+    torch.manual_seed(args.seed)
+    config = Config()
+    word2vec = SyntheticWord2Vec()
+    model = Model(config)
+    model.train()
+    train_model = DistributedDataParallel(model, find_unused_parameters=True) if world_size > 1 else model
+    optim = Optim(config.method, config.lr, config.lr_decay, config.weight_decay, config.max_grad_norm)
+    optim.set_parameters(model.parameters())
+    batches = [topic_feed_data(args.batch_size, config) for _ in range(args.steps + 1)]
+
+    def step(feed_data):
+        loss = compute_loss(train_model(feed_data, word2vec, gpu=False)[:5], feed_data, config)
+        loss.backward()
+        optim.step()
+        optim.optimizer.zero_grad()
+        return loss.item()
+
+    step(batches[0])  # 预热
+    barrier()
+    start_time = time.time()
+    losses = [step(feed_data) for feed_data in batches[1:]]
+    barrier()
+    use_time = time.time() - start_time
+    loss = all_reduce_sum([sum(losses) / len(losses)])[0] / world_size
+    if is_main_process():
+        with open(result_path, 'w', encoding='utf8') as fw:
+            json.dump({'num_processes': world_size, 'threads_per_process': num_threads, 'time': use_time,
+                       'examples_per_second': args.batch_size * world_size * args.steps / use_time,
+                       'loss': loss}, fw)
+
+
+def main():
+    total_threads = args.threads or os.cpu_count()
+    results = []
+    for num_processes in [int(n) for n in args.num_processes.split(',')]:
+        result_path = os.path.join(tempfile.mkdtemp(), 'result.json')
+        launch(worker, num_processes, max(1, total_threads // num_processes), result_path)
+        with open(result_path, 'r', encoding='utf8') as fr:
+            result = json.load(fr)
+        result['scaling_efficiency'] = result['examples_per_second'] / results[0]['examples_per_second'] / num_processes \
+            if results else 1.0
+        results.append(result)
+        print('{:d}个进程 x {:d}线程: {:.1f}样本/s, 扩展效率 {:.1%}, 平均损失 {:.3f}'
+              .format(num_processes, result['threads_per_process'], result['examples_per_second'],
+                      result['scaling_efficiency'], result['loss']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+r""" Decoder_attention每一步的耗时：每步传编码器输出(每步重新投影)和解码前prepare_memory一次的对比
+
+python -m benchmarks.decoder_attention --batch_size 32 --post_lens 10,30,60 --steps 30
+"""
+import argparse
+import json
+import time
+import torch
+from model.util.config import Config
+from model.Decoder_attention import Decoder
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', dest='batch_size', default=32, type=int, help='每个batch的样本数')
+parser.add_argument('--post_lens', dest='post_lens', default='10,30,60', type=str, help='比较的post长度')
+parser.add_argument('--steps', dest='steps', default=30, type=int, help='解码步数')
+parser.add_argument('--repeat', dest='repeat', default=5, type=int, help='重复次数，取平均')
+parser.add_argument('--threads', dest='threads', default=0, type=int, help='cpu线程数，0为torch默认')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+
+def decode(decoder, inputs, state, memory):
+    r""" 教师强制解码，返回每步的输出 [steps, batch, dim] """
+    outputs = []
+    for x in inputs:
+        output, state = decoder(x.unsqueeze(0), state, memory)
+        outputs.append(output)
+    return torch.cat(outputs, 0)
+
+
+def timing(run):
+    run()  # 预热
+    start_time = time.time()
+    for _ in range(args.repeat):
+        result = run()
+    return (time.time() - start_time) / args.repeat / args.steps, result
+
+
+def main():
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    config = Config()
+    dim = config.decoder_output_size
+    decoder = Decoder(config.decoder_cell_type, config.embedding_size, dim, config.decoder_num_layers).eval()
+    decoder.attn.v.data.normal_()
+
+    results = []
+    for post_len in [int(length) for length in args.post_lens.split(',')]:
+        encoder_outputs = torch.randn(post_len, args.batch_size, dim)
+        inputs = torch.randn(args.steps, args.batch_size, config.embedding_size)
+        h = torch.randn(config.decoder_num_layers, args.batch_size, dim)
+        state = (h, h) if config.decoder_cell_type == 'LSTM' else h
+        full = torch.full((args.batch_size,), post_len, dtype=torch.long)
+        with torch.no_grad():
+            per_step, baseline = timing(lambda: decode(decoder, inputs, state, encoder_outputs))
+            prepared, outputs = timing(lambda: decode(decoder, inputs, state,
+                                                      decoder.prepare_memory(encoder_outputs, full)))
+        result = {'post_len': post_len, 'per_step': per_step, 'prepared': prepared, 'speedup': per_step / prepared,
+                  'max_diff': (outputs - baseline).abs().max().item()}
+        results.append(result)
+        print('post长度{:3d}: 每步投影{:.3f}ms/step, 预先投影{:.3f}ms/step, 加速{:.2f}倍, 输出最大差{:.2e}'
+              .format(post_len, per_step * 1000, prepared * 1000, result['speedup'], result['max_diff']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+r""" model_topic_control在cpu上按不同micro-batch大小累积梯度训练的吞吐，实际batch相同；同时检查累积的梯度是否等于各micro-batch梯度的平均
+
+python -m benchmarks.grad_accumulation --batch_size 32 --micro_batch_sizes 32,8,4,1
+"""
+import argparse
+import json
+import random
+import time
+import torch
+import torch.nn.functional as F
+from model.util.config import Config
+from model.model_topic_control import Model
+from model.Optim import Optim
+from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', dest='batch_size', default=32, type=int, help='每次更新参数的实际batch')
+parser.add_argument('--micro_batch_sizes', dest='micro_batch_sizes', default='32,8,4,1', type=str,
+                    help='比较的micro-batch大小，需要整除batch_size，第一个作为参照')
+parser.add_argument('--updates', dest='updates', default=3, type=int, help='计时的参数更新次数')
+parser.add_argument('--threads', dest='threads', default=0, type=int, help='cpu线程数，0为torch默认')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+
+def split(feed_data, micro_batch_size):
+    r""" 把一个batch切成若干micro-batch，按各自的最大长度截掉多余的pad """
+    micro_batches = []
+    for start in range(0, feed_data['posts'].size(0), micro_batch_size):
+        micro = {key: value[start: start + micro_batch_size] for key, value in feed_data.items()}
+        len_posts, len_responses = int(micro['len_posts'].max()), int(micro['len_responses'].max())
+        micro['posts'] = micro['posts'][:, :len_posts]
+        micro['responses'] = micro['responses'][:, :len_responses]
+        micro['masks'] = micro['masks'][:, :len_responses - 1]
+        micro_batches.append(micro)
+    return micro_batches
+
+
+def compute_loss(outputs, feed_data, config):
+    r""" 同cvae_topic_globle_control.compute_loss，kl权重取1，返回每个样本的损失 [batch] """
+    output_vocab, _mu, _logvar, mu, logvar = outputs
+    masks = feed_data['masks']
+    nll_loss = F.nll_loss(output_vocab.reshape(-1, config.num_vocab).clamp_min(1e-12).log(),
+                          feed_data['responses'][:, 1:].reshape(-1), reduction='none')
+    nll_loss = (nll_loss * masks.reshape(-1)).reshape(-1, masks.size(1)).sum(1)
+    kld_loss = 0.5 * torch.sum(_logvar - logvar - 1 + logvar.exp() / _logvar.exp()
+                               + (_mu - mu).pow(2) / _logvar.exp(), 1)
+    return nll_loss + kld_loss
+
+
+def accumulate(model, optim, config, word2vec, micro_batches):
+    r""" 和驱动脚本的训练循环一样累积梯度，最后一个micro-batch时更新参数 """
+    for micro in micro_batches:
+        outputs = model(micro, word2vec, gpu=False)[:5]
+        (compute_loss(outputs, micro, config).mean() / optim.accumulation_steps).backward()
+        if optim.step():
+            return True
+    return False
+
+
+def gradients(model):
+    return torch.cat([p.grad.reshape(-1) for p in model.parameters() if p.grad is not None])
+
+
+def main():
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    config = Config()
+    word2vec = SyntheticWord2Vec()
+    model = Model(config)
+    model.eval()  # 关掉dropout才能比较梯度
+    batches = [topic_feed_data(args.batch_size, config) for _ in range(args.updates)]
+    micro_batch_sizes = [int(size) for size in args.micro_batch_sizes.split(',')]
+
+    # 梯度一致性：lr为0，累积的梯度应等于各micro-batch梯度的平均。
+    # 关键词注意力Attn的softmax在batch维上，不同的切分本身前向就不同，和整个batch的差只作参考
+    full_batch = None
+    accumulation_diff, batch_diff = {}, {}
+    for micro_batch_size in micro_batch_sizes:
+        micro_batches = split(batches[0], micro_batch_size)
+        optim = Optim(config.method, 0.0, max_grad_norm=0, accumulation_steps=len(micro_batches))
+        optim.set_parameters(model.parameters())
+        optim.optimizer.zero_grad()
+        assert accumulate(model, optim, config, word2vec, micro_batches)
+        grads = gradients(model)
+        separate = 0
+        for micro in micro_batches:
+            optim.optimizer.zero_grad()
+            compute_loss(model(micro, word2vec, gpu=False)[:5], micro, config).mean().backward()
+            separate = separate + gradients(model) / len(micro_batches)
+        optim.optimizer.zero_grad()
+        if full_batch is None:
+            full_batch = grads
+        accumulation_diff[micro_batch_size] = (grads - separate).abs().max().item() / separate.abs().max().item()
+        batch_diff[micro_batch_size] = (grads - full_batch).abs().max().item() / full_batch.abs().max().item()
+
+    results = []
+    model.train()
+    for micro_batch_size in micro_batch_sizes:
+        optim = Optim(config.method, config.lr, config.lr_decay, config.weight_decay, config.max_grad_norm,
+                      args.batch_size // micro_batch_size)
+        optim.set_parameters(model.parameters())
+        start_time = time.time()
+        for feed_data in batches:
+            accumulate(model, optim, config, word2vec, split(feed_data, micro_batch_size))
+            optim.optimizer.zero_grad()
+        use_time = time.time() - start_time
+        result = {'micro_batch_size': micro_batch_size, 'accumulation_steps': args.batch_size // micro_batch_size,
+                  'examples_per_second': args.batch_size * args.updates / use_time,
+                  'accumulation_diff': accumulation_diff[micro_batch_size],
+                  'batch_diff': batch_diff[micro_batch_size]}
+        results.append(result)
+        print('micro_batch {:3d} x {:3d}: {:.1f}样本/s, 累积梯度和分别计算的最大相对差 {:.2e}, '
+              '和micro_batch={}时的最大相对差 {:.2e}'
+              .format(micro_batch_size, result['accumulation_steps'], result['examples_per_second'],
+                      result['accumulation_diff'], micro_batch_sizes[0], result['batch_diff']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
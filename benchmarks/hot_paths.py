@@ -0,0 +1,220 @@
+r""" 项目热点路径的基准测试：词向量查表(Word2Vec_emb.embedding)、DataProcessor.get_batch_data、Encoder前向、
+model_topic_control、model_word2vec_mcvae_dd_act、model_seq的teacher forcing和贪心解码、rouge和distinct-n。
+只用和Config同形状的合成数据，不需要gpu和数据集。每个用例记录多次运行耗时的中位数等，结果存为json；
+--compare和之前存下的基线比较，中位数变慢超过--threshold的记为退化，有退化时退出码为1。
+没有gensim或训练好的词向量文件时Word2Vec_emb的用例记为跳过，其余用例都用同接口的SyntheticWord2Vec
+
+python -m benchmarks.hot_paths --output benchmarks_base.json
+python -m benchmarks.hot_paths --output benchmarks_new.json --compare benchmarks_base.json
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import torch
+from model.util.config import Config
+from model.util.sentence_processor import SentenceProcessor
+from model.util.data_processor_topic_globle import DataProcessor
+from model.Encoder import Encoder
+from model.model_topic_control import Model as TopicControlModel
+from model.model_word2vec_mcvae_dd_act import Model as McvaeDdActModel
+from model.model_seq import Model as SeqModel
+from rouge import rouge
+from distinct_n import distinct_n_corpus_level
+from benchmarks.synthetic import SyntheticWord2Vec, random_sentence, topic_feed_data, response_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--cases', dest='cases', default='', type=str, help='只跑名字以这些前缀开头的用例，逗号分隔，为空时全部')
+parser.add_argument('--batch_size', dest='batch_size', default=Config.batch_size, type=int, help='模型和编码器用例的batch大小')
+parser.add_argument('--num_examples', dest='num_examples', default=256, type=int, help='get_batch_data、rouge和distinct-n用的样本数')
+parser.add_argument('--num_global_keywords', dest='num_global_keywords', default=1000, type=int, help='get_batch_data的全局关键词数')
+parser.add_argument('--max_len', dest='max_len', default=30, type=int, help='贪心解码的最大步数')
+parser.add_argument('--warmup', dest='warmup', default=1, type=int, help='每个用例计时前先跑几次')
+parser.add_argument('--repeat', dest='repeat', default=5, type=int, help='每个用例计时几次')
+parser.add_argument('--threads', dest='threads', default=0, type=int, help='torch的线程数，0表示默认')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件，可以作为之后比较的基线')
+parser.add_argument('--compare', dest='compare', default='', type=str, help='作为基线的json文件，为空时不比较')
+parser.add_argument('--threshold', dest='threshold', default=0.1, type=float, help='中位数比基线慢多少比例算退化')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+SKIP_ERRORS = (ImportError, OSError)  # 可选依赖或文件不存在时跳过用例
+
+
+def synthetic_vocab(config):
+    r""" 和Config.num_vocab一样大的词汇表，前四个是特殊符号 """
+    return ['<PAD>', '<SOS>', '<EOS>', '<UNK>'] + ['w{}'.format(i) for i in range(4, config.num_vocab)]
+
+
+def synthetic_words(vocab, min_len, max_len, config):
+    return [vocab[i] for i in random_sentence(min_len, max_len, config)]
+
+
+def case_embedding_synthetic(config):
+    word2vec = SyntheticWord2Vec()
+    posts = topic_feed_data(args.batch_size, config)['posts']
+    return lambda: word2vec.embedding(posts)
+
+
+def case_embedding_word2vec_emb(config):
+    from gensim_word2vec_new import Word2Vec_emb  # 需要gensim、data/raw/vocab.txt和w2vModel.model
+    word2vec = Word2Vec_emb()
+    posts = topic_feed_data(args.batch_size, config)['posts']
+    return lambda: word2vec.embedding(posts)
+
+
+def case_get_batch_data(config):
+    vocab = synthetic_vocab(config)
+    sentence_processor = SentenceProcessor(vocab, config.pad_id, config.start_id, config.end_id, config.unk_id)
+    global_keywords = random.sample(vocab[config.unk_id + 1:], args.num_global_keywords)  # 驱动脚本里也是list
+    data = [{'post': synthetic_words(vocab, 5, 20, config),
+             'response': synthetic_words(vocab, 5, 20, config),
+             'KeyWord': synthetic_words(vocab, 1, 5, config),
+             'response_label_act': ['inform'],
+             'response_label_emotion': ['happiness']} for _ in range(args.num_examples)]
+    data_processor = DataProcessor(data, config.batch_size, sentence_processor, global_keywords, shuffle=False)
+    return lambda: sum(1 for _ in data_processor.get_batch_data())
+
+
+def case_encoder(config):
+    encoder = Encoder(config.post_encoder_cell_type, config.embedding_size, config.post_encoder_output_size,
+                      config.post_encoder_num_layers, config.post_encoder_bidirectional, config.dropout).eval()
+    feed_data = topic_feed_data(args.batch_size, config)
+    embed_posts = SyntheticWord2Vec().embedding(feed_data['posts']).transpose(0, 1)  # [seq, batch, embed_size]
+    return lambda: encoder(embed_posts, feed_data['len_posts'])
+
+
+def model_case(model_class, feed, inference):
+    def build(config):
+        model = model_class(config).eval()
+        word2vec = SyntheticWord2Vec()
+        feed_data = feed(args.batch_size, config)
+        if inference:
+            return lambda: model(feed_data, word2vec, inference=True, max_len=args.max_len, gpu=False)
+        return lambda: model(feed_data, word2vec, gpu=False)
+    return build
+
+
+def case_rouge(config):
+    vocab = synthetic_vocab(config)
+    hypotheses = [' '.join(synthetic_words(vocab, 5, 20, config)) for _ in range(args.num_examples)]
+    references = [' '.join(synthetic_words(vocab, 5, 20, config)) for _ in range(args.num_examples)]
+    return lambda: rouge(hypotheses, references)
+
+
+def case_distinct_n(config):
+    vocab = synthetic_vocab(config)
+    results = [synthetic_words(vocab, 5, 20, config) for _ in range(args.num_examples)]
+    return lambda: (distinct_n_corpus_level(results, 1), distinct_n_corpus_level(results, 2))
+
+
+CASES = [('embedding/synthetic', case_embedding_synthetic),
+         ('embedding/word2vec_emb', case_embedding_word2vec_emb),
+         ('data/get_batch_data', case_get_batch_data),
+         ('encoder/forward', case_encoder),
+         ('decode/topic_control/teacher_forced', model_case(TopicControlModel, topic_feed_data, False)),
+         ('decode/topic_control/greedy', model_case(TopicControlModel, topic_feed_data, True)),
+         ('decode/mcvae_dd_act/teacher_forced', model_case(McvaeDdActModel, response_feed_data, False)),
+         ('decode/mcvae_dd_act/greedy', model_case(McvaeDdActModel, response_feed_data, True)),
+         ('decode/seq/teacher_forced', model_case(SeqModel, response_feed_data, False)),
+         ('decode/seq/greedy', model_case(SeqModel, response_feed_data, True)),
+         ('metrics/rouge', case_rouge),
+         ('metrics/distinct_n', case_distinct_n)]
+
+
+def measure(run):
+    r""" 预热后计时repeat次，返回耗时的统计(秒) """
+    with torch.no_grad():
+        for _ in range(args.warmup):
+            run()
+        times = []
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start_time)
+    return {'median': statistics.median(times), 'min': min(times), 'mean': statistics.mean(times), 'repeat': len(times)}
+
+
+def run_cases(config):
+    prefixes = [prefix for prefix in args.cases.split(',') if prefix]
+    results = {}
+    for name, build in CASES:
+        if prefixes and not any(name.startswith(prefix) for prefix in prefixes):
+            continue
+        random.seed(args.seed)  # 每个用例的数据和参数不受前面用例的影响
+        torch.manual_seed(args.seed)
+        try:
+            run = build(config)
+        except SKIP_ERRORS as e:
+            results[name] = {'skipped': '{}: {}'.format(type(e).__name__, e)}
+            print('{:<40s}跳过 ({})'.format(name, results[name]['skipped']))
+            continue
+        results[name] = measure(run)
+        print('{:<40s}中位数 {:10.3f}ms, 最小 {:10.3f}ms'
+              .format(name, results[name]['median'] * 1000, results[name]['min'] * 1000))
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(),
+            'torch': torch.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'threads': torch.get_num_threads(),
+            'batch_size': args.batch_size,
+            'num_examples': args.num_examples,
+            'num_global_keywords': args.num_global_keywords,
+            'max_len': args.max_len,
+            'repeat': args.repeat}
+
+
+def compare(current, baseline, threshold):
+    r""" 按中位数和基线比较，打印每个用例的变化，返回退化的用例名 """
+    for key in ['torch', 'threads', 'batch_size', 'num_examples', 'num_global_keywords', 'max_len']:
+        if baseline['environment'].get(key) != current['environment'].get(key):
+            print('注意: 基线的{}为{}，这次为{}，结果不一定可比'
+                  .format(key, baseline['environment'].get(key), current['environment'].get(key)))
+    regressions = []
+    print('{:<40s}{:>14s}{:>14s}{:>10s}  {}'.format('用例', '基线(ms)', '这次(ms)', '比例', '结论'))
+    for name, result in current['cases'].items():
+        base = baseline['cases'].get(name, {})
+        if 'median' not in result or 'median' not in base:
+            print('{:<40s}{:>14s}{:>14s}{:>10s}  {}'.format(name, '-', '-', '-', '无法比较'))
+            continue
+        ratio = result['median'] / max(base['median'], 1e-12)
+        if ratio > 1 + threshold:
+            verdict = '退化'
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            verdict = '提升'
+        else:
+            verdict = '持平'
+        print('{:<40s}{:>14.3f}{:>14.3f}{:>10.2f}  {}'
+              .format(name, base['median'] * 1000, result['median'] * 1000, ratio, verdict))
+    return regressions
+
+
+def main():
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    config = Config()
+    current = {'environment': environment(), 'cases': run_cases(config)}
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(current, fw, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf8') as fr:
+            baseline = json.load(fr)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print('{}个用例比基线慢{:.0%}以上: {}'.format(len(regressions), args.threshold, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
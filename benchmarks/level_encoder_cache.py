@@ -0,0 +1,97 @@
+r""" 层级编码器global_sem缓存的基准：不同刷新间隔下每个batch的耗时和缓存的陈旧程度
+
+python -m benchmarks.level_encoder_cache --corpus_size 2000 --steps 20
+"""
+import argparse
+import json
+import random
+import time
+import torch
+from model.util.config import Config
+from model.model_topic_level_encoder import Model
+from benchmarks.synthetic import SyntheticWord2Vec, random_sentence, pad_batch, topic_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--corpus_size', dest='corpus_size', default=2000, type=int, help='层级编码器语料句子数')
+parser.add_argument('--steps', dest='steps', default=20, type=int, help='每种刷新间隔训练多少步')
+parser.add_argument('--refresh_steps', dest='refresh_steps', default='1,5,20', type=str, help='比较的刷新间隔')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+
+def level_corpus(config):
+    sentences = [random_sentence(5, 30, config) for _ in range(args.corpus_size)]
+    id_sentences, len_sentences = pad_batch(sentences, config)
+    return {'id_sentences': id_sentences, 'len_sentences': len_sentences}
+
+
+def run_train(refresh_steps, config, word2vec, corpus):
+    r""" 训练args.steps步，返回平均每步耗时和使用的global_sem相对最新值的平均偏差 """
+    torch.manual_seed(args.seed)
+    config.global_sem_refresh_steps = refresh_steps
+    model = Model(config)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=config.lr)
+    use_times, drifts = [], []
+    for _ in range(args.steps):
+        feed_data = topic_feed_data(1, config)
+
+        # 当前参数下真实的global_sem，不计入耗时，算完恢复训练用的缓存
+        saved = (model.global_sem_cache, model.global_sem_key, model.global_sem_age)
+        with torch.no_grad():
+            model.eval()
+            fresh = model.global_semantics(word2vec, corpus)
+            model.train()
+        model.global_sem_cache, model.global_sem_key, model.global_sem_age = saved
+
+        start_time = time.time()
+        output_vocab, _mu, _logvar, mu, logvar, loss = model(feed_data, word2vec, corpus, gpu=False)
+        (output_vocab.sum() * 0 + loss).backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        use_times.append(time.time() - start_time)
+
+        used = model.global_sem_cache  # 这一步实际使用的global_sem
+        drifts.append(((used - fresh).norm() / fresh.norm().clamp_min(1e-12)).item())
+    return sum(use_times) / len(use_times), sum(drifts) / len(drifts)
+
+
+def run_inference(config, word2vec, corpus):
+    r""" 测试时缓存命中与每次重新编码的单batch耗时 """
+    model = Model(config)
+    model.eval()
+    feed_data = topic_feed_data(1, config)
+    with torch.no_grad():
+        start_time = time.time()
+        model(feed_data, word2vec, corpus, inference=True, max_len=1, gpu=False)  # 第一次：编码语料
+        cold = time.time() - start_time
+        start_time = time.time()
+        model(feed_data, word2vec, corpus, inference=True, max_len=1, gpu=False)  # 第二次：命中缓存
+        warm = time.time() - start_time
+    return cold, warm
+
+
+def main():
+    random.seed(args.seed)
+    config = Config()
+    word2vec = SyntheticWord2Vec()
+    corpus = level_corpus(config)
+
+    results = {'corpus_size': args.corpus_size, 'train': [], 'inference': {}}
+    for refresh_steps in [int(s) for s in args.refresh_steps.split(',')]:
+        use_time, drift = run_train(refresh_steps, config, word2vec, corpus)
+        results['train'].append({'refresh_steps': refresh_steps, 'time_per_step': use_time, 'relative_drift': drift})
+        print('刷新间隔: {:d}, 训练耗时: {:.3f}s/step, global_sem相对偏差: {:.4f}'.format(refresh_steps, use_time, drift))
+
+    cold, warm = run_inference(config, word2vec, corpus)
+    results['inference'] = {'uncached': cold, 'cached': warm}
+    print('测试时 重新编码: {:.3f}s/batch, 使用缓存: {:.3f}s/batch'.format(cold, warm))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+r""" 一个模型训练时(前向+驱动脚本的损失+反向)的峰值内存随batch大小和回复长度的变化，拟合出每个样本、每个token的内存，
+按内存预算和最长回复推荐最大的安全batch。cpu上测RSS，--gpu时测显存。
+驱动脚本里用--auto_batch_size在真实数据上做同样的测量并直接使用推荐值
+
+python -m benchmarks.memory_profile --variant topic_control --batch_sizes 1,2,4,8 --seq_lens 10,20,40 --max_response_len 60
+"""
+import argparse
+import importlib
+import json
+import random
+import torch
+import torch.nn.functional as F
+from model.util.config import Config
+from model.util.perplexity import split_outputs, gaussian_kld
+from model.util.memory_profile import (profile_memory, fit_memory, recommend_batch_size, available_memory_mb,
+                                       optimizer_state_mb, predict_memory, memory_table)
+from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data, response_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--variant', dest='variant', default='topic_control', type=str,
+                    choices=['topic', 'topic_control', 'cvae', 'seq', 'mcvae_dd_act'], help='测量的模型')
+parser.add_argument('--batch_sizes', dest='batch_sizes', default='1,2,4,8', type=str, help='测量的batch大小')
+parser.add_argument('--seq_lens', dest='seq_lens', default='10,20,40', type=str, help='测量的回复长度(词数)')
+parser.add_argument('--post_len', dest='post_len', default=20, type=int, help='post的长度(词数)')
+parser.add_argument('--max_response_len', dest='max_response_len', default=60, type=int, help='按多长的回复推荐batch')
+parser.add_argument('--budget_mb', dest='budget_mb', default=0, type=float, help='内存预算(MB)，0表示当前可用的全部')
+parser.add_argument('--safety', dest='safety', default=0.8, type=float, help='只用预算的这个比例')
+parser.add_argument('--gpu', dest='gpu', action='store_true', help='是否使用gpu')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+MODULES = {'topic': 'model.model_topic', 'topic_control': 'model.model_topic_control', 'cvae': 'model.model_cvae',
+           'seq': 'model.model_seq', 'mcvae_dd_act': 'model.model_word2vec_mcvae_dd_act'}
+
+
+def compute_loss(outputs, feed_data, config):
+    r""" 同驱动脚本的compute_loss：对整个词表求log，kl权重取1 """
+    output_vocab, latents = split_outputs(outputs)
+    masks = feed_data['masks']
+    nll_loss = F.nll_loss(output_vocab.float().reshape(-1, config.num_vocab).clamp_min(1e-12).log(),
+                          feed_data['responses'][:, 1:].reshape(-1), reduction='none')
+    nll_loss = (nll_loss * masks.reshape(-1)).reshape(-1, masks.size(1)).sum(1)
+    if latents is not None:
+        _mu, _logvar, mu, logvar = [latent.float() for latent in latents]
+        nll_loss = nll_loss + gaussian_kld(mu, logvar, _mu, _logvar)
+    return nll_loss.mean()
+
+
+def main():
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    gpu = args.gpu and torch.cuda.is_available()
+    config = Config()
+    word2vec = SyntheticWord2Vec()
+    model = importlib.import_module(MODULES[args.variant]).Model(config)
+    if gpu:
+        model.to('cuda')
+    model.train()
+    feed = topic_feed_data if args.variant.startswith('topic') else response_feed_data
+
+    def step(batch_size, seq_len):
+        feed_data = feed(batch_size, config, min_len=args.post_len, max_len=args.post_len)
+        responses = response_feed_data(batch_size, config, min_len=seq_len, max_len=seq_len)  # 回复固定为seq_len个词
+        feed_data.update({key: responses[key] for key in ['responses', 'len_responses', 'masks']})
+        if gpu:
+            feed_data = {key: value.cuda() for key, value in feed_data.items()}
+        compute_loss(model(feed_data, word2vec, gpu=gpu), feed_data, config).backward()
+        model.zero_grad(set_to_none=True)
+
+    batch_sizes = [int(batch_size) for batch_size in args.batch_sizes.split(',')]
+    seq_lens = [int(seq_len) for seq_len in args.seq_lens.split(',')]
+    records = profile_memory(step, batch_sizes, seq_lens, gpu)
+    fit = fit_memory(records)
+    print(memory_table(records, fit))
+
+    budget_mb = args.budget_mb or available_memory_mb(gpu)
+    reserved_mb = optimizer_state_mb(model.parameters(), config.method)
+    batch_size = recommend_batch_size(fit, budget_mb, args.max_response_len, args.safety, reserved_mb)
+    print('固定部分{:.1f}MB, 每个样本{:.3f}MB, 每个回复token {:.3f}MB, {}状态{:.1f}MB'
+          .format(fit['fixed_mb'], fit['per_example_mb'], fit['per_token_mb'], config.method, reserved_mb))
+    print('{}预算{:.0f}MB(用{:.0%})、回复长度{}时推荐batch大小为{}，预计占用{:.1f}MB'
+          .format('显存' if gpu else '内存', budget_mb, args.safety, args.max_response_len, batch_size,
+                  predict_memory(fit, batch_size, args.max_response_len) + reserved_mb))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump({'variant': args.variant, 'gpu': gpu, 'records': records, 'fit': fit, 'budget_mb': budget_mb,
+                       'safety': args.safety, 'reserved_mb': reserved_mb, 'max_response_len': args.max_response_len,
+                       'batch_size': batch_size}, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
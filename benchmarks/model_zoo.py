@@ -0,0 +1,247 @@
+r""" model/下所有Model变体的成本排行：用Config构建，喂同样的合成batch，记录参数量、训练时每秒处理的回复token数、
+贪心生成时每秒生成的回复数和峰值内存(cpu上是相对构建模型前的峰值RSS增量，--gpu时还有峰值显存)。
+每个变体在单独的进程里跑，互不影响峰值内存，某个变体出错或超时也不影响其它变体。
+各变体的损失函数不同，训练时用输出里所有需要梯度的张量的均值之和作为损失，只为了让反向传播经过整个计算图
+
+python -m benchmarks.model_zoo --steps 3 --output model_zoo.json
+python -m benchmarks.model_zoo --variants model_topic_control,model_seq,model_word2vec_mcvae_dd_act --sort responses_per_sec
+"""
+import argparse
+import inspect
+import importlib
+import json
+import os
+import queue
+import random
+import resource
+import re
+import time
+import traceback
+import torch
+import torch.multiprocessing as mp
+from model.util.config import Config
+from model.Optim import Optim
+from benchmarks.synthetic import SyntheticWord2Vec, random_sentence, pad_batch, model_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--variants', dest='variants', default='', type=str, help='model/下的模块名，逗号分隔，为空时全部变体')
+parser.add_argument('--batch_size', dest='batch_size', default=Config.batch_size, type=int, help='每个batch的样本数')
+parser.add_argument('--steps', dest='steps', default=5, type=int, help='训练和生成各计时多少个batch')
+parser.add_argument('--max_len', dest='max_len', default=30, type=int, help='生成时最大解码步数')
+parser.add_argument('--corpus_size', dest='corpus_size', default=2000, type=int, help='层级编码器语料的句子数')
+parser.add_argument('--gpu', dest='gpu', action='store_true', help='是否使用gpu')
+parser.add_argument('--threads', dest='threads', default=0, type=int, help='每个变体进程的torch线程数，0表示默认')
+parser.add_argument('--timeout', dest='timeout', default=600, type=int, help='每个变体最多跑多少秒')
+parser.add_argument('--sort', dest='sort', default='train_tokens_per_sec', type=str,
+                    choices=['train_tokens_per_sec', 'responses_per_sec', 'params', 'peak_rss_mb', 'peak_cuda_mb'],
+                    help='排行依据，吞吐从高到低，参数量和内存从低到高')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'model')
+
+
+def discover():
+    r""" model/下定义了Model(nn.Module)的模块名，只看源码不导入 """
+    variants = []
+    for file_name in sorted(os.listdir(MODEL_DIR)):
+        if not file_name.endswith('.py'):
+            continue
+        with open(os.path.join(MODEL_DIR, file_name), 'r', encoding='utf8') as fr:
+            if re.search(r'^class Model\(nn\.Module\)', fr.read(), re.M):
+                variants.append(file_name[:-3])
+    return variants
+
+
+def level_corpus(config):
+    r""" 同benchmarks.level_encoder_cache，层级编码器的语料 """
+    id_sentences, len_sentences = pad_batch([random_sentence(5, 30, config) for _ in range(args.corpus_size)], config)
+    return {'id_sentences': id_sentences, 'len_sentences': len_sentences}
+
+
+def forward_extras(model_class, config, device):
+    r""" forward在inputs之后、inference之前的参数，返回(能构造的参数, 构造不了的参数名) """
+    names = list(inspect.signature(model_class.forward).parameters)[2:]  # 去掉self和inputs
+    names = names[:names.index('inference')] if 'inference' in names else names
+    extras, missing = [], []
+    for name in names:
+        if name == 'word2vec':
+            extras.append(SyntheticWord2Vec())
+        elif name == 'level_encoder_data':
+            extras.append(to_device(level_corpus(config), device))
+        else:  # 比如高斯混合的参数，要先在数据上拟合
+            missing.append(name)
+    return extras, missing
+
+
+def to_device(feed_data, device):
+    return {key: value.to(device) if isinstance(value, torch.Tensor) else value for key, value in feed_data.items()}
+
+
+def flatten(outputs):
+    if isinstance(outputs, (tuple, list)):
+        return [tensor for output in outputs for tensor in flatten(output)]
+    return [outputs]
+
+
+def surrogate_loss(outputs):
+    r""" 输出里所有需要梯度的浮点张量的均值之和 """
+    tensors = [output for output in flatten(outputs) if isinstance(output, torch.Tensor)
+               and output.requires_grad and output.is_floating_point()]
+    if not tensors:
+        raise ValueError('输出里没有需要梯度的张量')
+    return sum(tensor.float().mean() for tensor in tensors)
+
+
+def error_message(e):
+    if isinstance(e, (RuntimeError, AssertionError)) and ('NVIDIA driver' in str(e) or 'CUDA' in str(e)):
+        return '需要gpu'  # 写死了.cuda()的变体
+    lines = str(e).strip().splitlines()
+    return '{}: {}'.format(type(e).__name__, lines[0][:160] if lines else '')
+
+
+def timed(run, steps, gpu):
+    run(0)  # 预热，不计时
+    if gpu:
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for step in range(1, steps + 1):
+        run(step)
+    if gpu:
+        torch.cuda.synchronize()
+    return time.perf_counter() - start_time
+
+
+def profile(variant):
+    r""" 在当前进程里测一个变体 """
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    gpu = args.gpu and torch.cuda.is_available()
+    device = torch.device('cuda' if gpu else 'cpu')
+    result = {'variant': variant, 'params': None, 'train_tokens_per_sec': None, 'responses_per_sec': None,
+              'peak_rss_mb': None, 'peak_cuda_mb': None, 'status': 'ok'}
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kB
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    config = Config()
+    try:
+        model_class = importlib.import_module('model.' + variant).Model
+        model = model_class(config).to(device)
+        extras, missing = forward_extras(model_class, config, device)
+    except Exception as e:
+        result['status'] = '构建失败: ' + error_message(e)
+        return result
+    result['params'] = sum(param.numel() for param in model.parameters())
+    if missing:
+        result['status'] = '需要额外输入: ' + ', '.join(missing)
+        return result
+    batches = [to_device(model_feed_data(args.batch_size, config), device) for _ in range(args.steps + 1)]
+    if gpu:
+        torch.cuda.reset_peak_memory_stats()
+    errors = []
+
+    optim = Optim(config.method, config.lr, config.lr_decay, config.weight_decay, config.max_grad_norm)
+    optim.set_parameters(model.parameters())
+
+    def train_step(step):
+        outputs = model(batches[step], *extras, gpu=gpu)
+        surrogate_loss(outputs).backward()
+        optim.step()
+        optim.optimizer.zero_grad()
+
+    def generate_step(step):
+        model(batches[step], *extras, inference=True, max_len=args.max_len, gpu=gpu)
+
+    try:
+        model.train()
+        train_time = timed(train_step, args.steps, gpu)
+        tokens = sum(float(feed_data['masks'].sum()) for feed_data in batches[1:])
+        result['train_tokens_per_sec'] = tokens / train_time
+    except Exception as e:
+        errors.append('训练失败: ' + error_message(e))
+    optim.optimizer.zero_grad(set_to_none=True)
+    try:
+        model.eval()
+        with torch.no_grad():
+            generate_time = timed(generate_step, args.steps, gpu)
+        result['responses_per_sec'] = args.batch_size * args.steps / generate_time
+    except Exception as e:
+        errors.append('生成失败: ' + error_message(e))
+
+    result['peak_rss_mb'] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 1024
+    if gpu:
+        result['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 1024 ** 2
+    if errors:
+        result['status'] = '; '.join(errors)
+    return result
+
+
+def worker(variant, messages):
+    try:
+        messages.put(('result', profile(variant)))
+    except Exception:
+        messages.put(('error', traceback.format_exc()))
+
+
+def run_variant(variant):
+    r""" 在新进程里测一个变体，进程意外退出或超时时记在status里 """
+    context = mp.get_context('spawn')
+    messages = context.Queue()
+    process = context.Process(target=worker, args=(variant, messages), daemon=True)
+    process.start()
+    start_time = time.time()
+    result = None
+    while result is None:
+        try:
+            kind, payload = messages.get(timeout=1)
+            result = payload if kind == 'result' else {'variant': variant, 'status': '出错: ' + payload.strip().splitlines()[-1]}
+        except queue.Empty:
+            if not process.is_alive():  # 比如内存不够被杀掉
+                result = {'variant': variant, 'status': '进程意外退出，exitcode={}'.format(process.exitcode)}
+            elif time.time() - start_time > args.timeout:
+                process.kill()
+                result = {'variant': variant, 'status': '超过{}秒'.format(args.timeout)}
+    process.join()
+    return result
+
+
+def leaderboard(results):
+    r""" 按args.sort排序，没有这一项的排在最后 """
+    descending = args.sort in ['train_tokens_per_sec', 'responses_per_sec']
+    ranked = sorted([result for result in results if result.get(args.sort) is not None],
+                    key=lambda result: result[args.sort], reverse=descending)
+    ranked += [result for result in results if result.get(args.sort) is None]
+
+    def cell(value, scale=1.0, fmt='{:.1f}'):
+        return fmt.format(value / scale) if value is not None else '-'
+
+    lines = ['{:<50s}{:>10s}{:>14s}{:>14s}{:>14s}{:>14s}  {}'
+             .format('变体', '参数(M)', '训练token/s', '生成回复/s', '峰值RSS(MB)', '峰值显存(MB)', '状态')]
+    for result in ranked:
+        lines.append('{:<50s}{:>10s}{:>14s}{:>14s}{:>14s}{:>14s}  {}'
+                     .format(result['variant'], cell(result.get('params'), 1e6, '{:.2f}'),
+                             cell(result.get('train_tokens_per_sec')), cell(result.get('responses_per_sec')),
+                             cell(result.get('peak_rss_mb')), cell(result.get('peak_cuda_mb')), result['status']))
+    return ranked, '\n'.join(lines)
+
+
+def main():
+    variants = [variant for variant in args.variants.split(',') if variant] or discover()
+    results = []
+    for variant in variants:
+        result = run_variant(variant)
+        results.append(result)
+        print('{}: {}'.format(variant, result['status']))
+
+    ranked, table = leaderboard(results)
+    print(table)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump({'batch_size': args.batch_size, 'steps': args.steps, 'max_len': args.max_len,
+                       'gpu': args.gpu and torch.cuda.is_available(), 'results': ranked}, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
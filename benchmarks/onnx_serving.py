@@ -0,0 +1,117 @@
+r""" 导出model_topic_control、model_cvae、model_seq的encode/step两个ONNX图，检查onnxruntime贪心解码和pytorch是否一致，
+并比较cpu上的延迟
+
+python -m benchmarks.onnx_serving --batch_size 16 --steps 5
+"""
+import argparse
+import importlib
+import json
+import os
+import random
+import tempfile
+import time
+import numpy as np
+import torch
+from model.util.config import Config
+from model.onnx_export import export_onnx, onnx_modules, ENCODE_SPECS, MEMORY_NAMES
+from model.util.onnx_runner import OnnxGenerator
+from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data, keyword_category_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--variants', dest='variants', default='topic_control,cvae,seq', type=str, help='导出的模型')
+parser.add_argument('--batch_size', dest='batch_size', default=16, type=int, help='每个batch的样本数')
+parser.add_argument('--steps', dest='steps', default=5, type=int, help='计时的batch数')
+parser.add_argument('--max_len', dest='max_len', default=30, type=int, help='最大解码步数')
+parser.add_argument('--beam_size', dest='beam_size', default=5, type=int, help='beam search的beam数')
+parser.add_argument('--threads', dest='threads', default=0, type=int, help='cpu线程数，0为默认')
+parser.add_argument('--output_dir', dest='output_dir', default='', type=str, help='导出的ONNX文件夹，默认临时文件夹')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+MODULES = {'topic_control': 'model.model_topic_control', 'cvae': 'model.model_cvae', 'seq': 'model.model_seq'}
+
+
+def timing(run, batches):
+    r""" 预热一个batch后返回平均每个batch的耗时和所有结果 """
+    run(batches[0])
+    results = []
+    start_time = time.time()
+    for feed_data in batches:
+        results.append(run(feed_data))
+    return (time.time() - start_time) / len(batches), results
+
+
+def torch_greedy(encode, step, variant, feed_data):
+    r""" 用和导出时相同的encode/step模块在pytorch里贪心解码 """
+    input_names, output_names = ENCODE_SPECS[variant]
+    encoded = dict(zip(output_names, encode(*[feed_data[name] for name in input_names])))
+    h, c = encoded['h'], encoded['c']
+    memory = [encoded[name] for name in MEMORY_NAMES if name in encoded]
+    token = torch.full((h.size(1),), Config.start_id, dtype=torch.long)
+    done = torch.zeros(h.size(1), dtype=torch.bool)
+    results = []
+    for _ in range(args.max_len):
+        log_probs, h, c = step(token, h, c, *memory)
+        token = log_probs.argmax(1)
+        results.append(token)
+        done = done | (token == Config.end_id)
+        if bool(done.all()):
+            break
+    return torch.stack(results, 1).numpy()
+
+
+def run_variant(variant, config, word2vec):
+    torch.manual_seed(args.seed)
+    model = importlib.import_module(MODULES[variant]).Model(config)
+    model.eval()
+    feed = topic_feed_data if variant == 'topic_control' else keyword_category_feed_data
+    batches = [feed(args.batch_size, config) for _ in range(args.steps)]
+
+    output_dir = os.path.join(args.output_dir or tempfile.mkdtemp(), variant)
+    export_onnx(model, word2vec, variant, output_dir, batches[0])
+    generator = OnnxGenerator(output_dir, args.threads)
+    encode, step = onnx_modules(model, word2vec, variant)
+    numpy_batches = [{key: value.numpy() for key, value in feed_data.items()} for feed_data in batches]
+
+    def run_eager(feed_data):
+        outputs = model(feed_data, word2vec, inference=True, max_len=args.max_len, gpu=False)
+        return (outputs[0] if isinstance(outputs, tuple) else outputs).argmax(2).numpy()
+
+    result = {'variant': variant}
+    with torch.no_grad():
+        result['torch_graph'], torch_results = timing(lambda f: torch_greedy(encode, step, variant, f), batches)
+        result['torch_eager'], eager_results = timing(run_eager, batches)
+    result['onnx_greedy'], onnx_results = timing(lambda f: generator.greedy(f, args.max_len), numpy_batches)
+    result['onnx_beam'], _ = timing(lambda f: generator.beam(f, args.max_len, args.beam_size), numpy_batches)
+    result['onnx_sample'], _ = timing(lambda f: generator.sample(f, args.max_len, seed=args.seed), numpy_batches)
+
+    result['match_torch_graph'] = float(np.mean([np.array_equal(o, t) for o, t in zip(onnx_results, torch_results)]))
+    result['match_torch_eager'] = float(np.mean([np.array_equal(o, e) for o, e in zip(onnx_results, eager_results)]))
+    return result
+
+
+def main():
+    random.seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    config = Config()
+    word2vec = SyntheticWord2Vec()
+
+    results = []
+    for variant in args.variants.split(','):
+        result = run_variant(variant, config, word2vec)
+        results.append(result)
+        baseline = result['torch_eager']
+        print('{}: pytorch {:.3f}s/batch, onnxruntime 贪心{:.3f}s/batch(加速{:.2f}倍) beam{:.3f}s/batch 采样{:.3f}s/batch, '
+              '贪心结果一致比例 {:.2%}'.format(variant, baseline, result['onnx_greedy'], baseline / result['onnx_greedy'],
+                                        result['onnx_beam'], result['onnx_sample'],
+                                        result['match_torch_eager']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+r""" 比较驱动脚本原来的valid(带梯度、训练batch、每个batch三次tolist)和evaluate_perplexity(inference_mode、设备上累加)
+在验证集上的耗时，并检查同样batch大小时两者的NLL、KL和困惑度是否一致
+
+python -m benchmarks.perplexity_eval --num_examples 256 --batch_size 8 --valid_batch_size 128
+"""
+import argparse
+import importlib
+import json
+import random
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from model.util.config import Config
+from model.util.perplexity import evaluate_perplexity, split_outputs, gaussian_kld
+from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data, response_feed_data, split_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--variants', dest='variants', default='topic,topic_control,cvae,seq,mcvae_dd_act', type=str, help='验证的模型')
+parser.add_argument('--num_examples', dest='num_examples', default=256, type=int, help='验证集的样本数')
+parser.add_argument('--batch_size', dest='batch_size', default=8, type=int, help='原来valid用的训练batch大小')
+parser.add_argument('--valid_batch_size', dest='valid_batch_size', default=128, type=int, help='evaluate_perplexity用的batch大小')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+MODULES = {'topic': 'model.model_topic', 'topic_control': 'model.model_topic_control', 'cvae': 'model.model_cvae',
+           'seq': 'model.model_seq', 'mcvae_dd_act': 'model.model_word2vec_mcvae_dd_act'}
+
+
+def legacy_valid(model, word2vec, batches, config):
+    r""" 驱动脚本原来的valid：不关梯度，对整个词表求log，每个batch把三个张量转成list """
+    nll_losses, kld_losses, ppls = [], [], []
+    for feed_data in batches:
+        output_vocab, latents = split_outputs(model(feed_data, word2vec, gpu=False))
+        labels = feed_data['responses'][:, 1:]
+        masks = feed_data['masks']
+        nll_loss = F.nll_loss(output_vocab.reshape(-1, config.num_vocab).clamp_min(1e-12).log(), labels.reshape(-1),
+                              reduction='none')
+        nll_loss = (nll_loss * masks.reshape(-1)).reshape(-1, masks.size(1)).sum(1)
+        ppl = nll_loss / masks.sum(1).clamp_min(1e-12)
+        kld_loss = gaussian_kld(latents[2], latents[3], latents[0], latents[1]) if latents is not None \
+            else torch.zeros_like(nll_loss)
+        nll_losses.extend(nll_loss.detach().tolist())
+        kld_losses.extend(kld_loss.detach().tolist())
+        ppls.extend(ppl.detach().tolist())
+    return {'nll': np.mean(nll_losses), 'kld': np.mean(kld_losses), 'log_ppl': np.mean(ppls)}
+
+
+def timing(run):
+    start_time = time.time()
+    result = run()
+    return time.time() - start_time, result
+
+
+def run_variant(variant, config, word2vec):
+    torch.manual_seed(args.seed)
+    model = importlib.import_module(MODULES[variant]).Model(config)
+    model.eval()
+    feed = topic_feed_data if variant.startswith('topic') else response_feed_data
+    validset = feed(args.num_examples, config)
+    small_batches = split_feed_data(validset, args.batch_size)
+    large_batches = split_feed_data(validset, args.valid_batch_size)
+
+    legacy_valid(model, word2vec, small_batches[:1], config)  # 预热
+    legacy_time, legacy = timing(lambda: legacy_valid(model, word2vec, small_batches, config))
+    small_time, small = timing(lambda: evaluate_perplexity(model, word2vec, small_batches))
+    large_time, large = timing(lambda: evaluate_perplexity(model, word2vec, large_batches))
+    max_diff = max(abs(legacy[key] - small[key]) / max(abs(legacy[key]), 1e-6) for key in ['nll', 'kld', 'log_ppl'])
+    return {'variant': variant, 'legacy_valid': legacy_time, 'inference_small_batch': small_time,
+            'inference_large_batch': large_time, 'max_relative_diff': max_diff,
+            'ppl': small['ppl'], 'token_ppl': small['token_ppl'], 'large_batch_ppl': large['ppl']}
+
+
+def main():
+    random.seed(args.seed)
+    config = Config()
+    word2vec = SyntheticWord2Vec()
+    results = []
+    for variant in args.variants.split(','):
+        result = run_variant(variant, config, word2vec)
+        results.append(result)
+        print('{}: 原来的valid {:.2f}s, inference_mode batch={} {:.2f}s, batch={} {:.2f}s(加速{:.2f}倍), '
+              '和原来的最大相对差{:.1e}, PPL {:.1f}, 按token的PPL {:.1f}'
+              .format(variant, result['legacy_valid'], args.batch_size, result['inference_small_batch'],
+                      args.valid_batch_size, result['inference_large_batch'],
+                      result['legacy_valid'] / result['inference_large_batch'], result['max_relative_diff'],
+                      result['ppl'], result['token_ppl']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
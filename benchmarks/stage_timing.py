@@ -0,0 +1,103 @@
+r""" 用model.util.profiling.timer对model_topic_control的训练和贪心生成分阶段计时，打印各阶段的耗时表，
+比较计时关闭和打开时每步的耗时，并可以导出Chrome trace
+
+python -m benchmarks.stage_timing --steps 10 --trace /tmp/topic_control_trace.json
+"""
+import argparse
+import json
+import random
+import time
+import torch
+import torch.nn.functional as F
+from model.util.config import Config
+from model.model_topic_control import Model
+from model.Optim import Optim
+from model.util.profiling import timer
+from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', dest='batch_size', default=8, type=int, help='每个batch的样本数')
+parser.add_argument('--steps', dest='steps', default=10, type=int, help='训练和生成各计时多少步')
+parser.add_argument('--max_len', dest='max_len', default=30, type=int, help='生成时最大解码步数')
+parser.add_argument('--gpu', dest='gpu', action='store_true', help='是否使用gpu')
+parser.add_argument('--trace', dest='trace', default='', type=str, help='Chrome trace的位置，为空时不导出')
+parser.add_argument('--trace_steps', dest='trace_steps', default=3, type=int, help='Chrome trace记录多少步')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+
+def compute_loss(outputs, feed_data, config):
+    r""" 同cvae_topic_globle_control.compute_loss，kl权重取1 """
+    output_vocab, _mu, _logvar, mu, logvar = outputs
+    masks = feed_data['masks']
+    nll_loss = F.nll_loss(output_vocab.reshape(-1, config.num_vocab).clamp_min(1e-12).log(),
+                          feed_data['responses'][:, 1:].reshape(-1), reduction='none')
+    nll_loss = (nll_loss * masks.reshape(-1)).reshape(-1, masks.size(1)).sum(1)
+    kld_loss = 0.5 * torch.sum(_logvar - logvar - 1 + logvar.exp() / _logvar.exp()
+                               + (_mu - mu).pow(2) / _logvar.exp(), 1)
+    return (nll_loss + kld_loss).mean()
+
+
+def run(model, optim, word2vec, config, batches, device):
+    r""" 和驱动脚本一样的位置计时，返回训练和生成平均每步的秒数 """
+    start_time = time.time()
+    for data in timer.iterate(batches, 'get_batch_data'):
+        with timer.region('prepare_feed_data'):
+            feed_data = {key: value.to(device) for key, value in data.items()}
+        with timer.region('forward'):
+            outputs = model(feed_data, word2vec, gpu=args.gpu)[:5]
+        with timer.region('loss'):
+            loss = compute_loss(outputs, feed_data, config)
+        with timer.region('backward'):
+            loss.backward()
+        with timer.region('optim'):
+            optim.step()
+        optim.optimizer.zero_grad()
+        timer.step()
+    train_time = (time.time() - start_time) / len(batches)
+
+    model.eval()
+    start_time = time.time()
+    with torch.no_grad():
+        for data in batches:
+            feed_data = {key: value.to(device) for key, value in data.items()}
+            with timer.region('generate'):
+                model(feed_data, word2vec, inference=True, max_len=args.max_len, gpu=args.gpu)
+    model.train()
+    return train_time, (time.time() - start_time) / len(batches)
+
+
+def main():
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    device = 'cuda' if args.gpu else 'cpu'
+    config = Config()
+    word2vec = SyntheticWord2Vec()
+    model = Model(config).to(device)
+    model.train()
+    optim = Optim(config.method, config.lr, config.lr_decay, config.weight_decay, config.max_grad_norm)
+    optim.set_parameters(model.parameters())
+    batches = [topic_feed_data(args.batch_size, config) for _ in range(args.steps)]
+
+    run(model, optim, word2vec, config, batches[:1], device)  # 预热
+    disabled = run(model, optim, word2vec, config, batches, device)
+    timer.enable(args.gpu, args.trace, args.trace_steps)
+    enabled = run(model, optim, word2vec, config, batches, device)
+    timer.close()
+    print(timer.summary())
+    print('每步训练: 计时关闭{:.3f}s, 打开{:.3f}s; 每个batch生成: 关闭{:.3f}s, 打开{:.3f}s'
+          .format(disabled[0], enabled[0], disabled[1], enabled[1]))
+    if args.trace:
+        print(f'Chrome trace导出到{args.trace}')
+
+    if args.output:
+        result = {'disabled': {'train': disabled[0], 'generate': disabled[1]},
+                  'enabled': {'train': enabled[0], 'generate': enabled[1]},
+                  'stages': {path: {'calls': calls, 'total': total} for path, (calls, total) in timer.totals.items()}}
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(result, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import random
+import torch
+from model.util.config import Config
+
+
+class SyntheticWord2Vec(object):
+    r""" 和Word2Vec_emb接口一致的随机词向量，基准测试不依赖gensim模型文件和gpu """
+    def __init__(self, num_vocab=Config.num_vocab, embedding_size=Config.embedding_size, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        self.weight = torch.randn(num_vocab, embedding_size, generator=generator)
+
+    def embedding(self, batch_data):  # [batch, seq]
+        return self.weight[batch_data.cpu()].to(batch_data.device)  # [batch, seq, embedding_size]
+
+
+def random_sentence(min_len, max_len, config=Config):
+    r""" 随机生成一条不含特殊符号的句子id """
+    length = random.randint(min_len, max_len)
+    return [random.randint(config.unk_id + 1, config.num_vocab - 1) for _ in range(length)]
+
+
+def pad_batch(sentences, config=Config):
+    r""" 和SentenceProcessor.pad_sentence一致：加start/end并补齐，返回(ids, lengths) """
+    lengths = [len(s) + 2 for s in sentences]
+    max_len = max(lengths)
+    ids = [[config.start_id] + s + [config.end_id] + [config.pad_id] * (max_len - len(s) - 2) for s in sentences]
+    return torch.tensor(ids).long(), torch.tensor(lengths).long()
+
+
+def topic_feed_data(batch_size, config=Config, min_len=5, max_len=20, num_keywords=5):
+    r""" 构造topic系列模型prepare_feed_data输出的同形状输入 """
+    posts, len_posts = pad_batch([random_sentence(min_len, max_len, config) for _ in range(batch_size)], config)
+    responses, len_responses = pad_batch([random_sentence(min_len, max_len, config) for _ in range(batch_size)], config)
+    keywords = torch.randint(config.unk_id + 1, config.num_vocab, (batch_size, num_keywords)).long()
+    len_labels = len_responses - 1
+    masks = (1 - torch.nn.functional.one_hot(len_labels, int(len_labels.max()) + 1).cumsum(1))[:, :-1]
+    return {'posts': posts,
+            'len_posts': len_posts,
+            'responses': responses,
+            'len_responses': len_responses,
+            'sampled_latents': torch.randn((batch_size, config.latent_size)),
+            'masks': masks.float(),
+            'keywords': keywords,
+            'topic': torch.randint(0, 4, (batch_size, 1)).long(),
+            'len_keywords': torch.full((batch_size,), num_keywords).long()}
+
+
+def keyword_category_feed_data(batch_size, config=Config, min_len=5, max_len=20, num_keywords=5, len_category=1):
+    r""" 构造model_cvae、model_seq测试时的输入 """
+    posts, len_posts = pad_batch([random_sentence(min_len, max_len, config) for _ in range(batch_size)], config)
+    len_keywords = torch.randint(1, num_keywords + 1, (batch_size,)).long()
+    keywords = torch.randint(config.unk_id + 1, config.num_vocab, (batch_size, num_keywords)).long()
+    keywords = keywords * (torch.arange(num_keywords).unsqueeze(0) < len_keywords.unsqueeze(1)).long()  # 补齐的位置为pad_id
+    return {'posts': posts,
+            'len_posts': len_posts,
+            'keywords': keywords,
+            'len_keywords': len_keywords,
+            'category': torch.randint(config.unk_id + 1, config.num_vocab, (batch_size, len_category)).long(),
+            'len_category': torch.full((batch_size,), len_category).long(),
+            'sampled_latents': torch.randn((batch_size, config.latent_size))}
+
+
+def response_feed_data(batch_size, config=Config, min_len=5, max_len=20, num_keywords=5, len_category=1):
+    r""" keyword_category_feed_data加上回复和masks，model_cvae、model_seq和mcvae系列训练、验证时的输入 """
+    feed_data = keyword_category_feed_data(batch_size, config, min_len, max_len, num_keywords, len_category)
+    responses, len_responses = pad_batch([random_sentence(min_len, max_len, config) for _ in range(batch_size)], config)
+    len_labels = len_responses - 1
+    masks = (1 - torch.nn.functional.one_hot(len_labels, int(len_labels.max()) + 1).cumsum(1))[:, :-1]
+    feed_data.update({'responses': responses,
+                      'len_responses': len_responses,
+                      'masks': masks.float(),
+                      'responses_act': torch.randint(0, 4, (batch_size, 1)).long()})
+    return feed_data
+
+
+def split_feed_data(feed_data, batch_size):
+    r""" 把一个大batch按样本切成小batch，补齐的长度不变 """
+    num_examples = feed_data['posts'].size(0)
+    return [{key: value[start:start + batch_size] for key, value in feed_data.items()}
+            for start in range(0, num_examples, batch_size)]
+
+
+def model_feed_data(batch_size, config=Config, min_len=5, max_len=20, num_keywords=5):
+    r""" model/下各个Model变体读取的输入的并集，用同一份输入跑所有变体 """
+    feed_data = response_feed_data(batch_size, config, min_len, max_len, num_keywords)
+    feed_data.update({'topic': feed_data['responses_act'],
+                      'labels_id': torch.randint(0, config.nClusters, (batch_size,)).long(),
+                      'str_responses_act': [random.choice(['inform', 'question', 'directive', 'commissive'])
+                                            for _ in range(batch_size)]})
+    return feed_data
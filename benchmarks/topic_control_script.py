@@ -0,0 +1,76 @@
+r""" model_topic_control在cpu上eager与TorchScript推理的耗时对比，同时检查两者生成结果是否一致
+
+python -m benchmarks.topic_control_script --batch_size 32 --steps 10
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import torch
+from model.util.config import Config
+from model.model_topic_control import Model
+from model.model_topic_control_script import export_script, load_script
+from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', dest='batch_size', default=32, type=int, help='每个batch的样本数')
+parser.add_argument('--steps', dest='steps', default=10, type=int, help='计时的batch数')
+parser.add_argument('--max_len', dest='max_len', default=30, type=int, help='最大解码步数')
+parser.add_argument('--threads', dest='threads', default=0, type=int, help='cpu线程数，0为torch默认')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+
+def timing(run, batches):
+    r""" 先跑一个batch预热，返回平均每个batch的耗时和所有结果 """
+    run(batches[0])
+    results = []
+    start_time = time.time()
+    for feed_data in batches:
+        results.append(run(feed_data))
+    return (time.time() - start_time) / len(batches), results
+
+
+def main():
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    config = Config()
+    word2vec = SyntheticWord2Vec()
+    model = Model(config)
+    model.eval()
+
+    path = os.path.join(tempfile.mkdtemp(), 'topic_control.pt')
+    export_script(model, word2vec, path)
+    scripted, _ = load_script(path)
+    batches = [topic_feed_data(args.batch_size, config) for _ in range(args.steps)]
+
+    def run_eager(feed_data):
+        output_vocab = model(feed_data, word2vec, inference=True, max_len=args.max_len, gpu=False)[0]
+        return output_vocab.argmax(2)
+
+    def run_script(feed_data):
+        return scripted(feed_data['posts'], feed_data['len_posts'], feed_data['keywords'], feed_data['len_keywords'],
+                        feed_data['topic'], feed_data['sampled_latents'], args.max_len)
+
+    with torch.no_grad():
+        eager_time, eager_results = timing(run_eager, batches)
+        script_time, script_results = timing(run_script, batches)
+    match = sum(int(torch.equal(e, s)) for e, s in zip(eager_results, script_results)) / len(batches)
+
+    results = {'batch_size': args.batch_size, 'max_len': args.max_len, 'eager': eager_time, 'script': script_time,
+               'speedup': eager_time / script_time, 'match_rate': match, 'artifact_bytes': os.path.getsize(path)}
+    print('eager: {:.3f}s/batch, TorchScript: {:.3f}s/batch, 加速{:.2f}倍, 结果一致的batch比例: {:.2%}'
+          .format(eager_time, script_time, eager_time / script_time, match))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
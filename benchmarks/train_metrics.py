@@ -0,0 +1,118 @@
+r""" model_topic_control训练时比较两种记录训练指标的方式在训练线程上花的时间：原来每print_per_step次更新.item()几次、
+同步写tensorboard并flush，和MetricsAggregator在设备上累加、每个间隔同步一次、后台写tensorboard和jsonl。
+并检查MetricsAggregator记录的是间隔内每一步的平均值
+
+python -m benchmarks.train_metrics --steps 40 --print_per_step 5
+"""
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import time
+import torch
+import torch.nn.functional as F
+from torch.utils.tensorboard import SummaryWriter
+from model.util.config import Config
+from model.model_topic_control import Model
+from model.Optim import Optim
+from model.util.metrics import MetricsAggregator
+from benchmarks.synthetic import SyntheticWord2Vec, topic_feed_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', dest='batch_size', default=8, type=int, help='每个batch的样本数')
+parser.add_argument('--steps', dest='steps', default=40, type=int, help='训练步数')
+parser.add_argument('--print_per_step', dest='print_per_step', default=5, type=int, help='每多少步记录一次')
+parser.add_argument('--gpu', dest='gpu', action='store_true', help='是否使用gpu')
+parser.add_argument('--output', dest='output', default='', type=str, help='结果写入的json文件')
+parser.add_argument('--seed', dest='seed', default=999, type=int, help='随机种子')
+args = parser.parse_args()
+
+
+def compute_loss(outputs, feed_data, config):
+    r""" 同cvae_topic_globle_control.compute_loss，kl权重取1 """
+    output_vocab, _mu, _logvar, mu, logvar = outputs
+    masks = feed_data['masks']
+    nll_loss = F.nll_loss(output_vocab.reshape(-1, config.num_vocab).clamp_min(1e-12).log(),
+                          feed_data['responses'][:, 1:].reshape(-1), reduction='none')
+    nll_loss = (nll_loss * masks.reshape(-1)).reshape(-1, masks.size(1)).sum(1)
+    ppl = nll_loss / masks.sum(1).clamp_min(1e-12)
+    kld_loss = 0.5 * torch.sum(_logvar - logvar - 1 + logvar.exp() / _logvar.exp()
+                               + (_mu - mu).pow(2) / _logvar.exp(), 1)
+    return nll_loss, kld_loss, ppl
+
+
+def run(aggregate, config, word2vec, batches, device):
+    r""" 返回训练总耗时、训练线程上记录指标花的时间和每次记录的值 """
+    torch.manual_seed(args.seed)
+    model = Model(config).to(device)
+    model.train()
+    optim = Optim(config.method, config.lr, config.lr_decay, config.weight_decay, config.max_grad_norm)
+    optim.set_parameters(model.parameters())
+    log_dir = tempfile.mkdtemp()
+    summary_writer = SummaryWriter(os.path.join(log_dir, 'summary'))
+    metrics = MetricsAggregator(summary_writer, os.path.join(log_dir, 'train_metrics.jsonl'))
+    records, step_values, logging_time = [], [], 0
+    start_time = time.time()
+    for global_step, feed_data in enumerate(batches, 1):
+        nll_loss, kld_loss, ppl = compute_loss(model(feed_data, word2vec, gpu=args.gpu)[:5], feed_data, config)
+        (nll_loss + kld_loss).mean().backward()
+        optim.step()
+        optim.optimizer.zero_grad()
+        log_start = time.time()
+        if aggregate:
+            metrics.add(feed_data['posts'].size(0), feed_data['masks'].sum(),
+                        nll=nll_loss.mean(), kld=kld_loss.mean(), weight=1.0, ppl=ppl.mean())
+            if global_step % args.print_per_step == 0:
+                records.append(metrics.log(global_step, lr=optim.lr))
+        elif global_step % args.print_per_step == 0:  # 原来的做法，只记录这一步
+            record = {'global_step': global_step, 'nll': nll_loss.mean().item(), 'kld': kld_loss.mean().item(),
+                      'ppl': ppl.mean().exp().item()}
+            for name in ['nll', 'kld', 'ppl']:
+                summary_writer.add_scalar('train_' + name, record[name], global_step)
+            summary_writer.flush()
+            records.append(record)
+        logging_time += time.time() - log_start
+        step_values.append([nll_loss.mean().item(), kld_loss.mean().item(), ppl.mean().item()])  # 不计时，用来核对
+    train_time = time.time() - start_time
+    metrics.close()
+    summary_writer.close()
+
+    max_diff = 0  # 记录的值和间隔内每一步的平均值的相对差
+    if aggregate:
+        with open(os.path.join(log_dir, 'train_metrics.jsonl'), encoding='utf8') as fr:
+            assert [json.loads(line) for line in fr] == records
+        for record in records:
+            interval = step_values[record['global_step'] - args.print_per_step:record['global_step']]
+            expected = [sum(values) / len(interval) for values in zip(*interval)]
+            expected[2] = math.exp(expected[2])
+            max_diff = max([max_diff] + [abs(record[name] - value) / abs(value)
+                                         for name, value in zip(['nll', 'kld', 'ppl'], expected)])
+    return {'aggregate': aggregate, 'train_time': train_time, 'logging_time': logging_time,
+            'max_relative_diff': max_diff, 'records': records}
+
+
+def main():
+    random.seed(args.seed)
+    device = 'cuda' if args.gpu else 'cpu'
+    config = Config()
+    word2vec = SyntheticWord2Vec()
+    batches = [{key: value.to(device) for key, value in topic_feed_data(args.batch_size, config).items()}
+               for _ in range(args.steps)]
+    results = [run(False, config, word2vec, batches, device), run(True, config, word2vec, batches, device)]
+    for result in results:
+        print('{}: 训练{:.2f}s, 训练线程上记录指标{:.3f}s, 和每步平均值的最大相对差{:.1e}'
+              .format('MetricsAggregator' if result['aggregate'] else '每次记录时同步', result['train_time'],
+                      result['logging_time'], result['max_relative_diff']))
+    last = results[1]['records'][-1]
+    print('最后一个间隔: {:.0f} tokens/s, {:.1f} examples/s, {:.3f}s/step'
+          .format(last['tokens_per_sec'], last['examples_per_sec'], last['time_per_step']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
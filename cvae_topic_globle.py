@@ -1,15 +1,33 @@
 from model.util.config import Config
 from model.model_topic import Model
 from model.Optim import Optim
+from model.util.amp import MixedPrecision
+from model.util.async_checkpoint import AsyncCheckpointWriter
+from model.util.async_validation import AsyncValidator
+from model.util.metrics import MetricsAggregator
+from model.util.profiling import timer
+from model.util.memory_profile import (profile_memory, fit_memory, recommend_batch_size, available_memory_mb,
+                                       optimizer_state_mb, predict_memory, memory_table)
+from model.util.distributed import init_distributed, is_main_process, sync_context, launch, all_reduce_min, \
+    broadcast_object
+from model.util.perplexity import evaluate_perplexity, evaluate_snapshot
+from model.util.packing import PackInfo
+from model.util.state_cache import EncoderStateCache
+from model.util.session import DialogueSession
+from model.util.quantize import quantize_dynamic, model_size, save_quantized
+from model.util.checkpoint import export_inference, drop_training_only
 from model.util.sentence_processor import SentenceProcessor
 from gensim_word2vec_new import Word2Vec_emb
 from model.util.data_processor_topic_globle import DataProcessor
 from torch.utils.tensorboard import SummaryWriter
+from torch.nn.parallel import DistributedDataParallel
+from distinct_n import distinct_n_corpus_level
 import torch
 import torch.nn.functional as F
 import argparse
 import json
 import os
+import random
 import time
 import numpy as np
 
@@ -29,13 +47,38 @@ parser.add_argument('--max_len', dest='max_len', default=60, type=int, help='测
 parser.add_argument('--model_path', dest='model_path', default='log/topic1640847213/010000000335470.model', type=str, help='载入模型位置')  #
 parser.add_argument('--seed', dest='seed', default=666, type=int, help='随机种子')  #
 parser.add_argument('--gpu', dest='gpu', default=True, type=bool, help='是否使用gpu')  #
+parser.add_argument('--state_cache_size', dest='state_cache_size', default=100000, type=int, help='测试时缓存多少条句子的编码状态，0表示不缓存')
+parser.add_argument('--cache_valid', dest='cache_valid', action='store_true', help='训练中验证时是否也用编码状态缓存')
+parser.add_argument('--incremental', dest='incremental', action='store_true', help='测试时是否按对话逐轮生成，post编码器状态在对话内延续')
+parser.add_argument('--export_inference', dest='export_inference', default='', type=str, help='只保留生成用的部分导出到的位置，导出后退出')
+parser.add_argument('--export_half', dest='export_half', action='store_true', help='导出时浮点参数是否存成float16')
+parser.add_argument('--quantize', dest='quantize', default='', type=str, help='动态量化成int8后保存的位置，并在验证集上和浮点模型比较，比较后退出')
+parser.add_argument('--micro_batch_size', dest='micro_batch_size', default=1, type=int, help='每次前向的样本数')
+parser.add_argument('--accumulation_steps', dest='accumulation_steps', default=1, type=int, help='累积多少次前向的梯度更新一次参数，实际batch为两者之积')
+parser.add_argument('--num_processes', dest='num_processes', default=1, type=int, help='训练的进程数，大于1时每个进程训练一部分数据，用gloo后端同步梯度')
+parser.add_argument('--sync_save', dest='sync_save', action='store_true', help='在主线程写模型文件，默认在后台线程写')
+parser.add_argument('--save_in_flight', dest='save_in_flight', default=2, type=int, help='最多同时有几次保存没写完')
+parser.add_argument('--keep_last', dest='keep_last', default=0, type=int, help='只保留最近几个模型文件，0表示全部保留')
+parser.add_argument('--valid_batch_size', dest='valid_batch_size', default=128, type=int, help='验证时每个batch的样本数，只做前向可以比训练时大很多')
+parser.add_argument('--async_valid', dest='async_valid', action='store_true', help='是否在另一个进程里用参数快照验证，训练不用等验证结束')
+parser.add_argument('--valid_in_flight', dest='valid_in_flight', default=2, type=int, help='最多有几份参数快照等着验证')
+parser.add_argument('--quick_valid', dest='quick_valid', default=0, type=int, help='训练中途只在随机抽出的这么多条验证集上验证，0表示用全部，每个epoch结束时总是用全部')
+parser.add_argument('--profile', dest='profile', action='store_true', help='是否按阶段计时(取数据、前向各部分、损失、反向、更新参数)，打开时每个阶段前后同步cuda')
+parser.add_argument('--profile_trace', dest='profile_trace', default='', type=str, help='打开--profile时用torch.profiler记录前几步，导出Chrome trace的位置')
+parser.add_argument('--profile_trace_steps', dest='profile_trace_steps', default=5, type=int, help='Chrome trace记录多少步')
+parser.add_argument('--auto_batch_size', dest='auto_batch_size', action='store_true', help='训练前测出不同batch大小和回复长度下的峰值内存，把micro_batch_size换成预算内最大的安全值')
+parser.add_argument('--memory_budget', dest='memory_budget', default=0, type=float, help='--auto_batch_size的内存预算(MB)，gpu上是显存，0表示当前可用的全部')
+parser.add_argument('--memory_safety', dest='memory_safety', default=0.8, type=float, help='只用内存预算的这个比例，给碎片和拟合误差留余量')
+parser.add_argument('--auto_batch_len', dest='auto_batch_len', default=0, type=int, help='按多长的回复推荐batch，0表示训练集里最长的回复')
+parser.add_argument('--amp', dest='amp', action='store_true', help='是否混合精度训练，cpu上bf16，gpu上fp16')
 parser.add_argument('--max_epoch', dest='max_epoch', default=10, type=int, help='最大训练epoch')
 
 args = parser.parse_args()  # 程序运行参数
 
 config = Config()  # 模型配置
-config.batch_size = 1
-word2vec = Word2Vec_emb()
+config.batch_size = args.micro_batch_size  # 每次前向的batch，更新参数的batch为micro_batch_size*accumulation_steps
+word2vec = None  # 在main里载入，后台验证进程导入这个脚本时不会再载入一份词向量
+amp = MixedPrecision(args.amp, args.gpu)  # 混合精度，关闭时不起作用
 
 torch.manual_seed(args.seed)
 if torch.cuda.is_available():
@@ -43,6 +86,8 @@ if torch.cuda.is_available():
 
 
 def main():
+    global word2vec
+    word2vec = Word2Vec_emb()
     print(1)
     trainset, validset, testset = [], [], []
     if args.inference:  # 测试时只载入测试集
@@ -66,6 +111,14 @@ def main():
                 validset.append(json.loads(line))
         print(f'载入验证集{len(validset)}条')
 
+    if args.quantize:  # 量化时在验证集上比较
+        with open(args.validset_path, 'r', encoding='utf8') as fr:
+            for line in fr:
+                if len(json.loads(line)['KeyWord']) == 0:
+                    continue
+                validset.append(json.loads(line))
+        print(f'载入验证集{len(validset)}条')
+
     # 载入词汇表，词向量
     vocab_d ={}
     vocab = []
@@ -87,14 +140,20 @@ def main():
     # 创建模型
     model = Model(config)
     model.print_parameters()  # 输出模型参数个数
+    if args.state_cache_size > 0 and (args.inference or args.cache_valid):  # 测试模式下复用同一编码器、同一参数下已经编码过的句子
+        model.state_cache = EncoderStateCache(args.state_cache_size)
     epoch = 0  # 训练集迭代次数
     global_step = 0  # 参数更新次数
 
+    rank, world_size = init_distributed()  # 单进程时为(0, 1)，日志目录要在这之后才能只由rank 0创建
+
     # 载入模型
     print(os.path.isfile(args.model_path))
     if os.path.isfile(args.model_path):  # 如果载入模型的位置存在则载入模型
-        epoch, global_step = model.load_model(args.model_path)
-        print('载入模型完成')
+        load_start = time.time()
+        epoch, global_step = model.load_model(args.model_path,
+                                              inference=args.inference and not args.quantize)  # 只生成时不读训练用的部分
+        print('载入模型完成，用时{:.2f}s'.format(time.time() - load_start))
         # 记录模型的文件夹
         log_dir = os.path.split(args.model_path)[0]
     elif args.inference:  # 如果载入模型的位置不存在，但是又要测试，这是没有意义的
@@ -103,81 +162,147 @@ def main():
     else:  # 如果载入模型的位置不存在，重新开始训练，则载入预训练的词向量
         print('初始化模型完成')
         # 记录模型的文件夹
-        log_dir = os.path.join(args.log_path, 'topic' + str(int(time.time())))
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
+        log_dir = broadcast_object(os.path.join(args.log_path, 'topic' + str(int(time.time()))))  # 所有进程用rank 0的目录
+        if is_main_process():
+            os.makedirs(log_dir, exist_ok=True)
+
+    if args.export_inference:  # 去掉回复编码器、识别网络等训练用的部分
+        export_inference(model, args.export_inference, epoch, global_step, half=args.export_half)
+        print('导出生成用的模型到{}, {:.1f}MB'.format(args.export_inference, os.path.getsize(args.export_inference) / 2**20))
+        return
 
+    if args.quantize:  # 动态量化成int8，和浮点模型在cpu上比较
+        args.gpu = False  # 量化后的模型只能在cpu上运行
+        model.state_cache = None  # 不用缓存，耗时才可比
+        dp_valid = DataProcessor(validset, config.batch_size, sentence_processor, global_keywords, shuffle=False)
+        model.eval()
+        quantized = quantize_dynamic(model)
+        float_result = evaluate(model, dp_valid, sentence_processor)
+        quantized_result = evaluate(quantized, dp_valid, sentence_processor)
+        save_quantized(quantized, args.quantize)
+
+        float_size, quantized_size = model_size(model), model_size(quantized)
+        print('模型大小: 浮点{:.1f}MB, int8 {:.1f}MB, 减少{:.1%}'
+              .format(float_size / 2**20, quantized_size / 2**20, 1 - quantized_size / float_size))
+        print('验证集耗时: 浮点{:.1f}s, int8 {:.1f}s, 加速{:.2f}倍'
+              .format(float_result['time'], quantized_result['time'], float_result['time'] / quantized_result['time']))
+        for key in ['nll', 'ppl', 'distinct_1', 'distinct_2']:
+            print('{}: 浮点{:.4f}, int8 {:.4f}, 变化{:+.4f}'
+                  .format(key, float_result[key], quantized_result[key], quantized_result[key] - float_result[key]))
+        print(f'量化模型保存到{args.quantize}')
+        return
+
+    if args.inference:  # 只生成时释放训练用的部分
+        drop_training_only(model)
+
+    if world_size > 1:
+        torch.manual_seed(args.seed + rank)  # 各进程的dropout和隐变量采样不同，初始参数由DistributedDataParallel从rank 0广播
+        if args.gpu:
+            torch.cuda.set_device(rank % torch.cuda.device_count())
     if args.gpu:
         model.to('cuda')  # 将模型参数转到gpu
+    if args.auto_batch_size and not args.inference:  # 按内存预算换成最大的安全batch
+        config.batch_size = auto_batch_size(model, trainset, sentence_processor, global_keywords, world_size)
+    train_model = DistributedDataParallel(model, find_unused_parameters=True) if world_size > 1 else model
     # 定义优化器参数
-    optim = Optim(config.method, config.lr, config.lr_decay, config.weight_decay, config.max_grad_norm)
+    optim = Optim(config.method, config.lr, config.lr_decay, config.weight_decay, config.max_grad_norm,
+                  args.accumulation_steps)
     optim.set_parameters(model.parameters())  # 给优化器设置参数
     optim.update_lr(epoch)  # 每个epoch更新学习率
+    if args.profile:  # 只有rank 0导出Chrome trace
+        timer.enable(args.gpu, args.profile_trace if is_main_process() else '', args.profile_trace_steps)
 
     # 训练
     if not args.inference:
-        summary_writer = SummaryWriter(os.path.join(log_dir, 'summary'))  # 创建tensorboard记录的文件夹
-        dp_train = DataProcessor(trainset, config.batch_size, sentence_processor, global_keywords)  # 数据的迭代器
-        dp_valid = DataProcessor(validset, config.batch_size, sentence_processor, global_keywords, shuffle=False)
+        summary_writer = SummaryWriter(os.path.join(log_dir, 'summary')) if is_main_process() else None  # 创建tensorboard记录的文件夹
+        checkpoint_writer = AsyncCheckpointWriter(args.save_in_flight, args.keep_last, enabled=not args.sync_save)
+        # 训练指标在设备上累加，每print_per_step次更新同步一次，所有进程都要参与
+        metrics = MetricsAggregator(summary_writer, os.path.join(log_dir, 'train_metrics.jsonl') if is_main_process() else '',
+                                    start_step=global_step)
+        dp_train = DataProcessor(trainset, config.batch_size, sentence_processor, global_keywords,
+                                 rank=rank, world_size=world_size, seed=args.seed)  # 数据的迭代器
+        # 后台验证只在rank 0上进行，用全部验证集；同步验证时每个进程验证一部分
+        valid_shard = {'rank': 0, 'world_size': 1} if args.async_valid else {'rank': rank, 'world_size': world_size}
+        dp_valid = DataProcessor(validset, args.valid_batch_size, sentence_processor, global_keywords, shuffle=False, **valid_shard)
+        quickset = random.Random(args.seed).sample(validset, min(args.quick_valid, len(validset))) \
+            if args.quick_valid > 0 else validset  # 每次抽样验证都用同一批样本，结果才可比
+        dp_quick = DataProcessor(quickset, args.valid_batch_size, sentence_processor, global_keywords, shuffle=False, **valid_shard)
+        validator = None
+        if is_main_process() or not args.async_valid:
+            # 验证用的feed_data在cpu上准备一次，连同词向量和设置显式传给验证函数
+            valid_batches = [prepare_feed_data(data, gpu=False) for data in dp_valid.get_batch_data()]
+            quick_batches = [prepare_feed_data(data, gpu=False) for data in dp_quick.get_batch_data()] \
+                if args.quick_valid > 0 else valid_batches
+            validator = AsyncValidator(model, evaluate_snapshot,
+                                       (word2vec, valid_batches, quick_batches, config.kl_step, args.gpu),
+                                       args.valid_in_flight, enabled=args.async_valid)
         while epoch < args.max_epoch:  # 最大训练轮数
             model.train()
-            for data in dp_train.get_batch_data():
-                start_time = time.time()
-                feed_data = prepare_feed_data(data)
-                loss, nll_loss, kld_loss, ppl, kld_weight= train(model, feed_data, global_step)
-                loss.mean().backward()  # 反向传播
-                optim.step()  # 更新参数
+            for data in timer.iterate(dp_train.get_batch_data(), 'get_batch_data'):
+                with timer.region('prepare_feed_data'):
+                    feed_data = prepare_feed_data(data)
+                # kl退火按参数更新次数计算
+                with sync_context(train_model, optim.micro_steps + 1 == optim.accumulation_steps):  # 多进程时只在更新参数前同步梯度
+                    loss, nll_loss, kld_loss, ppl, kld_weight= train(train_model, feed_data, global_step)
+                    with timer.region('backward'):
+                        amp.backward(loss.mean() / optim.accumulation_steps)  # 反向传播，梯度在各micro-batch间累加
+                metrics.add(feed_data['posts'].size(0), feed_data['masks'].sum(),  # 不同步，记录时才取回
+                            nll=nll_loss.mean(), kld=kld_loss.mean(), weight=kld_weight, ppl=ppl.mean())
+                with timer.region('optim'):
+                    updated = optim.step(amp.scaler)
+                if not updated:  # 梯度还没累积够，不更新参数
+                    continue
                 optim.optimizer.zero_grad()  # 清空梯度
-                use_time = time.time() - start_time
+                timer.step()  # 设置了--profile_trace时推进torch.profiler
 
                 global_step += 1  # 参数更新次数+1
-                # summary当前情况
+                # summary这print_per_step次更新的平均情况，tensorboard和jsonl在后台写
                 if global_step % args.print_per_step == 0:
-                    print('epoch: {:d}, global_step: {:d}, lr: {:g}, nll_loss: {:.2f}, kld_loss: {:.2f},'
-                          ' kld_weight: {:g}, ppl: {:.2f}, time: {:.2f}s/step'
-                          .format(epoch, global_step, optim.lr, nll_loss.mean().item(), kld_loss.mean().item(),
-                                  kld_weight, ppl.mean().exp().item(), use_time))
-                    summary_writer.add_scalar('train_nll', nll_loss.mean().item(), global_step)
-                    summary_writer.add_scalar('train_kld', kld_loss.mean().item(), global_step)
-                    summary_writer.add_scalar('train_weight', kld_weight, global_step)
-                    summary_writer.add_scalar('train_ppl', ppl.mean().exp().item(), global_step)
-                    summary_writer.flush()  # 将缓冲区写入文件
+                    record = metrics.log(global_step, epoch=epoch, lr=optim.lr)
+                    timer.log(summary_writer, global_step)  # 各阶段平均耗时，打开--profile时才有
+                    if is_main_process():
+                        print('epoch: {:d}, global_step: {:d}, lr: {:g}, nll_loss: {:.2f}, kld_loss: {:.2f},'
+                              ' kld_weight: {:g}, ppl: {:.2f}, {:.0f} tokens/s, {:.1f} examples/s, time: {:.2f}s/step'
+                              .format(epoch, global_step, optim.lr, record['nll'], record['kld'], record['weight'],
+                                      record['ppl'], record['tokens_per_sec'], record['examples_per_sec'],
+                                      record['time_per_step']))
 
                 if global_step % args.log_per_step == 0 \
                         or (global_step % (2*config.kl_step) - config.kl_step) == config.kl_step // 2:
 
-                    # 验证集上计算困惑度
-                    model.eval()
-                    nll_loss, kld_loss, ppl = valid(model, dp_valid, global_step-1)
-                    model.train()
-                    print('在验证集上的NLL损失为: {:g}, KL损失为: {:g}, PPL为: {:g}'
-                          .format(nll_loss, kld_loss, np.exp(ppl)))
-                    summary_writer.add_scalar('valid_nll', nll_loss, global_step)
-                    summary_writer.add_scalar('valid_kld', kld_loss, global_step)
-                    summary_writer.add_scalar('valid_ppl', np.exp(ppl), global_step)
-                    summary_writer.flush()  # 将缓冲区写入文件
+                    # 验证集上计算困惑度，后台验证时拷贝完参数就继续训练
+                    if validator is not None:
+                        validator.submit(model, global_step, quick=args.quick_valid > 0)
+                if validator is not None:
+                    log_valid(summary_writer, validator.poll())  # 后台验证完的结果按提交时的global_step记录
 
+            optim.discard()  # micro-batch数不是accumulation_steps的倍数时，最后不满一次更新的梯度丢掉
             epoch += 1  # 数据集迭代次数+1
-            if epoch % 10 == 0:
+            if epoch % 10 == 0 and is_main_process():
                 log_file = os.path.join(log_dir, '{:03d}{:012d}.model'.format(epoch, global_step))
-                model.save_model(epoch, global_step, log_file)
+                checkpoint_writer.save(model, epoch, global_step, log_file)  # 拷贝完参数就继续训练
             optim.update_lr(epoch)  # 调整学习率
+            if args.profile and is_main_process():
+                print(timer.summary())
 
             # 保存模型
 
             # 验证集上计算困惑度
-            model.eval()
-            nll_loss, kld_loss, ppl = valid(model, dp_valid, global_step-1)
-            print('在验证集上的NLL损失为: {:g}, KL损失为: {:g}, PPL为: {:g}'
-                  .format(nll_loss, kld_loss, np.exp(ppl)))
-            summary_writer.add_scalar('valid_nll', nll_loss, global_step)
-            summary_writer.add_scalar('valid_kld', kld_loss, global_step)
-            summary_writer.add_scalar('valid_ppl', np.exp(ppl), global_step)
-            summary_writer.flush()  # 将缓冲区写入文件
-
-        summary_writer.close()
-        log_file = os.path.join(log_dir, '{:03d}{:012d}.model'.format(epoch, global_step))
-        model.save_model(epoch, global_step, log_file)
+            if validator is not None:
+                validator.submit(model, global_step)
+                log_valid(summary_writer, validator.poll())
+            if is_main_process() and model.state_cache is not None:
+                print(model.state_cache.report())
+
+        if validator is not None:
+            log_valid(summary_writer, validator.close())  # 等后台验证完，结果写进tensorboard
+        metrics.close()
+        timer.close()
+        if is_main_process():
+            summary_writer.close()
+            log_file = os.path.join(log_dir, '{:03d}{:012d}.model'.format(epoch, global_step))
+            checkpoint_writer.save(model, epoch, global_step, log_file)
+        checkpoint_writer.close()  # 等所有模型文件写完再退出
     else:  # 测试
         if not os.path.exists(args.result_path):  # 创建结果文件夹
             os.makedirs(args.result_path)
@@ -187,54 +312,75 @@ def main():
         dp_test = DataProcessor(testset, config.batch_size, sentence_processor, global_keywords, shuffle=False)
 
         model.eval()  # 切换到测试模式，会停用dropout等等
-        # nll_loss, kld_loss, ppl = valid(model, dp_test, global_step-1)  # 评估困惑度
+        # nll_loss, kld_loss, ppl, _ = valid(model, dp_test, global_step-1)  # 评估困惑度
         # print('在测试集上的NLL损失为: {:g}, KL损失为: {:g}, PPL为: {:g}'
         #       .format(nll_loss, kld_loss, np.exp(ppl)))
 
         len_results = []  # 统计生成结果的总长度
-        for data in dp_test.get_batch_data():
-            posts = data['str_posts']
-            responses = data['str_responses']
-            feed_data = prepare_feed_data(data, inference=True)
-            results = test(model, feed_data)  # 使用模型计算结果 [batch, len_decoder]
-
-            for idx, result in enumerate(results):
+        if args.incremental:  # 按对话逐轮生成，每轮只编码最新的post
+            session = DialogueSession(model, word2vec, sentence_processor, config, max_len=args.max_len, gpu=args.gpu)
+            for idx, item in enumerate(testset):
+                if idx > 0 and item['post'] != testset[idx - 1]['response']:  # 和上一轮接不上，是新的对话
+                    session.reset()
                 new_data = dict()
-                new_data['post'] = posts[idx]
-                new_data['response'] = responses[idx]
-                new_data['result'] = sentence_processor.index2word(result)  # 将输出的句子转回单词的形式
+                new_data['post'] = item['post']
+                new_data['response'] = item['response']
+                new_data['result'] = session.step(item['post'], item['KeyWord'], item['response_label_act'])
                 len_results.append(len(new_data['result']))
                 fw.write(json.dumps(new_data, ensure_ascii=False) + '\n')
+        else:
+            for data in timer.iterate(dp_test.get_batch_data(), 'get_batch_data'):
+                posts = data['str_posts']
+                responses = data['str_responses']
+                with timer.region('prepare_feed_data'):
+                    feed_data = prepare_feed_data(data, inference=True)
+                with timer.region('generate'):
+                    results = test(model, feed_data)  # 使用模型计算结果 [batch, len_decoder]
+                timer.step()
+
+                for idx, result in enumerate(results):
+                    new_data = dict()
+                    new_data['post'] = posts[idx]
+                    new_data['response'] = responses[idx]
+                    new_data['result'] = sentence_processor.index2word(result)  # 将输出的句子转回单词的形式
+                    len_results.append(len(new_data['result']))
+                    fw.write(json.dumps(new_data, ensure_ascii=False) + '\n')
 
         fw.close()
         print(f'生成句子平均长度: {1.0 * sum(len_results) / len(len_results)}')
+        if args.profile:
+            print(timer.summary())
+            timer.close()
+        if model.state_cache is not None:
+            print(model.state_cache.report())
 
 
-def prepare_feed_data(data, inference=False):
+def prepare_feed_data(data, inference=False,
+                      gpu=None):  # 是否转移到gpu上，None时按args.gpu
     len_labels = torch.tensor([l - 1 for l in data['len_responses']]).long()  # [batch] 标签没有start_id，长度-1
     masks = (1 - F.one_hot(len_labels, len_labels.max() + 1).cumsum(1))[:, :-1]  # [batch, len_decoder]
     batch_size = masks.size(0)
 
     if not inference:  # 训练时的输入
         feed_data = {'posts': torch.tensor(data['posts']).long(),  # [batch, len_encoder]
-                     'len_posts': torch.tensor(data['len_posts']).long(),  # [batch]
+                     'len_posts': PackInfo.from_lengths(data['len_posts']),  # [batch]
                      'responses': torch.tensor(data['responses']).long(),  # [batch, len_decoder]
-                     'len_responses': torch.tensor(data['len_responses']).long(),  # [batch]
+                     'len_responses': PackInfo.from_lengths(data['len_responses']),  # [batch]
                      'sampled_latents': torch.randn((batch_size, config.latent_size)),  # [batch, latent_size]
                      'masks': masks.float(),# [batch, len_decoder]
                      'keywords': torch.tensor(data['keywords']),
                      'topic': torch.tensor(data['responses_act']),
-                     'len_keywords': torch.tensor(data['len_keywords'])
+                     'len_keywords': PackInfo.from_lengths(data['len_keywords'])
                      }
     else:  # 测试时的输入
         feed_data = {'posts': torch.tensor(data['posts']).long(),
-                     'len_posts': torch.tensor(data['len_posts']).long(),
+                     'len_posts': PackInfo.from_lengths(data['len_posts']),
                      'keywords': torch.tensor(data['keywords']),
-                     'len_keywords': torch.tensor(data['len_keywords']),
+                     'len_keywords': PackInfo.from_lengths(data['len_keywords']),
                      'topic': torch.tensor(data['responses_act']),
                      'sampled_latents': torch.randn((batch_size, config.latent_size))}
 
-    if args.gpu:  # 将数据转移到gpu上
+    if args.gpu if gpu is None else gpu:  # 将数据转移到gpu上
         for key, value in feed_data.items():
             feed_data[key] = value.cuda()
 
@@ -281,35 +427,87 @@ def compute_loss(outputs, labels, masks, global_step):
 
 
 def train(model, feed_data, global_step):
-    output_vocab, _mu, _logvar, mu, logvar, Loss = model(feed_data, word2vec, gpu=args.gpu)  # 前向传播
-    outputs = (output_vocab, _mu, _logvar, mu, logvar)
+    with amp.autocast(), timer.region('forward'):  # 只有前向在低精度下计算
+        output_vocab, _mu, _logvar, mu, logvar, Loss = model(feed_data, word2vec, gpu=args.gpu)  # 前向传播
+    # 损失和kl在float32下计算
+    outputs = (output_vocab.float(), _mu.float(), _logvar.float(), mu.float(), logvar.float())
     labels = feed_data['responses'][:, 1:]  # 去掉start_id
     masks = feed_data['masks']
-    loss, nll_loss, kld_loss, ppl, kld_weight = compute_loss(outputs, labels, masks, global_step)  # 计算损失
+    with timer.region('loss'):
+        loss, nll_loss, kld_loss, ppl, kld_weight = compute_loss(outputs, labels, masks, global_step)  # 计算损失
     # loss +=Loss
     return loss, nll_loss, kld_loss, ppl, kld_weight
 
 
-def valid(model, data_processor, global_step):
-    nll_losses, kld_losses, ppls = [], [], []
-    for data in data_processor.get_batch_data():
-        feed_data = prepare_feed_data(data)
-        output_vocab, _mu, _logvar, mu, logvar, Loss = model(feed_data, word2vec, gpu=args.gpu)
+def auto_batch_size(model, trainset, sentence_processor, global_keywords, world_size):
+    r""" 用训练集里post最长的样本，回复重复到不同长度，测一次前向+反向的峰值内存，拟合后返回预算内最大的安全batch，
+    多进程时取各进程的最小值 """
+    example = max(trainset, key=lambda item: (len(item['post']), len(item['response'])))
+    words = example['response'] or [sentence_processor.vocab[config.unk_id]]
+    max_len = args.auto_batch_len or max(len(item['response']) for item in trainset)
+
+    def step(batch_size, seq_len):
+        item = dict(example, response=(words * seq_len)[:seq_len])
+        data = next(DataProcessor([item] * batch_size, batch_size, sentence_processor, global_keywords,
+                                  shuffle=False).get_batch_data())
+        loss = train(model, prepare_feed_data(data), 0)[0]
+        amp.backward(loss.mean())
+        model.zero_grad(set_to_none=True)
+
+    model.train()
+    with torch.random.fork_rng(devices=[torch.cuda.current_device()] if args.gpu else []):  # 不影响训练用的随机数
+        records = profile_memory(step, [1, 2, 4, 8], sorted({max(max_len // 2, 1), max_len}), args.gpu)
+    fit = fit_memory(records)
+    budget_mb = args.memory_budget or available_memory_mb(args.gpu)
+    if not args.gpu:
+        budget_mb /= world_size  # 同一台机器上的进程共用内存
+    reserved_mb = optimizer_state_mb(model.parameters(), config.method)
+    batch_size = recommend_batch_size(fit, budget_mb, max_len, args.memory_safety, reserved_mb)
+    batch_size = max(int(all_reduce_min([batch_size])[0]), 1)
+    if is_main_process():
+        print(memory_table(records, fit))
+        print('{}预算{:.0f}MB(用{:.0%})、回复长度{}时最大的安全batch为{}，预计占用{:.1f}MB'
+              .format('显存' if args.gpu else '内存', budget_mb, args.memory_safety, max_len, batch_size,
+                      predict_memory(fit, batch_size, max_len) + reserved_mb))
+    return batch_size
 
-        outputs = (output_vocab, _mu, _logvar, mu, logvar)
-        labels = feed_data['responses'][:, 1:]  # 去掉start_id
-        masks = feed_data['masks']
 
-        _, nll_loss, kld_loss, ppl, kld_weight = compute_loss(outputs, labels, masks, global_step)
-        nll_losses.extend(nll_loss.detach().tolist())
-        kld_losses.extend(kld_loss.detach().tolist())
-        ppls.extend(ppl.detach().tolist())
+def valid(model, data_processor, global_step):
+    r""" 返回每个样本平均的NLL损失、乘了kl权重的KL损失，以及按样本平均和按token加权的log困惑度 """
+    kld_weight = min(1.0 * (global_step % (2*config.kl_step)) / config.kl_step, 1)  # 同compute_loss里的周期性退火
+    feed_batches = (prepare_feed_data(data) for data in data_processor.get_batch_data())
+    with timer.region('valid'):
+        result = evaluate_perplexity(model, word2vec, feed_batches, kld_weight, gpu=args.gpu)  # 多进程时合并所有进程的样本
+    return result['nll'], result['kld'], result['log_ppl'], result['log_token_ppl']
 
-    nll_losses = np.array(nll_losses)
-    kld_losses = np.array(kld_losses) * kld_weight
-    ppls = np.array(ppls)
 
-    return nll_losses.mean(), kld_losses.mean(), ppls.mean()
+def log_valid(summary_writer, results):
+    r""" 打印验证结果并按提交验证时的global_step写入tensorboard，抽样验证的结果记为valid_quick_* """
+    if not is_main_process() or not results:
+        return
+    for global_step, quick, (nll_loss, kld_loss, ppl, token_ppl) in results:
+        prefix = 'valid_quick' if quick else 'valid'
+        print('global_step: {:d}, 在{}验证集上的NLL损失为: {:g}, KL损失为: {:g}, PPL为: {:g}, 按token的PPL为: {:g}'
+              .format(global_step, '抽样的' if quick else '', nll_loss, kld_loss, np.exp(ppl), np.exp(token_ppl)))
+        summary_writer.add_scalar(prefix + '_nll', nll_loss, global_step)
+        summary_writer.add_scalar(prefix + '_kld', kld_loss, global_step)
+        summary_writer.add_scalar(prefix + '_ppl', np.exp(ppl), global_step)
+        summary_writer.add_scalar(prefix + '_token_ppl', np.exp(token_ppl), global_step)
+    summary_writer.flush()  # 将缓冲区写入文件
+
+
+def evaluate(model, data_processor, sentence_processor):
+    r""" 验证集上的NLL、生成回复的distinct-1/2和总耗时，用于比较量化前后的模型 """
+    torch.manual_seed(args.seed)  # 两个模型用同样的隐变量采样
+    start_time = time.time()
+    with torch.no_grad():
+        nll_loss, kld_loss, ppl, _ = valid(model, data_processor, 0)
+        results = []
+        for data in data_processor.get_batch_data():
+            feed_data = prepare_feed_data(data, inference=True)
+            results.extend(sentence_processor.index2word(result) for result in test(model, feed_data))
+    return {'nll': nll_loss, 'ppl': np.exp(ppl), 'time': time.time() - start_time,
+            'distinct_1': distinct_n_corpus_level(results, 1), 'distinct_2': distinct_n_corpus_level(results, 2)}
 
 
 def test(model, feed_data):
@@ -326,4 +524,4 @@ def pre_train(model,feed_data):
 
 
 if __name__ == '__main__':
-    main()
+    launch(main, 1 if args.inference else args.num_processes)
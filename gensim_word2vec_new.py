@@ -47,7 +47,7 @@ class Word2Vec_emb():
             emb_y = []
         embedding_ = torch.stack(emb_x, dim=0)
         embedding_.requires_grad = True
-        return embedding_.cuda()
+        return embedding_.to(batch_data.device)  # 和输入的id在同一设备上，cpu推理时不需要gpu
 
 
 
@@ -1,6 +1,7 @@
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from model.util.packing import PackInfo
 
 class Attn(torch.nn.Module):
     def __init__(self, method, hidden_size):
@@ -26,9 +27,26 @@ class Attn(torch.nn.Module):
         energy = self.attn(torch.cat((hidden.expand(encoder_output.size(0), -1, -1), encoder_output), 2)).tanh()
         return torch.sum(self.v * energy, dim=2)
 
+    def keys(self, encoder_outputs):  # [seq, batch, dim]
+        r""" 注意力里只和编码器输出有关的部分，每个序列算一次 """
+        if self.method == 'general':
+            return self.attn(encoder_outputs)
+        if self.method == 'concat':  # attn(cat(h, e)) = W_h h + (W_e e + b)
+            return F.linear(encoder_outputs, self.attn.weight[:, self.hidden_size:], self.attn.bias)
+        return encoder_outputs
+
+    def memory_score(self, hidden, memory):  # hidden: [1, batch, dim]
+        r""" 用预先算好的key打分，每步只有O(seq*dim) [seq, batch] """
+        if self.method == 'concat':
+            query = F.linear(hidden, self.attn.weight[:, :self.hidden_size])  # [1, batch, dim]
+            return torch.sum(self.v * torch.tanh(memory.keys + query), dim=2)
+        return torch.sum(hidden * memory.keys, dim=2)
+
     def forward(self, hidden, encoder_outputs):
         # 根据给定的方法计算注意力（能量）
-        if self.method == 'general':
+        if isinstance(encoder_outputs, AttentionMemory):
+            attn_energies = self.memory_score(hidden, encoder_outputs)
+        elif self.method == 'general':
             attn_energies = self.general_score(hidden, encoder_outputs)
         elif self.method == 'concat':
             attn_energies = self.concat_score(hidden, encoder_outputs)
@@ -41,6 +59,16 @@ class Attn(torch.nn.Module):
         # Return the softmax normalized probability scores (with added dimension)
         return F.softmax(attn_energies, dim=1).unsqueeze(1)
 
+
+class AttentionMemory(object):
+    r""" 解码前准备一次的注意力输入：编码器输出、投影好的key和padding位置的加性mask """
+    def __init__(self, outputs,  # 编码器输出 [seq, batch, dim]
+                 keys,  # Attn.keys(outputs) [seq, batch, dim]
+                 bias=None):  # padding位置为-inf，其余为0 [seq, batch]，None表示不mask
+        self.outputs = outputs
+        self.keys = keys
+        self.bias = bias
+
 class Decoder(nn.Module):
     r""" 解码器 """
     def __init__(self, cell_type,  # rnn类型
@@ -60,20 +88,39 @@ class Decoder(nn.Module):
         self.attn = Attn('concat', output_size)
         self.concat = nn.Linear(output_size * 2, output_size)
 
+    def prepare_memory(self, encoder_outputs,  # [seq, batch, dim]
+                       lengths=None):  # post长度 [batch] 或 PackInfo，None表示不mask
+        r""" 每个序列调用一次，返回值代替encoder_outputs传给每一步的forward """
+        bias = None
+        if lengths is not None:
+            if isinstance(lengths, PackInfo):
+                lengths = lengths.batch_lengths
+            positions = torch.arange(encoder_outputs.size(0), device=encoder_outputs.device).unsqueeze(1)
+            padding = positions >= lengths.to(encoder_outputs.device).unsqueeze(0)  # [seq, batch]
+            bias = encoder_outputs.new_zeros(padding.size()).masked_fill(padding, float('-inf'))
+        return AttentionMemory(encoder_outputs, self.attn.keys(encoder_outputs), bias)
+
     def forward(self, x,  # 输入 [seq, batch, dim] 或者单步输入 [1, batch, dim]
                 state, encoder_outputs=None):  # 初始状态 [layers*directions, batch, dim]
+        # encoder_outputs: prepare_memory的返回值，或者编码器输出 [seq, batch, dim](每步都重新投影，不mask)
         # output: [seq, batch, dim*directions] 每个时间步的输出
         # final_state: [layers*directions, batch, dim] 每一层的最终状态
         rnn_output, hidden = self.rnn_cell(x, state)
         # 从当前GRU输出计算注意力
-        if encoder_outputs == None:
+        if encoder_outputs is None:
             return rnn_output, hidden
-        attn_weights = self.attn(rnn_output, encoder_outputs)
-        b = torch.zeros(attn_weights.size())-2
-        attn_weights = attn_weights+b.cuda()
-        attn_weights = F.softmax(attn_weights, dim=2)
+        if not isinstance(encoder_outputs, AttentionMemory):
+            encoder_outputs = self.prepare_memory(encoder_outputs)
+        scores = self.attn.memory_score(rnn_output, encoder_outputs)  # [seq, batch]
+        if encoder_outputs.bias is not None:
+            scores = scores + encoder_outputs.bias
+        # 和训练好的模型保持一致：softmax后的权重再做一次softmax(原实现中间减的常数不影响结果)，padding位置两次都mask
+        attn_weights = F.softmax(scores, dim=0)
+        if encoder_outputs.bias is not None:
+            attn_weights = attn_weights + encoder_outputs.bias
+        attn_weights = F.softmax(attn_weights, dim=0).t().unsqueeze(1)  # [batch, 1, seq]
         # 将注意力权重乘以编码器输出以获得新的“加权和”上下文向量
-        context = attn_weights.bmm(encoder_outputs.transpose(0, 1))
+        context = attn_weights.bmm(encoder_outputs.outputs.transpose(0, 1))
         # 使用Luong的公式五连接加权上下文向量和GRU输出
         rnn_output = rnn_output.squeeze(0)
         context = context.squeeze(1)
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, PackedSequence
+from model.util.packing import PackInfo
 
 
 class Encoder(nn.Module):
@@ -28,13 +29,21 @@ class Encoder(nn.Module):
                                                bidirectional=bidirectional,
                                                dropout=dropout)
 
-    def forward(self, x,  # [seq, batch, dim]
-                length):  # [batch]
-        x = pack_padded_sequence(x, length, enforce_sorted=False)
+    def forward(self, x,  # [seq, batch, dim]，或已经pack好的PackedSequence
+                length=None,  # [batch]，或collate阶段算好的PackInfo
+                state=None):  # 初始状态，格式和返回的final_state相同 [layers, batch, dim]，None为全0
+        if isinstance(x, PackedSequence):  # 已经pack好(带着还原置换)，直接送入rnn
+            pass
+        elif isinstance(length, PackInfo):  # 已经排好序，长度也在cpu上，不再排序
+            x = length.pack(x)
+        else:
+            x = pack_padded_sequence(x, length, enforce_sorted=False)
 
         # output: [seq, batch, dim*directions] 每个时间步的输出
         # final_state = [layers*directions, batch, dim] 每一层的最终状态
-        output, final_state = self.rnn_cell(x)
+        if state is not None:
+            state = self.rnn_state(state)
+        output, final_state = self.rnn_cell(x, state)
         output = pad_packed_sequence(output)[0]
 
         if self.bidirectional:  # 如果是双向的，对双向进行拼接作为每层的最终状态
@@ -51,3 +60,13 @@ class Encoder(nn.Module):
         # output = [seq, batch, dim]
         # final_state = [layers, batch, dim]
         return output, final_state
+
+    def rnn_state(self, state):
+        r""" 把forward返回格式的状态[layers, batch, dim]转回rnn需要的[layers*directions, batch, dim/directions] """
+        if isinstance(state, tuple):
+            return tuple(self.rnn_state(s) for s in state)
+        if not self.bidirectional:
+            return state
+        state_forward, state_back = state.chunk(2, 2)  # [layers, batch, dim/2]
+        # rnn的状态按(第0层前向, 第0层后向, 第1层前向, ...)排列
+        return torch.stack([state_forward, state_back], 1).view(-1, state.size(1), state_forward.size(2))
@@ -8,13 +8,17 @@ class Optim(object):
                  lr,  # 学习率
                  lr_decay=1.0,  # 学习率衰减
                  weight_decay=0.0,  # 权值decay
-                 max_grad_norm=5):  # 梯度裁剪
+                 max_grad_norm=5,  # 梯度裁剪
+                 accumulation_steps=1):  # 累积多少个micro-batch的梯度更新一次参数
         assert method in ['sgd', 'adam']
+        assert accumulation_steps >= 1
         self.method = method
         self.lr = lr
         self.lr_decay = lr_decay
         self.weight_decay = weight_decay
         self.max_grad_norm = max_grad_norm
+        self.accumulation_steps = accumulation_steps
+        self.micro_steps = 0  # 上次更新参数之后累积了几个micro-batch
 
     def set_parameters(self, parameters):
         r""" 设置需要优化的参数 """
@@ -30,8 +34,28 @@ class Optim(object):
         for param in self.optimizer.param_groups:
             param['lr'] = self.lr
 
-    def step(self):
-        r""" 更新参数 """
-        if self.max_grad_norm:
-            nn.utils.clip_grad_norm_(self.params, self.max_grad_norm)
-        self.optimizer.step()
+    def step(self, scaler=None):  # 混合精度训练时的GradScaler
+        r""" 累积满accumulation_steps个micro-batch时裁剪梯度并更新参数，返回这次是否更新了参数 """
+        self.micro_steps += 1
+        if self.micro_steps < self.accumulation_steps:  # 梯度还在累积
+            return False
+        self.micro_steps = 0
+        if scaler is not None and scaler.is_enabled():
+            scaler.unscale_(self.optimizer)  # 先还原梯度的真实大小再裁剪
+            if self.max_grad_norm:
+                nn.utils.clip_grad_norm_(self.params, self.max_grad_norm)
+            scaler.step(self.optimizer)  # 梯度里有inf/nan时跳过这次更新
+            scaler.update()
+        else:
+            if self.max_grad_norm:
+                nn.utils.clip_grad_norm_(self.params, self.max_grad_norm)
+            self.optimizer.step()
+        return True
+
+    def discard(self):
+        r""" 丢掉还没累积够accumulation_steps个micro-batch的梯度，返回丢掉的micro-batch数。
+        每个epoch结束时调用，剩下的梯度不带到下一个epoch；多进程时这些micro-batch没有同步过梯度，不能直接更新 """
+        dropped = self.micro_steps
+        self.micro_steps = 0
+        self.optimizer.zero_grad()
+        return dropped
@@ -8,6 +8,7 @@ from model.PriorNet import PriorNet
 from model.RecognizeNet import RecognizeNet
 from model.Decoder import Decoder
 from model.PrepareState import PrepareState
+from model.util.gmm import gaussian_pdfs_log
 import torch.nn.functional as F
 
 
@@ -113,7 +114,7 @@ class Model(nn.Module):
                 pi = self.pi_
                 log_sigma2_c = self.log_sigma2_c
                 mu_c = self.mu_c
-                yita_c = torch.exp(torch.log(pi.unsqueeze(0)) + self.gaussian_pdfs_log(z, mu_c, log_sigma2_c))
+                yita_c = torch.log(pi.unsqueeze(0)) + self.gaussian_pdfs_log(z, mu_c, log_sigma2_c)  # argmax在log空间做，避免exp下溢
 
                 yita = yita_c.detach().cpu().numpy()
                 print(torch.log(pi.unsqueeze(0)))
@@ -172,7 +173,7 @@ class Model(nn.Module):
         pi = self.pi_
         log_sigma2_c = self.log_sigma2_c
         mu_c = self.mu_c
-        yita_c = torch.exp(torch.log(pi.unsqueeze(0))+self.gaussian_pdfs_log(z,mu_c,log_sigma2_c))
+        yita_c = torch.log(pi.unsqueeze(0))+self.gaussian_pdfs_log(z,mu_c,log_sigma2_c)  # argmax在log空间做，避免exp下溢
 
         yita=yita_c.detach().cpu().numpy()
         print(np.argmax(yita,axis=1))
@@ -217,10 +218,7 @@ class Model(nn.Module):
         return epoch, global_step
 
     def gaussian_pdfs_log(self,x,mus,log_sigma2s):
-        G=[]
-        for c in range(self.config.nClusters):
-            G.append(self.gaussian_pdf_log(x,mus[c:c+1,:],log_sigma2s[c:c+1,:]).view(-1,1))
-        return torch.cat(G,1)
+        return gaussian_pdfs_log(x, mus, log_sigma2s)  # 所有簇一次广播计算
 
 
 
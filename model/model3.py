@@ -1,6 +1,5 @@
 import torch
 import torch.nn as nn
-from sklearn.mixture import GaussianMixture
 import numpy as np
 from model.Embedding import Embedding
 from model.Encoder import Encoder
@@ -8,6 +7,7 @@ from model.PriorNet import PriorNet
 from model.RecognizeNet import RecognizeNet
 from model.Decoder import Decoder
 from model.PrepareState import PrepareState
+from model.util.gmm import gaussian_pdfs_log, gmm_vae_loss, StreamingGMM
 import torch.nn.functional as F
 
 
@@ -122,51 +122,48 @@ class Model(nn.Module):
             output_vocab = self.projector(outputs)  # [batch, seq-1, num_vocab]
             return output_vocab, _mu, _logvar, mu, logvar
         elif ingau:
-            Z = []
-            Y = []
-            with torch.no_grad():
-                for data in inputs.get_batch_data():
-                    inputs2 = self.prepare_feed_data(data)
-                    id_posts = inputs2['posts']  # [batch, seq]
-                    len_posts = inputs2['len_posts']  # [batch]
-                    id_responses = inputs2['responses']  # [batch, seq]
-                    len_responses = inputs2['len_responses']  # [batch, seq]
-                    sampled_latents = inputs2['sampled_latents']  # [batch, latent_size]
-                    id_responses_act = inputs2['responses_act']
-                    len_decoder = id_responses.size(1) - 1
-
-                    embed_posts = self.embedding(id_posts)  # [batch, seq, embed_size]
-                    embed_responses = self.embedding(id_responses)  # [batch, seq, embed_size]
-                    # state: [layers, batch, dim]
-                    _, state_posts = self.post_encoder(embed_posts.transpose(0, 1), len_posts)
-                    _, state_responses = self.response_encoder(embed_responses.transpose(0, 1), len_responses)
-                    if isinstance(state_posts, tuple):
-                        state_posts = state_posts[0]
-                    if isinstance(state_responses, tuple):
-                        state_responses = state_responses[0]
-                    x = state_posts[-1, :, :]  # [batch, dim]
-                    y = state_responses[-1, :, :]  # [batch, dim]
-
-                    # p(z|x)
-                    _mu, _logvar = self.prior_net(x)  # [batch, latent]
-                    # p(z|x,y)
-                    mu, logvar = self.recognize_net(x, y)  # [batch, latent]
-                    # 重参数化
-                    z = mu + (0.5 * logvar).exp() * sampled_latents  # [batch, latent]
-                    Z.append(z)
-                    Y.append(id_responses_act)
-
-            Z = torch.cat(Z, 0).detach().cpu().numpy()
+            # 流式小批量EM初始化GMM：逐batch更新充分统计量，不再把所有z拼起来交给sklearn
+            gmm = StreamingGMM(self.config.nClusters, self.config.latent_size)
+            for _ in range(self.config.gmm_em_passes):  # 多遍遍历数据细化参数，聚类精度用最后一遍统计
+                pre = []
+                Y = []
+                with torch.no_grad():
+                    for data in inputs.get_batch_data():
+                        inputs2 = self.prepare_feed_data(data)
+                        id_posts = inputs2['posts']  # [batch, seq]
+                        len_posts = inputs2['len_posts']  # [batch]
+                        id_responses = inputs2['responses']  # [batch, seq]
+                        len_responses = inputs2['len_responses']  # [batch, seq]
+                        sampled_latents = inputs2['sampled_latents']  # [batch, latent_size]
+                        id_responses_act = inputs2['responses_act']
+                        len_decoder = id_responses.size(1) - 1
+
+                        embed_posts = self.embedding(id_posts)  # [batch, seq, embed_size]
+                        embed_responses = self.embedding(id_responses)  # [batch, seq, embed_size]
+                        # state: [layers, batch, dim]
+                        _, state_posts = self.post_encoder(embed_posts.transpose(0, 1), len_posts)
+                        _, state_responses = self.response_encoder(embed_responses.transpose(0, 1), len_responses)
+                        if isinstance(state_posts, tuple):
+                            state_posts = state_posts[0]
+                        if isinstance(state_responses, tuple):
+                            state_responses = state_responses[0]
+                        x = state_posts[-1, :, :]  # [batch, dim]
+                        y = state_responses[-1, :, :]  # [batch, dim]
+
+                        # p(z|x)
+                        _mu, _logvar = self.prior_net(x)  # [batch, latent]
+                        # p(z|x,y)
+                        mu, logvar = self.recognize_net(x, y)  # [batch, latent]
+                        # 重参数化
+                        z = mu + (0.5 * logvar).exp() * sampled_latents  # [batch, latent]
+                        pre.append(gmm.partial_fit(z))  # 在线EM更新一步
+                        Y.append(id_responses_act)
+
+            pre = torch.cat(pre, 0).cpu().numpy()
             Y = torch.cat(Y, 0).detach().cpu().numpy()
-
-            gmm = GaussianMixture(n_components=self.config.nClusters, covariance_type='diag')
-
-            pre = gmm.fit_predict(Z)
             print('Acc={:.4f}%'.format(cluster_acc(pre, Y)[0] * 100))
 
-            self.pi_.data = torch.from_numpy(gmm.weights_).cuda().float()
-            self.mu_c.data = torch.from_numpy(gmm.means_).cuda().float()
-            self.log_sigma2_c.data = torch.log(torch.from_numpy(gmm.covariances_).cuda().float())
+            gmm.assign(self.pi_, self.mu_c, self.log_sigma2_c)
 
             self.save_model(0, 0, './pretrain2.model')
         elif not inference:  # 训练
@@ -196,23 +193,8 @@ class Model(nn.Module):
             # 重参数化
             z = mu + (0.5 * logvar).exp() * sampled_latents  # [batch, latent]
 
-            pi = self.pi_
-            log_sigma2_c = self.log_sigma2_c
-            mu_c = self.mu_c
-            det = 1e-10
-
-            yita_c = torch.exp(torch.log(pi.unsqueeze(0)) + self.gaussian_pdfs_log(z, mu_c, log_sigma2_c)) + det
-
-            yita_c = yita_c / (yita_c.sum(1).view(-1, 1))  # batch_size*Clusters
-
-            Loss = 0.5 * torch.mean(torch.sum(yita_c * torch.sum(log_sigma2_c.unsqueeze(0) +
-                                                                 torch.exp(logvar.unsqueeze(
-                                                                     1) - log_sigma2_c.unsqueeze(0)) +
-                                                                 (mu.unsqueeze(1) - mu_c.unsqueeze(0)).pow(
-                                                                     2) / torch.exp(log_sigma2_c.unsqueeze(0)), 2), 1))
-            # 第二项
-            Loss -= torch.mean(torch.sum(yita_c * torch.log(pi.unsqueeze(0) / (yita_c)), 1)) + 0.5 * torch.mean(
-                torch.sum(1 + logvar, 1))
+            # GMM先验的ELBO项，q(c|z)在log空间归一化
+            Loss, yita_c = gmm_vae_loss(z, mu, logvar, self.pi_, self.mu_c, self.log_sigma2_c)
             # torch.mean(torch.sum(yita_c*torch.log(pi.unsqueeze(0)/(yita_c)),1))第三个
             # 0.5*torch.mean(torch.sum(1+z_sigma2_log,1))第四个
 
@@ -330,7 +312,7 @@ class Model(nn.Module):
         pi = self.pi_
         log_sigma2_c = self.log_sigma2_c
         mu_c = self.mu_c
-        yita_c = torch.exp(torch.log(pi.unsqueeze(0))+self.gaussian_pdfs_log(z,mu_c,log_sigma2_c))
+        yita_c = torch.log(pi.unsqueeze(0))+self.gaussian_pdfs_log(z,mu_c,log_sigma2_c)  # argmax在log空间做，避免exp下溢
 
         yita=yita_c.detach().cpu().numpy()
         return np.argmax(yita,axis=1)
@@ -374,10 +356,7 @@ class Model(nn.Module):
         return epoch, global_step
 
     def gaussian_pdfs_log(self,x,mus,log_sigma2s):
-        G=[]
-        for c in range(self.config.nClusters):
-            G.append(self.gaussian_pdf_log(x,mus[c:c+1,:],log_sigma2s[c:c+1,:]).view(-1,1))
-        return torch.cat(G,1)
+        return gaussian_pdfs_log(x, mus, log_sigma2s)  # 所有簇一次广播计算
 
 
 
@@ -88,6 +88,7 @@ class Model(nn.Module):
             embed_category = word2vec.embedding(id_category)
             # state: [layers, batch, dim]
             encoder_output, state_posts = self.post_encoder(embed_posts.transpose(0, 1), len_posts)
+            memory = self.decoder.prepare_memory(encoder_output, len_posts)  # 注意力的key和padding的mask，每个序列只算一次
             keywords_output, state_keywords = self.keyword_encoder(embed_keywords.transpose(0, 1), len_keywords)
             category_output, state_category = self.category_encoder(embed_category.transpose(0, 1), len_category)
             if isinstance(state_posts, tuple):
@@ -115,7 +116,7 @@ class Model(nn.Module):
                 decoder_input = decoder_inputs[idx]  # 当前时间步输入 [1, batch, embed_size]
                 # output: [1, batch, dim_out]
                 # state: [num_layer, batch, dim_out]
-                output, state = self.decoder(decoder_input, state, encoder_output)
+                output, state = self.decoder(decoder_input, state, memory)
                 outputs.append(output)
 
             outputs = torch.cat(outputs, 0).transpose(0, 1)  # [batch, seq-1, dim_out]
@@ -139,6 +140,7 @@ class Model(nn.Module):
             embed_category = word2vec.embedding(id_category)
             # state: [layers, batch, dim]
             encoder_output, state_posts = self.post_encoder(embed_posts.transpose(0, 1), len_posts)
+            memory = self.decoder.prepare_memory(encoder_output, len_posts)  # 注意力的key和padding的mask，每个序列只算一次
             keywords_output, state_keywords = self.keyword_encoder(embed_keywords.transpose(0, 1), len_keywords)
             category_output, state_category = self.category_encoder(embed_category.transpose(0, 1), len_category)
             if isinstance(state_posts, tuple):
@@ -169,7 +171,7 @@ class Model(nn.Module):
                     decoder_input = word2vec.embedding(next_input_id)  # [1, batch, embed_size]
                 # output: [1, batch, dim_out]
                 # state: [num_layers, batch, dim_out]
-                output, state = self.decoder(decoder_input, state ,encoder_output)
+                output, state = self.decoder(decoder_input, state, memory)
                 outputs.append(output)
 
                 vocab_prob = self.projector(output)  # [1, batch, num_vocab]
@@ -8,6 +8,9 @@ from model.PriorNetTopicControl import PriorNet
 from model.RecognizeNetTopicControl import RecognizeNet
 from model.Decoder import Decoder
 from model.PrepareState import PrepareState
+from model.util.gmm import gaussian_pdfs_log
+from model.util.checkpoint import save_checkpoint, load_checkpoint
+from model.util.profiling import timer
 import torch.nn.functional as F
 
 class Attn(torch.nn.Module):
@@ -53,6 +56,7 @@ class Model(nn.Module):
     def __init__(self, config):
         super(Model, self).__init__()
         self.config = config
+        self.state_cache = None  # 测试时编码器最终状态的缓存，见model.util.state_cache
 
         # 定义嵌入层
         self.embedding = Embedding(config.num_vocab,  # 词汇表大小
@@ -136,7 +140,16 @@ class Model(nn.Module):
         self.mu1 = None
         self.sigma1 = None
 
-    def forward(self, inputs, word2vec, inference=False, inpre=False, ingau=False, max_len=60, gpu=True):
+    def encode_state(self, encoder, ids, length, embed,
+                     state=None):  # 编码器的初始状态，例如多轮对话里上一轮延续下来的，None时从0开始
+        r""" 编码器的最终状态，测试模式下设置了state_cache时按token id序列复用已经编码过的句子，给了初始状态时不用缓存 """
+        if state is None and self.state_cache is not None and not self.training:
+            return self.state_cache.encode(encoder, ids, length, embed)
+        _, state = encoder(embed.transpose(0, 1), length, state)
+        return state
+
+    def forward(self, inputs, word2vec, inference=False, inpre=False, ingau=False, max_len=60, gpu=True,
+                state_posts=None):  # 测试时已经编码好的post最终状态，None时在forward里编码
         if not inference:  # 训练
             id_posts = inputs['posts']  # [batch, seq]
             len_posts = inputs['len_posts']  # [batch]
@@ -149,80 +162,86 @@ class Model(nn.Module):
 
             len_decoder = id_responses.size(1) - 1
 
-            embed_posts = word2vec.embedding(id_posts)  # [batch, seq, embed_size]
-            embed_responses = word2vec.embedding(id_responses)  # [batch, seq, embed_size]
-            embed_keywords = word2vec.embedding(id_keywords)  # [batch, seq, embed_size]
-            embed_topic = word2vec.embedding(id_topic)  # [batch, 1, embed_size]
+            with timer.region('embedding'):
+                embed_posts = word2vec.embedding(id_posts)  # [batch, seq, embed_size]
+                embed_responses = word2vec.embedding(id_responses)  # [batch, seq, embed_size]
+                embed_keywords = word2vec.embedding(id_keywords)  # [batch, seq, embed_size]
+                embed_topic = word2vec.embedding(id_topic)  # [batch, 1, embed_size]
 
-            # keyword attention  [batch,seq,embed_size]
-            a_i_j_one = []
-            for i in range(0, id_keywords.size()[1]):
-                a_i_j_one.append(
-                    self.linear_one(embed_keywords[:, i, :].unsqueeze(dim=1).repeat(1, id_keywords.size()[1], 1),
-                                    embed_keywords)) # seq 1 batch
-            a_i_j_one = torch.stack(a_i_j_one,dim=1).squeeze(dim=2).transpose(0, 2) #batch seq seq
-            ri = a_i_j_one.bmm(embed_keywords) # [batch, seq, embed_size]
+            with timer.region('keyword_attention'):
+                # keyword attention  [batch,seq,embed_size]
+                a_i_j_one = []
+                for i in range(0, id_keywords.size()[1]):
+                    a_i_j_one.append(
+                        self.linear_one(embed_keywords[:, i, :].unsqueeze(dim=1).repeat(1, id_keywords.size()[1], 1),
+                                        embed_keywords)) # seq 1 batch
+                a_i_j_one = torch.stack(a_i_j_one,dim=1).squeeze(dim=2).transpose(0, 2) #batch seq seq
+                ri = a_i_j_one.bmm(embed_keywords) # [batch, seq, embed_size]
 
-            a_i_j_two = []
-            for i in range(0, embed_topic.size()[1]):
-                a_i_j_two.append(
-                    self.linear_two(embed_topic[:, i, :].unsqueeze(dim=1).repeat(1, ri.size()[1], 1),
-                                    ri)) # seq 1 batch
+                a_i_j_two = []
+                for i in range(0, embed_topic.size()[1]):
+                    a_i_j_two.append(
+                        self.linear_two(embed_topic[:, i, :].unsqueeze(dim=1).repeat(1, ri.size()[1], 1),
+                                        ri)) # seq 1 batch
 
-            a_i_j_two = torch.stack(a_i_j_two, dim=1).squeeze(dim=2).transpose(0, 2).transpose(1,2)  # batch 1 seq
-            ti = a_i_j_two.bmm(embed_topic)  # [batch, seq, embed_size]
-            ui = torch.cat((ti, embed_topic.repeat(1, ti.size()[1],1)), dim=2)
+                a_i_j_two = torch.stack(a_i_j_two, dim=1).squeeze(dim=2).transpose(0, 2).transpose(1,2)  # batch 1 seq
+                ti = a_i_j_two.bmm(embed_topic)  # [batch, seq, embed_size]
+                ui = torch.cat((ti, embed_topic.repeat(1, ti.size()[1],1)), dim=2)
 
 
 
             # keyword attention with topic attention
             # topic encoder
             # state: [layers, batch, dim]
-            _, state_posts = self.post_encoder(embed_posts.transpose(0, 1), len_posts)
-            _, state_responses = self.response_encoder(embed_responses.transpose(0, 1), len_responses)
-            _, state_keywords = self.topic_encoder(ui.transpose(0, 1), len_keywords)
-            if isinstance(state_posts, tuple):
-                state_posts = state_posts[0]
-            if isinstance(state_responses, tuple):
-                state_responses = state_responses[0]
-            if isinstance(state_keywords, tuple):
-                state_keywords = state_keywords[0]
-            x = state_posts[-1, :, :]  # [batch, dim]
-            y = state_responses[-1, :, :]  # [batch, dim]
-            t = state_keywords[-1, :, :]
-            control = embed_topic.squeeze(dim=1)
-            control = self.topic_linear(control)  # [batch, dim]
-            x = torch.cat([x, control], 1) # [batch, dim*2]
-            x = self.control_post_linear(x) # [batch, dim]
-
-
-            # p(z|x)
-            _mu, _logvar = self.prior_net(x, t)  # [batch, latent]
-
-            # p(z|x,y)
-            mu, logvar = self.recognize_net(x, y, t)  # [batch, latent]
-            self.mu1 = mu
-            self.sigma1 = logvar
-            # 重参数化
-            z = mu + (0.5 * logvar).exp() * sampled_latents  # [batch, latent]
-
-            # 解码器的输入为回复去掉end_id
-            decoder_inputs = embed_responses[:, :-1, :].transpose(0, 1)  # [seq-1, batch, embed_size]
-            decoder_inputs = decoder_inputs.split([1] * len_decoder, 0)  # 解码器每一步的输入 seq-1个[1, batch, embed_size]
-            first_state = self.prepare_state(torch.cat([z, x], 1))  # [num_layer, batch, dim_out]
-
-            outputs = []
-            for idx in range(len_decoder):
-                if idx == 0:
-                    state = first_state  # 解码器初始状态
-                decoder_input = decoder_inputs[idx]  # 当前时间步输入 [1, batch, embed_size]
-                # output: [1, batch, dim_out]
-                # state: [num_layer, batch, dim_out]
-                output, state = self.decoder(decoder_input, state)
-                outputs.append(output)
-
-            outputs = torch.cat(outputs, 0).transpose(0, 1)  # [batch, seq-1, dim_out]
-            output_vocab = self.projector(outputs)  # [batch, seq-1, num_vocab]
+            with timer.region('encoder'):
+                state_posts = self.encode_state(self.post_encoder, id_posts, len_posts, embed_posts)
+                state_responses = self.encode_state(self.response_encoder, id_responses, len_responses, embed_responses)
+                _, state_keywords = self.topic_encoder(ui.transpose(0, 1), len_keywords)
+                if isinstance(state_posts, tuple):
+                    state_posts = state_posts[0]
+                if isinstance(state_responses, tuple):
+                    state_responses = state_responses[0]
+                if isinstance(state_keywords, tuple):
+                    state_keywords = state_keywords[0]
+                x = state_posts[-1, :, :]  # [batch, dim]
+                y = state_responses[-1, :, :]  # [batch, dim]
+                t = state_keywords[-1, :, :]
+                control = embed_topic.squeeze(dim=1)
+                control = self.topic_linear(control)  # [batch, dim]
+                x = torch.cat([x, control], 1) # [batch, dim*2]
+                x = self.control_post_linear(x) # [batch, dim]
+
+
+            with timer.region('latent'):
+                # p(z|x)
+                _mu, _logvar = self.prior_net(x, t)  # [batch, latent]
+
+                # p(z|x,y)
+                mu, logvar = self.recognize_net(x, y, t)  # [batch, latent]
+                self.mu1 = mu
+                self.sigma1 = logvar
+                # 重参数化
+                z = mu + (0.5 * logvar).exp() * sampled_latents  # [batch, latent]
+
+            with timer.region('decoder'):
+                # 解码器的输入为回复去掉end_id
+                decoder_inputs = embed_responses[:, :-1, :].transpose(0, 1)  # [seq-1, batch, embed_size]
+                decoder_inputs = decoder_inputs.split([1] * len_decoder, 0)  # 解码器每一步的输入 seq-1个[1, batch, embed_size]
+                first_state = self.prepare_state(torch.cat([z, x], 1))  # [num_layer, batch, dim_out]
+
+                outputs = []
+                for idx in range(len_decoder):
+                    if idx == 0:
+                        state = first_state  # 解码器初始状态
+                    decoder_input = decoder_inputs[idx]  # 当前时间步输入 [1, batch, embed_size]
+                    # output: [1, batch, dim_out]
+                    # state: [num_layer, batch, dim_out]
+                    output, state = self.decoder(decoder_input, state)
+                    outputs.append(output)
+
+                outputs = torch.cat(outputs, 0).transpose(0, 1)  # [batch, seq-1, dim_out]
+            with timer.region('projector'):
+                output_vocab = self.projector(outputs)  # [batch, seq-1, num_vocab]
 
 
             return output_vocab, _mu, _logvar, mu, logvar, None
@@ -235,79 +254,86 @@ class Model(nn.Module):
             id_topic = inputs['topic']  # [batch, 1]
             batch_size = id_posts.size(0)
 
-            embed_posts = word2vec.embedding(id_posts)  # [batch, seq, embed_size]
-            embed_keywords = word2vec.embedding(id_keywords)  # [batch, seq, embed_size]
-            embed_topic = word2vec.embedding(id_topic)  # [batch, 1, embed_size]
-
-            # keyword attention  [batch,seq,embed_size]
-            a_i_j_one = []
-            for i in range(0, id_keywords.size()[1]):
-                a_i_j_one.append(
-                    self.linear_one(embed_keywords[:, i, :].unsqueeze(dim=1).repeat(1, id_keywords.size()[1], 1),
-                                    embed_keywords))  # seq 1 batch
-            a_i_j_one = torch.stack(a_i_j_one, dim=1).squeeze(dim=2).transpose(0, 2)  # batch seq seq
-            ri = a_i_j_one.bmm(embed_keywords)  # [batch, seq, embed_size]
-
-            a_i_j_two = []
-            for i in range(0, embed_topic.size()[1]):
-                a_i_j_two.append(
-                    self.linear_two(embed_topic[:, i, :].unsqueeze(dim=1).repeat(1, ri.size()[1], 1),
-                                    ri))  # seq 1 batch
-
-            a_i_j_two = torch.stack(a_i_j_two, dim=1).squeeze(dim=2).transpose(0, 2).transpose(1, 2)  # batch 1 seq
-            ti = a_i_j_two.bmm(embed_topic)  # [batch, seq, embed_size]
-            ui = torch.cat((ti, embed_topic.repeat(1, ti.size()[1], 1)), dim=2)
+            with timer.region('embedding'):
+                embed_posts = word2vec.embedding(id_posts)  # [batch, seq, embed_size]
+                embed_keywords = word2vec.embedding(id_keywords)  # [batch, seq, embed_size]
+                embed_topic = word2vec.embedding(id_topic)  # [batch, 1, embed_size]
+
+            with timer.region('keyword_attention'):
+                # keyword attention  [batch,seq,embed_size]
+                a_i_j_one = []
+                for i in range(0, id_keywords.size()[1]):
+                    a_i_j_one.append(
+                        self.linear_one(embed_keywords[:, i, :].unsqueeze(dim=1).repeat(1, id_keywords.size()[1], 1),
+                                        embed_keywords))  # seq 1 batch
+                a_i_j_one = torch.stack(a_i_j_one, dim=1).squeeze(dim=2).transpose(0, 2)  # batch seq seq
+                ri = a_i_j_one.bmm(embed_keywords)  # [batch, seq, embed_size]
+
+                a_i_j_two = []
+                for i in range(0, embed_topic.size()[1]):
+                    a_i_j_two.append(
+                        self.linear_two(embed_topic[:, i, :].unsqueeze(dim=1).repeat(1, ri.size()[1], 1),
+                                        ri))  # seq 1 batch
+
+                a_i_j_two = torch.stack(a_i_j_two, dim=1).squeeze(dim=2).transpose(0, 2).transpose(1, 2)  # batch 1 seq
+                ti = a_i_j_two.bmm(embed_topic)  # [batch, seq, embed_size]
+                ui = torch.cat((ti, embed_topic.repeat(1, ti.size()[1], 1)), dim=2)
 
             # state = [layers, batch, dim]
 
-            _, state_posts = self.post_encoder(embed_posts.transpose(0, 1), len_posts)
-            _, state_keywords = self.topic_encoder(ui.transpose(0, 1), len_keywords)
-            if isinstance(state_posts, tuple):
-                state_posts = state_posts[0]
-            if isinstance(state_keywords, tuple):
-                state_keywords = state_keywords[0]
-            x = state_posts[-1, :, :]  # [batch, dim]
-            t = state_keywords[-1, :, :]
-            control = embed_topic.squeeze(dim=1)
-            control = self.topic_linear(control)  # [batch, dim]
-            x = torch.cat([x, control], 1)  # [batch, dim*2]
-            x = self.control_post_linear(x)  # [batch, dim]
-
-
-            # p(z|x)
-            _mu, _logvar = self.prior_net(x, t)  # [batch, latent]
-            # 重参数化
-            z = _mu + (0.5 * _logvar).exp() * sampled_latents  # [batch, latent]
-
-            first_state = self.prepare_state(torch.cat([z, x], 1))  # [num_layer, batch, dim_out]
-            done = torch.tensor([0] * batch_size).bool()
-            first_input_id = (torch.ones((1, batch_size)) * self.config.start_id).long()
-            if gpu:
-                done = done.cuda()
-                first_input_id = first_input_id.cuda()
-
-            outputs = []
-            for idx in range(max_len):
-                if idx == 0:  # 第一个时间步
-                    state = first_state  # 解码器初始状态
-                    decoder_input = word2vec.embedding(first_input_id)  # 解码器初始输入 [1, batch, embed_size]
-                else:
-                    decoder_input = word2vec.embedding(next_input_id)  # [1, batch, embed_size]
-                # output: [1, batch, dim_out]
-                # state: [num_layers, batch, dim_out]
-                output, state = self.decoder(decoder_input, state)
-                outputs.append(output)
-
-                vocab_prob = self.projector(output)  # [1, batch, num_vocab]
-                next_input_id = torch.argmax(vocab_prob, 2)  # 选择概率最大的词作为下个时间步的输入 [1, batch]
-
-                _done = next_input_id.squeeze(0) == self.config.end_id  # 当前时间步完成解码的 [batch]
-                done = done | _done  # 所有完成解码的
-                if done.sum() == batch_size:  # 如果全部解码完成则提前停止
-                    break
-
-            outputs = torch.cat(outputs, 0).transpose(0, 1)  # [batch, seq, dim_out]
-            output_vocab = self.projector(outputs)  # [batch, seq, num_vocab]
+            with timer.region('encoder'):
+                if state_posts is None:
+                    state_posts = self.encode_state(self.post_encoder, id_posts, len_posts, embed_posts)
+                _, state_keywords = self.topic_encoder(ui.transpose(0, 1), len_keywords)
+                if isinstance(state_posts, tuple):
+                    state_posts = state_posts[0]
+                if isinstance(state_keywords, tuple):
+                    state_keywords = state_keywords[0]
+                x = state_posts[-1, :, :]  # [batch, dim]
+                t = state_keywords[-1, :, :]
+                control = embed_topic.squeeze(dim=1)
+                control = self.topic_linear(control)  # [batch, dim]
+                x = torch.cat([x, control], 1)  # [batch, dim*2]
+                x = self.control_post_linear(x)  # [batch, dim]
+
+
+            with timer.region('latent'):
+                # p(z|x)
+                _mu, _logvar = self.prior_net(x, t)  # [batch, latent]
+                # 重参数化
+                z = _mu + (0.5 * _logvar).exp() * sampled_latents  # [batch, latent]
+
+            with timer.region('decoder'):
+                first_state = self.prepare_state(torch.cat([z, x], 1))  # [num_layer, batch, dim_out]
+                done = torch.tensor([0] * batch_size).bool()
+                first_input_id = (torch.ones((1, batch_size)) * self.config.start_id).long()
+                if gpu:
+                    done = done.cuda()
+                    first_input_id = first_input_id.cuda()
+
+                outputs = []
+                for idx in range(max_len):
+                    if idx == 0:  # 第一个时间步
+                        state = first_state  # 解码器初始状态
+                        decoder_input = word2vec.embedding(first_input_id)  # 解码器初始输入 [1, batch, embed_size]
+                    else:
+                        decoder_input = word2vec.embedding(next_input_id)  # [1, batch, embed_size]
+                    # output: [1, batch, dim_out]
+                    # state: [num_layers, batch, dim_out]
+                    output, state = self.decoder(decoder_input, state)
+                    outputs.append(output)
+
+                    vocab_prob = self.projector(output)  # [1, batch, num_vocab]
+                    next_input_id = torch.argmax(vocab_prob, 2)  # 选择概率最大的词作为下个时间步的输入 [1, batch]
+
+                    _done = next_input_id.squeeze(0) == self.config.end_id  # 当前时间步完成解码的 [batch]
+                    done = done | _done  # 所有完成解码的
+                    if done.sum() == batch_size:  # 如果全部解码完成则提前停止
+                        break
+
+                outputs = torch.cat(outputs, 0).transpose(0, 1)  # [batch, seq, dim_out]
+            with timer.region('projector'):
+                output_vocab = self.projector(outputs)  # [batch, seq, num_vocab]
 
             return output_vocab, _mu, _logvar, None, None
 
@@ -349,64 +375,63 @@ class Model(nn.Module):
         pi = self.pi_
         log_sigma2_c = self.log_sigma2_c
         mu_c = self.mu_c
-        yita_c = torch.exp(torch.log(pi.unsqueeze(0))+self.gaussian_pdfs_log(z,mu_c,log_sigma2_c))
+        yita_c = torch.log(pi.unsqueeze(0))+self.gaussian_pdfs_log(z,mu_c,log_sigma2_c)  # argmax在log空间做，避免exp下溢
 
         yita=yita_c.detach().cpu().numpy()
         return np.argmax(yita,axis=1)
 
+    # 生成时用不到的部分：回复编码器和识别网络只在训练时用，嵌入层由word2vec代替，GMM参数只用于聚类，mu1/sigma1是最后一个batch的中间结果
+    TRAINING_ONLY = ['embedding', 'response_encoder', 'recognize_net', 'pi_', 'mu_c', 'log_sigma2_c', 'mu1', 'sigma1']
+
+    def checkpoint_modules(self):
+        r""" 模型文件里的名字 -> 子模块，'linear_teo'是旧模型文件里的名字 """
+        return {'embedding': self.embedding,
+                'post_encoder': self.post_encoder,
+                'response_encoder': self.response_encoder,
+                'prior_net': self.prior_net,
+                'recognize_net': self.recognize_net,
+                'prepare_state': self.prepare_state,
+                'decoder': self.decoder,
+                'projector': self.projector,
+                'topic_encoder': self.topic_encoder,
+                'linear_one': self.linear_one,
+                'linear_teo': self.linear_two,
+                'topic_linear': self.topic_linear,
+                'control_post_linear': self.control_post_linear}
+
+    def checkpoint_dict(self, epoch, global_step):
+        r""" save_model写入的内容，张量和模型共享内存 """
+        checkpoint = {name: module.state_dict() for name, module in self.checkpoint_modules().items()}
+        checkpoint.update({'pi_': self.pi_,
+                           'mu_c': self.mu_c,
+                           'log_sigma2_c': self.log_sigma2_c,
+                           'mu1': self.mu1,
+                           'sigma1': self.sigma1,
+                           'epoch': epoch,
+                           'global_step': global_step})
+        return checkpoint
+
     def save_model(self, epoch, global_step, path):
-        r""" 保存模型 """
-        torch.save({'embedding': self.embedding.state_dict(),
-                    'post_encoder': self.post_encoder.state_dict(),
-                    'response_encoder': self.response_encoder.state_dict(),
-                    'prior_net': self.prior_net.state_dict(),
-                    'recognize_net': self.recognize_net.state_dict(),
-                    'prepare_state': self.prepare_state.state_dict(),
-                    'decoder': self.decoder.state_dict(),
-                    'projector': self.projector.state_dict(),
-                    'topic_encoder': self.topic_encoder.state_dict(),
-                    'linear_one': self.linear_one.state_dict(),
-                    'linear_teo': self.linear_two.state_dict(),
-                    'topic_linear': self.topic_linear.state_dict(),
-                    'control_post_linear': self.control_post_linear.state_dict(),
-                    'pi_': self.pi_,
-                    'mu_c': self.mu_c,
-                    'log_sigma2_c': self.log_sigma2_c,
-                    'mu1': self.mu1,
-                    'sigma1': self.sigma1,
-                    'epoch': epoch,
-                    'global_step': global_step}, path)
-
-    def load_model(self, path):
-        r""" 载入模型 """
-        checkpoint = torch.load(path)
-        self.embedding.load_state_dict(checkpoint['embedding'])
-        self.post_encoder.load_state_dict(checkpoint['post_encoder'])
-        self.response_encoder.load_state_dict(checkpoint['response_encoder'])
-        self.prior_net.load_state_dict(checkpoint['prior_net'])
-        self.recognize_net.load_state_dict(checkpoint['recognize_net'])
-        self.prepare_state.load_state_dict(checkpoint['prepare_state'])
-        self.decoder.load_state_dict(checkpoint['decoder'])
-        self.projector.load_state_dict(checkpoint['projector'])
-        self.topic_encoder.load_state_dict(checkpoint['topic_encoder'])
-        self.linear_one.load_state_dict(checkpoint['linear_one'])
-        self.linear_two.load_state_dict(checkpoint['linear_teo'])
-        self.topic_linear.load_state_dict(checkpoint['topic_linear'])
-        self.control_post_linear.load_state_dict(checkpoint['control_post_linear'])
-        self.pi_ = checkpoint['pi_']
-        self.mu_c = checkpoint['mu_c']
-        self.log_sigma2_c = checkpoint['log_sigma2_c']
-        self.mu1 = checkpoint['mu1']
-        self.sigma1 = checkpoint['sigma1']
+        r""" 保存模型，格式见model.util.checkpoint """
+        save_checkpoint(self.checkpoint_dict(epoch, global_step), path)
+
+    def load_model(self, path, inference=False):  # inference时不读TRAINING_ONLY
+        r""" 载入模型，旧的torch.save文件也能读；张量先放在cpu上，gpu上保存的模型在cpu上也能载入 """
+        checkpoint = load_checkpoint(path)
+        assert inference or 'inference_only' not in checkpoint, f'{path}是export_inference导出的，只能用于生成'
+        skip = self.TRAINING_ONLY if inference else []
+        for name, module in self.checkpoint_modules().items():
+            if name not in skip:
+                module.load_state_dict(checkpoint[name])
+        for name in ['pi_', 'mu_c', 'log_sigma2_c', 'mu1', 'sigma1']:
+            if name not in skip:
+                setattr(self, name, checkpoint[name])
         epoch = checkpoint['epoch']
         global_step = checkpoint['global_step']
         return epoch, global_step
 
     def gaussian_pdfs_log(self,x,mus,log_sigma2s):
-        G=[]
-        for c in range(self.config.nClusters):
-            G.append(self.gaussian_pdf_log(x,mus[c:c+1,:],log_sigma2s[c:c+1,:]).view(-1,1))
-        return torch.cat(G,1)
+        return gaussian_pdfs_log(x, mus, log_sigma2s)  # 所有簇一次广播计算
 
 
 
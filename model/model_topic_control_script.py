@@ -0,0 +1,174 @@
+import copy
+import json
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence
+from typing import List, Optional, Tuple
+
+
+class ConcatAttn(nn.Module):
+    r""" model_topic_control.Attn('concat')的批量版本：所有query对所有位置的分数一次算出，
+    softmax和原实现一样在batch维上做 """
+    def __init__(self, attn):  # model_topic_control.Attn
+        super(ConcatAttn, self).__init__()
+        assert attn.method == 'concat'
+        hidden_size = attn.hidden_size
+        weight = attn.attn.weight.detach()  # [hidden, hidden*2]，前一半作用于query，后一半作用于位置
+        self.query = nn.Linear(hidden_size, hidden_size)
+        self.key = nn.Linear(hidden_size, hidden_size, bias=False)
+        self.query.weight.data.copy_(weight[:, :hidden_size])
+        self.query.bias.data.copy_(attn.attn.bias.detach())
+        self.key.weight.data.copy_(weight[:, hidden_size:])
+        self.v = nn.Parameter(attn.v.detach().clone())
+
+    def forward(self, query,  # [batch, num_query, dim]
+                keys):  # [batch, num_key, dim]
+        energy = torch.tanh(self.query(query).unsqueeze(2) + self.key(keys).unsqueeze(1))  # [batch, num_query, num_key, dim]
+        scores = (energy * self.v).sum(3)  # [batch, num_query, num_key]
+        return torch.softmax(scores, 0)
+
+
+class LSTMFinalState(nn.Module):
+    r""" Encoder的最后一层最终状态h，双向时拼接两个方向 [batch, dim] """
+    def __init__(self, encoder):  # model.Encoder.Encoder
+        super(LSTMFinalState, self).__init__()
+        self.rnn_cell = encoder.rnn_cell
+        self.bidirectional = encoder.bidirectional
+
+    def forward(self, x,  # [seq, batch, dim]
+                lengths):  # [batch]
+        packed = pack_padded_sequence(x, lengths.cpu(), enforce_sorted=False)
+        _, (h, _) = self.rnn_cell(packed)  # [layers*directions, batch, dim]
+        if self.bidirectional:
+            return torch.cat([h[-2], h[-1]], 1)
+        return h[-1]
+
+
+class GRUFinalState(nn.Module):
+    r""" 同LSTMFinalState，GRU版本 """
+    def __init__(self, encoder):
+        super(GRUFinalState, self).__init__()
+        self.rnn_cell = encoder.rnn_cell
+        self.bidirectional = encoder.bidirectional
+
+    def forward(self, x, lengths):
+        packed = pack_padded_sequence(x, lengths.cpu(), enforce_sorted=False)
+        _, h = self.rnn_cell(packed)
+        if self.bidirectional:
+            return torch.cat([h[-2], h[-1]], 1)
+        return h[-1]
+
+
+class LSTMStep(nn.Module):
+    r""" 解码器的一步，状态统一为(h, c) """
+    def __init__(self, decoder):  # model.Decoder.Decoder
+        super(LSTMStep, self).__init__()
+        self.rnn_cell = decoder.rnn_cell
+
+    def forward(self, x,  # [1, batch, embed_size]
+                h,  # [layers, batch, dim]
+                c):  # [layers, batch, dim]
+        output, (h, c) = self.rnn_cell(x, (h, c))
+        return output, h, c
+
+
+class GRUStep(nn.Module):
+    r""" 同LSTMStep，GRU版本，c原样传回 """
+    def __init__(self, decoder):
+        super(GRUStep, self).__init__()
+        self.rnn_cell = decoder.rnn_cell
+
+    def forward(self, x, h, c):
+        output, h = self.rnn_cell(x, h)
+        return output, h, c
+
+
+class TopicControlInference(nn.Module):
+    r""" model_topic_control的纯推理图：词向量表、关键词/话题注意力、编码器、先验网络和贪心解码都在一个模块里，
+    可以torch.jit.script，不依赖word2vec对象和gpu参数 """
+    def __init__(self, model,  # model_topic_control.Model
+                 embedding_table):  # [num_vocab, embedding_size]
+        super(TopicControlInference, self).__init__()
+        model = copy.deepcopy(model).cpu().eval()  # 不和训练中的模型共享参数
+        config = model.config
+        self.start_id = config.start_id
+        self.end_id = config.end_id
+        self.latent_size = config.latent_size
+        self.decoder_num_layers = config.decoder_num_layers
+
+        self.embedding = nn.Embedding.from_pretrained(embedding_table.float().cpu(), freeze=True)
+        self.keyword_attn = ConcatAttn(model.linear_one)
+        self.topic_attn = ConcatAttn(model.linear_two)
+        self.post_encoder = LSTMFinalState(model.post_encoder) if model.post_encoder.cell_type == 'LSTM' \
+            else GRUFinalState(model.post_encoder)
+        self.topic_encoder = LSTMFinalState(model.topic_encoder) if model.topic_encoder.cell_type == 'LSTM' \
+            else GRUFinalState(model.topic_encoder)
+        self.topic_linear = model.topic_linear
+        self.control_post_linear = model.control_post_linear
+        self.prior_net = model.prior_net
+        self.prepare_linear = model.prepare_state.linear
+        self.decoder = LSTMStep(model.decoder) if model.decoder.cell_type == 'LSTM' else GRUStep(model.decoder)
+        self.projector = model.projector[0]  # 贪心解码只取argmax，不需要softmax
+
+    def forward(self, posts,  # [batch, seq]
+                len_posts,  # [batch]
+                keywords,  # [batch, num_keywords]
+                len_keywords,  # [batch]
+                topic,  # [batch, 1]
+                sampled_latents: Optional[torch.Tensor] = None,  # [batch, latent_size]
+                max_len: int = 60):
+        batch_size = posts.size(0)
+        embed_posts = self.embedding(posts)  # [batch, seq, embed_size]
+        embed_keywords = self.embedding(keywords)  # [batch, num_keywords, embed_size]
+        embed_topic = self.embedding(topic)  # [batch, 1, embed_size]
+
+        # 关键词之间的注意力，再用话题对结果做注意力
+        ri = self.keyword_attn(embed_keywords, embed_keywords).bmm(embed_keywords)  # [batch, num_keywords, embed_size]
+        ti = self.topic_attn(embed_topic, ri).transpose(1, 2).bmm(embed_topic)  # [batch, num_keywords, embed_size]
+        ui = torch.cat([ti, embed_topic.expand(-1, ti.size(1), -1)], 2)  # [batch, num_keywords, embed_size*2]
+
+        x = self.post_encoder(embed_posts.transpose(0, 1), len_posts)  # [batch, dim]
+        t = self.topic_encoder(ui.transpose(0, 1), len_keywords)  # [batch, dim]
+        control = self.topic_linear(embed_topic.squeeze(1))  # [batch, dim]
+        x = self.control_post_linear(torch.cat([x, control], 1))  # [batch, dim]
+
+        # p(z|x)
+        _mu, _logvar = self.prior_net(x, t)  # [batch, latent]
+        if sampled_latents is None:
+            sampled_latents = torch.randn(batch_size, self.latent_size, device=x.device)
+        z = _mu + (0.5 * _logvar).exp() * sampled_latents  # [batch, latent]
+
+        h = self.prepare_linear(torch.cat([z, x], 1)).unsqueeze(0).repeat(self.decoder_num_layers, 1, 1)
+        c = h  # [num_layers, batch, dim_out]
+        next_input_id = torch.full((1, batch_size), self.start_id, dtype=torch.long, device=posts.device)
+        done = torch.zeros(batch_size, dtype=torch.bool, device=posts.device)
+        results: List[torch.Tensor] = []
+        for _ in range(max_len):
+            output, h, c = self.decoder(self.embedding(next_input_id), h, c)  # [1, batch, dim_out]
+            next_input_id = self.projector(output).argmax(2)  # [1, batch]
+            results.append(next_input_id)
+            done = done | (next_input_id.squeeze(0) == self.end_id)
+            if bool(done.all()):  # 全部解码完成则提前停止
+                break
+        return torch.cat(results, 0).t()  # [batch, seq]
+
+
+def embedding_table(word2vec, num_vocab):
+    r""" 把外部词向量对象展开成[num_vocab, embedding_size]的表 """
+    with torch.no_grad():
+        return word2vec.embedding(torch.arange(num_vocab).unsqueeze(0))[0].detach().float().cpu()
+
+
+def export_script(model, word2vec, path):
+    r""" 导出成一个TorchScript文件，配置记录在文件里的config.json """
+    module = torch.jit.script(TopicControlInference(model, embedding_table(word2vec, model.config.num_vocab)))
+    config = {key: getattr(model.config, key) for key in dir(model.config) if not key.startswith('_')}
+    torch.jit.save(module, path, _extra_files={'config.json': json.dumps(config)})
+    return module
+
+
+def load_script(path):
+    r""" 载入导出的文件，不需要本仓库的源码，返回(模块, 配置) """
+    extra_files = {'config.json': ''}
+    module = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    return module, json.loads(extra_files['config.json'])
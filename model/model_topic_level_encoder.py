@@ -1,14 +1,18 @@
+import hashlib
 import torch
 import torch.nn as nn
 from sklearn.mixture import GaussianMixture
 import numpy as np
 from model.Embedding import Embedding
 from model.Encoder import Encoder
+from model.util.packing import PackInfo
 from model.PriorNetTopic import PriorNet
 from model.RecognizeNetTopic import RecognizeNet
 from model.Decoder import Decoder
 from model.PrepareState import PrepareState
+from model.util.gmm import gaussian_pdfs_log, gmm_vae_loss
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 class Attn(torch.nn.Module):
     def __init__(self, method, hidden_size):
@@ -53,6 +57,7 @@ class Model(nn.Module):
     def __init__(self, config):
         super(Model, self).__init__()
         self.config = config
+        self.state_cache = None  # 测试时编码器最终状态的缓存，见model.util.state_cache
 
         # 定义嵌入层
         self.embedding = Embedding(config.num_vocab,  # 词汇表大小
@@ -148,7 +153,23 @@ class Model(nn.Module):
         self.mu1 = None
         self.sigma1 = None
 
-    def forward(self, inputs, word2vec, level_encoder_data, inference=False, inpre=False, ingau=False, max_len=60, gpu=True):
+        # 全局语义向量的缓存
+        self.global_sem_refresh_steps = config.global_sem_refresh_steps  # 训练时每隔多少次前向重新编码一次
+        self.global_sem_cache = None  # 缓存的global_sem，已detach
+        self.global_sem_key = None  # 缓存对应的(是否训练模式, 语料版本, 参数版本)
+        self.global_sem_age = 0  # 训练时缓存已经被复用的次数
+        self.level_encoder_chunk_size = config.level_encoder_chunk_size  # 词级编码每块的句子数，<=0为不分块
+
+    def encode_state(self, encoder, ids, length, embed,
+                     state=None):  # 编码器的初始状态，例如多轮对话里上一轮延续下来的，None时从0开始
+        r""" 编码器的最终状态，测试模式下设置了state_cache时按token id序列复用已经编码过的句子，给了初始状态时不用缓存 """
+        if state is None and self.state_cache is not None and not self.training:
+            return self.state_cache.encode(encoder, ids, length, embed)
+        _, state = encoder(embed.transpose(0, 1), length, state)
+        return state
+
+    def forward(self, inputs, word2vec, level_encoder_data, inference=False, inpre=False, ingau=False, max_len=60, gpu=True,
+                state_posts=None):  # 测试时已经编码好的post最终状态，None时在forward里编码
         if not inference:  # 训练
             id_posts = inputs['posts']  # [batch, seq]
             len_posts = inputs['len_posts']  # [batch]
@@ -166,28 +187,8 @@ class Model(nn.Module):
             embed_keywords = word2vec.embedding(id_keywords)  # [batch, seq, embed_size]
             embed_topic = word2vec.embedding(id_topic)  # [batch, 1, embed_size]
 
-            #level encoder data
-
-
-            level_sentences = level_encoder_data['id_sentences']  #2000, seq
-            level_len_sentences = level_encoder_data['len_sentences']# 2000
-
-            embed_level_sentences = word2vec.embedding(level_sentences)#2000, seq, emb
-
-            #词级编码器
-            _, state_word_level = self.word_encoder(embed_level_sentences.transpose(0, 1), level_len_sentences)
-            if isinstance(state_word_level, tuple):
-                state_word_level = state_word_level[0]
-            sentence_encoder_input = state_word_level[-1, :, :]  # [2000, emb]
-            sentence_encoder_input = sentence_encoder_input.unsqueeze(dim=0) #[batch 2000 emb]
-
-            #句子级编码器
-            len_sentence = torch.tensor([sentence_encoder_input.size()[1]]).long().cuda()
-            _, state_sentence_level = self.word_encoder(sentence_encoder_input.transpose(0, 1),len_sentence)
-            if isinstance(state_sentence_level, tuple):
-                state_sentence_level = state_sentence_level[0]
-            global_sem = state_sentence_level[-1, :, :]  # [batch, emb]
-            global_sem = global_sem.unsqueeze(dim=0)
+            # 全局语义向量，按缓存策略复用
+            global_sem = self.global_semantics(word2vec, level_encoder_data)  # [1, 1, emb]
 
             # keyword attention  [batch,seq,embed_size]
             a_i_j_one = []
@@ -223,8 +224,8 @@ class Model(nn.Module):
             # keyword attention with topic attention
             # topic encoder
             # state: [layers, batch, dim]
-            _, state_posts = self.post_encoder(embed_posts.transpose(0, 1), len_posts)
-            _, state_responses = self.response_encoder(embed_responses.transpose(0, 1), len_responses)
+            state_posts = self.encode_state(self.post_encoder, id_posts, len_posts, embed_posts)
+            state_responses = self.encode_state(self.response_encoder, id_responses, len_responses, embed_responses)
             _, state_keywords = self.topic_encoder(ui.transpose(0, 1), len_keywords)
             if isinstance(state_posts, tuple):
                 state_posts = state_posts[0]
@@ -246,24 +247,8 @@ class Model(nn.Module):
             # 重参数化
             z = mu + (0.5 * logvar).exp() * sampled_latents  # [batch, latent]
 
-            pi = self.pi_
-            log_sigma2_c = self.log_sigma2_c
-            mu_c = self.mu_c
-            det = 1e-10
-
-            #z = torch.randn_like(mu) * torch.exp(logvar / 2) + mu
-            yita_c = torch.exp(torch.log(pi.unsqueeze(0)) + self.gaussian_pdfs_log(z, mu_c, log_sigma2_c)) + det
-
-            yita_c = yita_c / (yita_c.sum(1).view(-1, 1))  # batch_size*Clusters
-
-            Loss = 0.5 * torch.mean(torch.sum(yita_c * torch.sum(log_sigma2_c.unsqueeze(0) +
-                                                                 torch.exp(logvar.unsqueeze(
-                                                                     1) - log_sigma2_c.unsqueeze(0)) +
-                                                                 (mu.unsqueeze(1) - mu_c.unsqueeze(0)).pow(
-                                                                     2) / torch.exp(log_sigma2_c.unsqueeze(0)), 2), 1))
-            # 第二项
-            Loss -= torch.mean(torch.sum(yita_c * torch.log(pi.unsqueeze(0) / (yita_c)), 1)) + 0.5 * torch.mean(
-                torch.sum(1 + logvar, 1))
+            # GMM先验的ELBO项，q(c|z)在log空间归一化
+            Loss, yita_c = gmm_vae_loss(z, mu, logvar, self.pi_, self.mu_c, self.log_sigma2_c)
             # torch.mean(torch.sum(yita_c*torch.log(pi.unsqueeze(0)/(yita_c)),1))第三个
             # 0.5*torch.mean(torch.sum(1+z_sigma2_log,1))第四个
 
@@ -302,27 +287,8 @@ class Model(nn.Module):
             embed_keywords = word2vec.embedding(id_keywords)  # [batch, seq, embed_size]
             embed_topic = word2vec.embedding(id_topic)  # [batch, 1, embed_size]
 
-            # level encoder data
-
-            level_sentences = level_encoder_data['id_sentences']  # 2000, seq
-            level_len_sentences = level_encoder_data['len_sentences']  # 2000
-
-            embed_level_sentences = word2vec.embedding(level_sentences)  # 2000, seq, emb
-
-            # 词级编码器
-            _, state_word_level = self.word_encoder(embed_level_sentences.transpose(0, 1), level_len_sentences)
-            if isinstance(state_word_level, tuple):
-                state_word_level = state_word_level[0]
-            sentence_encoder_input = state_word_level[-1, :, :]  # [2000, emb]
-            sentence_encoder_input = sentence_encoder_input.unsqueeze(dim=0)  # [batch 2000 emb]
-
-            # 句子级编码器
-            len_sentence = torch.tensor([sentence_encoder_input.size()[1]]).long().cuda()
-            _, state_sentence_level = self.word_encoder(sentence_encoder_input.transpose(0, 1), len_sentence)
-            if isinstance(state_sentence_level, tuple):
-                state_sentence_level = state_sentence_level[0]
-            global_sem = state_sentence_level[-1, :, :]  # [batch, emb]
-            global_sem = global_sem.unsqueeze(dim=0)
+            # 全局语义向量，测试时参数不变直接用缓存
+            global_sem = self.global_semantics(word2vec, level_encoder_data)  # [1, 1, emb]
 
             # keyword attention  [batch,seq,embed_size]
             a_i_j_one = []
@@ -355,7 +321,8 @@ class Model(nn.Module):
 
             # state = [layers, batch, dim]
 
-            _, state_posts = self.post_encoder(embed_posts.transpose(0, 1), len_posts)
+            if state_posts is None:
+                state_posts = self.encode_state(self.post_encoder, id_posts, len_posts, embed_posts)
             _, state_keywords = self.topic_encoder(ui.transpose(0, 1), len_keywords)
             if isinstance(state_posts, tuple):
                 state_posts = state_posts[0]
@@ -401,6 +368,88 @@ class Model(nn.Module):
 
             return output_vocab, _mu, _logvar, None, None
 
+    def global_semantics(self, word2vec, level_encoder_data):
+        r""" 层级编码器得到的全局语义向量 [1, 1, emb]，避免每个batch都重新编码上千条语料
+        测试时只要语料和编码器参数不变就直接用缓存；训练时每global_sem_refresh_steps次前向刷新一次，
+        刷新的那一步带梯度，其余步用detach的旧值（global_sem_refresh_steps<=1时每步都重新计算）。
+        切换训练/测试模式或者换了语料后都重新编码 """
+        level_sentences = level_encoder_data['id_sentences']  # 2000, seq
+        level_len_sentences = level_encoder_data['len_sentences']  # 2000
+        # 参数版本：优化器原地更新参数、load_state_dict都会增加_version
+        version = sum(p._version for p in self.word_encoder.parameters())
+        key = (self.training, self.corpus_version(level_encoder_data), version)
+
+        if self.global_sem_cache is not None and key[:2] == self.global_sem_key[:2]:
+            if not self.training and key == self.global_sem_key:
+                return self.global_sem_cache
+            if self.training and self.global_sem_age + 1 < self.global_sem_refresh_steps:
+                self.global_sem_age += 1
+                return self.global_sem_cache
+
+        with torch.set_grad_enabled(self.training and torch.is_grad_enabled()):
+            # 词级编码器，按长度分块编码，峰值显存由块大小而不是语料大小决定
+            sentence_encoder_input = self.encode_level_sentences(word2vec, level_sentences, level_len_sentences)  # [2000, emb]
+            sentence_encoder_input = sentence_encoder_input.unsqueeze(dim=0)  # [batch 2000 emb]
+
+            # 句子级编码器
+            len_sentence = torch.tensor([sentence_encoder_input.size()[1]]).long()
+            _, state_sentence_level = self.word_encoder(sentence_encoder_input.transpose(0, 1), len_sentence)
+            if isinstance(state_sentence_level, tuple):
+                state_sentence_level = state_sentence_level[0]
+            global_sem = state_sentence_level[-1, :, :]  # [batch, emb]
+            global_sem = global_sem.unsqueeze(dim=0)
+
+        self.global_sem_cache = global_sem.detach()
+        self.global_sem_key = key
+        self.global_sem_age = 0
+        return global_sem
+
+    @staticmethod
+    def corpus_version(level_encoder_data):
+        r""" 语料的版本：level_encoder_data里给了'version'就用它，否则第一次用到时算句子id和长度的内容哈希，
+        存成level_encoder_data['version']，之后每个batch都不再拷贝和哈希语料。原地改了语料内容时要换掉'version' """
+        if 'version' not in level_encoder_data:
+            content = hashlib.sha1()
+            for key in ['id_sentences', 'len_sentences']:
+                value = torch.as_tensor(level_encoder_data[key]).cpu()
+                content.update(str(tuple(value.shape)).encode())
+                content.update(value.numpy().tobytes())
+            level_encoder_data['version'] = content.hexdigest()
+        return level_encoder_data['version']
+
+    def encode_level_sentences(self, word2vec, level_sentences, level_len_sentences):
+        r""" 词级编码器：语料按长度排序后每level_encoder_chunk_size条一块，每块只截取到块内最大长度再编码，
+        每条句子的最终状态按原顺序拼回 [num_sentences, emb]。训练时每块用checkpoint，反向时重算，激活值也不随语料增长 """
+        level_len_sentences = torch.as_tensor(level_len_sentences).long().cpu()  # pack需要cpu上的长度
+        sorted_len, sorted_index = level_len_sentences.sort(descending=True)
+        chunk_size = self.level_encoder_chunk_size if self.level_encoder_chunk_size > 0 else sorted_index.size(0)
+
+        states = []
+        for st in range(0, sorted_index.size(0), chunk_size):
+            index = sorted_index[st: st + chunk_size]
+            len_chunk = sorted_len[st: st + chunk_size]
+            id_chunk = level_sentences[index.to(level_sentences.device), :int(len_chunk[0])]  # [chunk, chunk_max_len]
+            embed_chunk = word2vec.embedding(id_chunk)  # [chunk, chunk_max_len, emb]
+            if torch.is_grad_enabled():
+                if not embed_chunk.requires_grad:  # checkpoint至少需要一个输入需要梯度，参数才会有梯度
+                    embed_chunk.requires_grad_()
+                states.append(checkpoint(self.word_level_state, embed_chunk, len_chunk))
+            else:
+                states.append(self.word_level_state(embed_chunk, len_chunk))
+
+        states = torch.cat(states, 0)  # 排序后的顺序 [num_sentences, emb]
+        restore_index = sorted_index.argsort().to(states.device)
+        return states.index_select(0, restore_index)  # 恢复语料原顺序
+
+    def word_level_state(self, embed_sentences,  # [chunk, seq, emb]
+                         len_sentences):  # [chunk]
+        r""" 一块句子在词级编码器最后一层的最终状态 [chunk, emb] """
+        # 块内已经按长度降序，直接pack，不再排序和还原
+        _, state_word_level = self.word_encoder(embed_sentences.transpose(0, 1), PackInfo(len_sentences))
+        if isinstance(state_word_level, tuple):
+            state_word_level = state_word_level[0]
+        return state_word_level[-1, :, :]
+
     def print_parameters(self):
         r""" 统计参数 """
         total_num = 0  # 参数总数
@@ -439,7 +488,7 @@ class Model(nn.Module):
         pi = self.pi_
         log_sigma2_c = self.log_sigma2_c
         mu_c = self.mu_c
-        yita_c = torch.exp(torch.log(pi.unsqueeze(0))+self.gaussian_pdfs_log(z,mu_c,log_sigma2_c))
+        yita_c = torch.log(pi.unsqueeze(0))+self.gaussian_pdfs_log(z,mu_c,log_sigma2_c)  # argmax在log空间做，避免exp下溢
 
         yita=yita_c.detach().cpu().numpy()
         return np.argmax(yita,axis=1)
@@ -495,10 +544,7 @@ class Model(nn.Module):
         return epoch, global_step
 
     def gaussian_pdfs_log(self,x,mus,log_sigma2s):
-        G=[]
-        for c in range(self.config.nClusters):
-            G.append(self.gaussian_pdf_log(x,mus[c:c+1,:],log_sigma2s[c:c+1,:]).view(-1,1))
-        return torch.cat(G,1)
+        return gaussian_pdfs_log(x, mus, log_sigma2s)  # 所有簇一次广播计算
 
 
 
@@ -8,6 +8,7 @@ from model.PriorNet import PriorNet
 from model.RecognizeNet import RecognizeNet
 from model.Decoder_attention import Decoder
 from model.PrepareState import PrepareState
+from model.util.gmm import gaussian_pdfs_log
 import torch.nn.functional as F
 
 emotion_num = 3
@@ -143,6 +144,7 @@ class Model(nn.Module):
             embed_responses = word2vec.embedding(id_responses)  # [batch, seq, embed_size]
             # state: [layers, batch, dim]
             encoder_output, state_posts = self.post_encoder(embed_posts.transpose(0, 1), len_posts)
+            memory = self.decoder.prepare_memory(encoder_output, len_posts)  # 注意力的key和padding的mask，每个序列只算一次
             _, state_responses = self.response_encoder(embed_responses.transpose(0, 1), len_responses)
             if isinstance(state_posts, tuple):
                 atten_weight_post = state_posts[2]
@@ -176,7 +178,7 @@ class Model(nn.Module):
                 decoder_input = decoder_inputs[idx]  # 当前时间步输入 [1, batch, embed_size]
                 # output: [1, batch, dim_out]
                 # state: [num_layer, batch, dim_out]
-                output, state = self.decoder(decoder_input, state, encoder_output)
+                output, state = self.decoder(decoder_input, state, memory)
                 outputs.append(output)
 
             outputs = torch.cat(outputs, 0).transpose(0, 1)  # [batch, seq-1, dim_out]
@@ -219,6 +221,13 @@ class Model(nn.Module):
             decoder_inputs = embed_responses[:, :-1, :].transpose(0, 1)  # [seq-1, batch, embed_size]
             decoder_inputs = decoder_inputs.split([1] * len_decoder, 0)  # 解码器每一步的输入 seq-1个[1, batch, embed_size]
             first_state = self.prepare_state(torch.cat([z, x], 1))  # [num_layer, batch, dim_out]
+            # 每个情感解码器用自己的注意力参数投影key，每个序列只算一次
+            if ingau == 0:
+                emotion_memory = self.no_emotion_decoder.prepare_memory(encoder_output, len_posts)
+            elif ingau == 1:
+                emotion_memory = self.positive_decoder.prepare_memory(encoder_output, len_posts)
+            else:
+                emotion_memory = self.negative_decoder.prepare_memory(encoder_output, len_posts)
             outputs = []
             for idx in range(len_decoder):
                 if idx == 0:
@@ -232,11 +241,11 @@ class Model(nn.Module):
                 # output: [1, batch, dim_out]
                 # state: [num_layer, batch, dim_out]
                 if ingau == 0:
-                    output, state = self.no_emotion_decoder(decoder_input, state, encoder_output)
+                    output, state = self.no_emotion_decoder(decoder_input, state, emotion_memory)
                 elif ingau == 1:
-                    output, state = self.positive_decoder(decoder_input, state, encoder_output)
+                    output, state = self.positive_decoder(decoder_input, state, emotion_memory)
                 else:
-                    output, state = self.negative_decoder(decoder_input, state, encoder_output)
+                    output, state = self.negative_decoder(decoder_input, state, emotion_memory)
                 outputs.append(output)
 
             outputs = torch.cat(outputs, 0).transpose(0, 1)  # [batch, seq-1, dim_out]
@@ -259,6 +268,7 @@ class Model(nn.Module):
             embed_posts = word2vec.embedding(id_posts)  # [batch, seq, embed_size]
             # state = [layers, batch, dim]
             encoder_output, state_posts = self.post_encoder(embed_posts.transpose(0, 1), len_posts)
+            memory = self.decoder.prepare_memory(encoder_output, len_posts)  # 注意力的key和padding的mask，每个序列只算一次
             if isinstance(state_posts, tuple):
                 atten_weight_post = state_posts[2]
                 state_posts = state_posts[0]
@@ -282,6 +292,7 @@ class Model(nn.Module):
             for num_catgory in range(0, emotion_num):
                 if num_catgory == 0:
                     done = torch.tensor([0] * batch_size).bool().cuda()
+                    emotion_memory = self.no_emotion_decoder.prepare_memory(encoder_output, len_posts)  # 这个解码器的key，每个序列只算一次
                     for idx in range(max_len):
                         if idx == 0:  # 第一个时间步
                             state = self.no_emotion_prepare_state(torch.cat([z, x], 1))  # 解码器初始状态
@@ -290,7 +301,7 @@ class Model(nn.Module):
                             decoder_input = word2vec.embedding(next_input_id)  # [1, batch, embed_size]
                         # output: [1, batch, dim_out]
                         # state: [num_layers, batch, dim_out]
-                        output, state = self.no_emotion_decoder(decoder_input, state, encoder_output)
+                        output, state = self.no_emotion_decoder(decoder_input, state, emotion_memory)
                         outputs_0.append(output)
 
                         vocab_prob = self.projector_no_emotion(output)  # [1, batch, num_vocab]
@@ -305,6 +316,7 @@ class Model(nn.Module):
                     outputs_0 = self.projector_no_emotion(outputs_0)  # [batch, seq, num_vocab]
                 elif num_catgory == 1:
                     done = torch.tensor([0] * batch_size).bool().cuda()
+                    emotion_memory = self.positive_decoder.prepare_memory(encoder_output, len_posts)  # 这个解码器的key，每个序列只算一次
                     for idx in range(max_len):
                         if idx == 0:  # 第一个时间步
                             state = self.positive_prepare_state(torch.cat([z, x], 1))  # 解码器初始状态
@@ -313,7 +325,7 @@ class Model(nn.Module):
                             decoder_input = word2vec.embedding(next_input_id)  # [1, batch, embed_size]
                         # output: [1, batch, dim_out]
                         # state: [num_layers, batch, dim_out]
-                        output, state = self.positive_decoder(decoder_input, state, encoder_output)
+                        output, state = self.positive_decoder(decoder_input, state, emotion_memory)
                         outputs_1.append(output)
 
                         vocab_prob = self.projector_positive(output)  # [1, batch, num_vocab]
@@ -328,6 +340,7 @@ class Model(nn.Module):
                     outputs_1 = self.projector_positive(outputs_1)  # [batch, seq, num_vocab]
                 else:
                     done = torch.tensor([0] * batch_size).bool().cuda()
+                    emotion_memory = self.negative_decoder.prepare_memory(encoder_output, len_posts)  # 这个解码器的key，每个序列只算一次
                     for idx in range(max_len):
                         if idx == 0:  # 第一个时间步
                             state = self.negative_prepare_state(torch.cat([z, x], 1))  # 解码器初始状态
@@ -336,7 +349,7 @@ class Model(nn.Module):
                             decoder_input = word2vec.embedding(next_input_id)  # [1, batch, embed_size]
                         # output: [1, batch, dim_out]
                         # state: [num_layers, batch, dim_out]
-                        output, state = self.negative_decoder(decoder_input, state, encoder_output)
+                        output, state = self.negative_decoder(decoder_input, state, emotion_memory)
                         outputs_2.append(output)
 
                         vocab_prob = self.projector_negative(output)  # [1, batch, num_vocab]
@@ -358,7 +371,7 @@ class Model(nn.Module):
                     decoder_input = word2vec.embedding(next_input_id)  # [1, batch, embed_size]
                 # output: [1, batch, dim_out]
                 # state: [num_layers, batch, dim_out]
-                output, state = self.decoder(decoder_input, state, encoder_output)
+                output, state = self.decoder(decoder_input, state, memory)
                 outputs.append(output)
 
                 vocab_prob = self.projector(output)  # [1, batch, num_vocab]
@@ -440,10 +453,7 @@ class Model(nn.Module):
         return epoch, global_step
 
     def gaussian_pdfs_log(self,x,mus,log_sigma2s):
-        G=[]
-        for c in range(self.config.nClusters):
-            G.append(self.gaussian_pdf_log(x,mus[c:c+1,:],log_sigma2s[c:c+1,:]).view(-1,1))
-        return torch.cat(G,1)
+        return gaussian_pdfs_log(x, mus, log_sigma2s)  # 所有簇一次广播计算
 
 
 
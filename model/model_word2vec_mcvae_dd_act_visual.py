@@ -8,6 +8,8 @@ from model.PriorNet import PriorNet
 from model.RecognizeNet import RecognizeNet
 from model.Decoder import Decoder
 from model.PrepareState import PrepareState
+from model.util.routing import routed_latents
+from model.util.gmm import gaussian_pdfs_log
 import torch.nn.functional as F
 
 act_num = 4
@@ -240,27 +242,10 @@ class Model(nn.Module):
                     state_responses = state_responses[0]
                 x = state_posts[-1, :, :]  # [batch, dim]
                 y = state_responses[-1, :, :]  # [batch, dim]
-                ingau = id_responses_act.detach().cpu().numpy()
-                if ingau[0][0] == 0:
-                    _mu, _logvar = self.inform_prior_net(x)  # [batch, latent]
-                    mu, logvar = self.inform_recognize_net(x, y)  # [batch, latent]
-                    z = mu + (0.5 * logvar).exp() * sampled_latents  # [batch, latent]
-                elif ingau[0][0] == 1:
-                    _mu, _logvar = self.question_prior_net(x)  # [batch, latent]
-                    mu, logvar = self.question_recognize_net(x, y)  # [batch, latent]
-                    z = mu + (0.5 * logvar).exp() * sampled_latents  # [batch, latent]
-                elif ingau[0][0] == 2:
-                    _mu, _logvar = self.directive_prior_net(x)  # [batch, latent]
-                    mu, logvar = self.directive_recognize_net(x, y)  # [batch, latent]
-                    z = mu + (0.5 * logvar).exp() * sampled_latents  # [batch, latent]
-                elif ingau[0][0] == 3:
-                    _mu, _logvar = self.commissive_prior_net(x)  # [batch, latent]
-                    mu, logvar = self.commissive_recognize_net(x, y)  # [batch, latent]
-                    z = mu + (0.5 * logvar).exp() * sampled_latents  # [batch, latent]
-                else:
-                    _mu, _logvar = self.prior_net(x)  # [batch, latent]
-                    mu, logvar = self.recognize_net(x, y)  # [batch, latent]
-                    z = mu + (0.5 * logvar).exp() * sampled_latents  # [batch, latent]
+                # 每个样本按自己的类别选分支，类别不在0-3的用通用的识别网络
+                categories = id_responses_act[:, 0].long()  # [batch]
+                categories = categories.masked_fill((categories < 0) | (categories >= act_num), act_num)
+                z = routed_latents(self.category_recognize_nets(), x, y, sampled_latents, categories)  # [batch, latent]
 
                 z_ = z.detach().cpu().numpy()
                 z_s.append(z_)
@@ -270,6 +255,14 @@ class Model(nn.Module):
         label_s = np.concatenate(label_s, 0)
         return z_s, label_s
 
+    def category_recognize_nets(self):
+        r""" 每个类别对应的识别网络，下标和类别一致，最后一个是通用的 """
+        return [self.inform_recognize_net,
+                self.question_recognize_net,
+                self.directive_recognize_net,
+                self.commissive_recognize_net,
+                self.recognize_net]
+
     def print_parameters(self):
         r""" 统计参数 """
         total_num = 0  # 参数总数
@@ -375,10 +368,7 @@ class Model(nn.Module):
         return epoch, global_step
 
     def gaussian_pdfs_log(self,x,mus,log_sigma2s):
-        G=[]
-        for c in range(self.config.nClusters):
-            G.append(self.gaussian_pdf_log(x,mus[c:c+1,:],log_sigma2s[c:c+1,:]).view(-1,1))
-        return torch.cat(G,1)
+        return gaussian_pdfs_log(x, mus, log_sigma2s)  # 所有簇一次广播计算
 
 
 
@@ -8,6 +8,8 @@ from model.PriorNet import PriorNet
 from model.RecognizeNet import RecognizeNet
 from model.Decoder import Decoder
 from model.PrepareState import PrepareState
+from model.util.routing import routed_teacher_forcing
+from model.util.gmm import gaussian_pdfs_log
 import torch.nn.functional as F
 
 act_num = 3
@@ -336,6 +338,12 @@ class Model(nn.Module):
             y = state_responses[-1, :, :]  # [batch, dim]
             classify_result = self.classification(x)
 
+            if torch.is_tensor(ingau):  # ingau为每个样本的类别[batch]时，混合类别的batch按样本路由到对应分支
+                output_vocab, _mu, _logvar, mu, logvar = routed_teacher_forcing(self.category_branches(), x, y,
+                                                                                embed_responses, sampled_latents,
+                                                                                ingau)
+                return output_vocab, _mu, _logvar, mu, logvar, classify_result
+
             if ingau == 0:
                 _mu, _logvar = self.inform_prior_net(x)  # [batch, latent]
                 mu, logvar = self.inform_recognize_net(x, y)  # [batch, latent]
@@ -590,6 +598,18 @@ class Model(nn.Module):
 
             return outputs_0, outputs_1, outputs_2, outputs_3, outputs, outputs_ms , clf_result
 
+    def category_branches(self):
+        r""" 每个类别对应的(先验网络, 识别网络, 初始化解码器状态, 解码器, 输出层)，下标和ingau一致 """
+        branches = [(self.inform_prior_net, self.inform_recognize_net, self.inform_prepare_state,
+                     self.inform_decoder, self.projector_inform),
+                    (self.question_prior_net, self.question_recognize_net, self.question_prepare_state,
+                     self.question_decoder, self.projector_question),
+                    (self.directive_prior_net, self.directive_recognize_net, self.directive_prepare_state,
+                     self.directive_decoder, self.projector_directive),
+                    (self.commissive_prior_net, self.commissive_recognize_net, self.commissive_prepare_state,
+                     self.commissive_decoder, self.projector_commssive)]
+        return branches[:act_num]
+
     def print_parameters(self):
         r""" 统计参数 """
         total_num = 0  # 参数总数
@@ -695,10 +715,7 @@ class Model(nn.Module):
         return epoch, global_step
 
     def gaussian_pdfs_log(self,x,mus,log_sigma2s):
-        G=[]
-        for c in range(self.config.nClusters):
-            G.append(self.gaussian_pdf_log(x,mus[c:c+1,:],log_sigma2s[c:c+1,:]).view(-1,1))
-        return torch.cat(G,1)
+        return gaussian_pdfs_log(x, mus, log_sigma2s)  # 所有簇一次广播计算
 
 
 
@@ -0,0 +1,213 @@
+import copy
+import json
+import os
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from model.model_topic_control_script import ConcatAttn, embedding_table
+from model.Decoder_attention import AttentionMemory
+
+
+class OnnxEncoder(nn.Module):
+    r""" 可导出的Encoder：初始状态按输入的batch生成，返回每步输出和拼接了双向的(h, c) [layers, batch, dim] """
+    def __init__(self, encoder):  # model.Encoder.Encoder
+        super(OnnxEncoder, self).__init__()
+        self.rnn_cell = encoder.rnn_cell
+        self.cell_type = encoder.cell_type
+        self.bidirectional = encoder.bidirectional
+
+    def forward(self, x,  # [seq, batch, dim]
+                lengths):  # [batch]
+        rnn = self.rnn_cell
+        num_states = rnn.num_layers * (2 if self.bidirectional else 1)
+        # 初始状态显式跟随batch大小，导出的图才能换batch
+        h0 = x.new_zeros(num_states, x.size(1), rnn.hidden_size)
+        packed = pack_padded_sequence(x, lengths, enforce_sorted=False)
+        if self.cell_type == 'LSTM':
+            output, (h, c) = rnn(packed, (h0, h0))
+        else:
+            output, h = rnn(packed, h0)
+            c = h
+        output = pad_packed_sequence(output)[0]  # [seq, batch, dim]
+        if self.bidirectional:
+            h = torch.cat([h[0::2], h[1::2]], 2)
+            c = torch.cat([c[0::2], c[1::2]], 2)
+        return output, h, c
+
+
+def initial_state(prepare_state, x):  # [batch, dim]
+    r""" 同PrepareState，统一返回(h, c)，GRU时c不使用 """
+    h = prepare_state.linear(x).unsqueeze(0).repeat(prepare_state.num_layers, 1, 1)  # [num_layers, batch, dim_out]
+    return h, h
+
+
+class TopicControlEncode(nn.Module):
+    r""" model_topic_control的encode图：post、关键词、话题 -> 解码器初始状态和先验 """
+    def __init__(self, model, embedding):
+        super(TopicControlEncode, self).__init__()
+        self.embedding = embedding
+        self.keyword_attn = ConcatAttn(model.linear_one)
+        self.topic_attn = ConcatAttn(model.linear_two)
+        self.post_encoder = OnnxEncoder(model.post_encoder)
+        self.topic_encoder = OnnxEncoder(model.topic_encoder)
+        self.topic_linear = model.topic_linear
+        self.control_post_linear = model.control_post_linear
+        self.prior_net = model.prior_net
+        self.prepare_state = model.prepare_state
+
+    def forward(self, posts, len_posts, keywords, len_keywords, topic, sampled_latents):
+        embed_posts = self.embedding(posts)  # [batch, seq, embed_size]
+        embed_keywords = self.embedding(keywords)  # [batch, num_keywords, embed_size]
+        embed_topic = self.embedding(topic)  # [batch, 1, embed_size]
+        ri = self.keyword_attn(embed_keywords, embed_keywords).bmm(embed_keywords)
+        ti = self.topic_attn(embed_topic, ri).transpose(1, 2).bmm(embed_topic)
+        ui = torch.cat([ti, embed_topic.expand(-1, ti.size(1), -1)], 2)  # [batch, num_keywords, embed_size*2]
+
+        _, state_posts, _ = self.post_encoder(embed_posts.transpose(0, 1), len_posts)
+        _, state_keywords, _ = self.topic_encoder(ui.transpose(0, 1), len_keywords)
+        x = state_posts[-1]  # [batch, dim]
+        t = state_keywords[-1]
+        x = self.control_post_linear(torch.cat([x, self.topic_linear(embed_topic.squeeze(1))], 1))
+
+        mu, logvar = self.prior_net(x, t)  # p(z|x) [batch, latent]
+        z = mu + (0.5 * logvar).exp() * sampled_latents
+        h, c = initial_state(self.prepare_state, torch.cat([z, x], 1))
+        return h, c, mu, logvar
+
+
+class KeywordCategoryEncode(nn.Module):
+    r""" model_cvae和model_seq的encode图：post、关键词、类别 -> 解码器初始状态、注意力的输入(和先验) """
+    def __init__(self, model, embedding, with_prior):
+        super(KeywordCategoryEncode, self).__init__()
+        self.with_prior = with_prior
+        self.embedding = embedding
+        self.post_encoder = OnnxEncoder(model.post_encoder)
+        self.keyword_encoder = OnnxEncoder(model.keyword_encoder)
+        self.category_encoder = OnnxEncoder(model.category_encoder)
+        self.atten_category_keywords = model.atten_category_keywords
+        self.prepare_state = model.prepare_state
+        self.decoder = model.decoder
+        if with_prior:
+            self.post_category_keywords = model.post_category_keywords
+            self.prior_net = model.prior_net
+
+    def forward(self, posts, len_posts, keywords, len_keywords, category, len_category, sampled_latents):
+        memory, state_posts, _ = self.post_encoder(self.embedding(posts).transpose(0, 1), len_posts)
+        _, _, cell_keywords = self.keyword_encoder(self.embedding(keywords).transpose(0, 1), len_keywords)
+        _, state_category, _ = self.category_encoder(self.embedding(category).transpose(0, 1), len_category)
+        x = state_posts[-1]  # [batch, dim]
+        # 原模型关键词取的是LSTM的c
+        category_keyword = self.atten_category_keywords(torch.cat([cell_keywords[-1], state_category[-1]], 1))
+        attention = self.decoder.prepare_memory(memory, len_posts)  # 和原模型一样每个序列只投影一次
+        if not self.with_prior:  # model_seq
+            h, c = initial_state(self.prepare_state, torch.cat([x, category_keyword], 1))
+            return h, c, memory, attention.keys, attention.bias
+
+        x = self.post_category_keywords(torch.cat([x, category_keyword], 1))
+        mu, logvar = self.prior_net(x)  # p(z|x) [batch, latent]
+        z = mu + (0.5 * logvar).exp() * sampled_latents
+        h, c = initial_state(self.prepare_state, torch.cat([z, x], 1))
+        return h, c, memory, attention.keys, attention.bias, mu, logvar
+
+
+class DecoderStep(nn.Module):
+    r""" step图：上一步的词和状态 -> 下一个词的log概率和新状态 """
+    def __init__(self, model, embedding):
+        super(DecoderStep, self).__init__()
+        self.embedding = embedding
+        self.rnn_cell = model.decoder.rnn_cell
+        self.cell_type = model.decoder.cell_type
+        self.projector = model.projector[0]
+
+    def rnn_step(self, token, h, c):
+        x = self.embedding(token).unsqueeze(0)  # [1, batch, embed_size]
+        if self.cell_type == 'LSTM':
+            output, (h, c) = self.rnn_cell(x, (h, c))
+        else:
+            output, h = self.rnn_cell(x, h)
+        return output, h, c  # output: [1, batch, dim_out]
+
+    def forward(self, token,  # [batch]
+                h,  # [num_layers, batch, dim_out]
+                c):  # [num_layers, batch, dim_out]
+        output, h, c = self.rnn_step(token, h, c)
+        return F.log_softmax(self.projector(output.squeeze(0)), -1), h, c
+
+
+class AttentionDecoderStep(DecoderStep):
+    r""" Decoder_attention的一步，直接调用原解码器，注意力的key和mask由encode图给出 """
+    def __init__(self, model, embedding):
+        super(AttentionDecoderStep, self).__init__(model, embedding)
+        self.decoder = model.decoder
+
+    def forward(self, token, h, c,
+                memory,  # encode图输出的post编码 [seq, batch, dim]
+                keys,  # 投影好的key [seq, batch, dim]
+                attn_bias):  # padding位置为-inf [seq, batch]
+        x = self.embedding(token).unsqueeze(0)  # [1, batch, embed_size]
+        state = (h, c) if self.cell_type == 'LSTM' else h
+        output, state = self.decoder(x, state, AttentionMemory(memory, keys, attn_bias))  # [1, batch, dim_out]
+        h, c = state if self.cell_type == 'LSTM' else (state, state)
+        return F.log_softmax(self.projector(output.squeeze(0)), -1), h, c
+
+
+# 每种模型encode图的输入和输出名，step图的输入输出见export_onnx
+MEMORY_NAMES = ['memory', 'keys', 'attn_bias']  # 解码每一步都要传给step图的注意力输入，第1维是batch
+ENCODE_SPECS = {
+    'topic_control': (['posts', 'len_posts', 'keywords', 'len_keywords', 'topic', 'sampled_latents'],
+                      ['h', 'c', 'mu', 'logvar']),
+    'cvae': (['posts', 'len_posts', 'keywords', 'len_keywords', 'category', 'len_category', 'sampled_latents'],
+             ['h', 'c', 'memory', 'keys', 'attn_bias', 'mu', 'logvar']),
+    'seq': (['posts', 'len_posts', 'keywords', 'len_keywords', 'category', 'len_category', 'sampled_latents'],
+            ['h', 'c', 'memory', 'keys', 'attn_bias']),
+}
+
+
+def onnx_modules(model, word2vec, variant):
+    r""" 构造(encode模块, step模块)，variant in ENCODE_SPECS """
+    model = copy.deepcopy(model).cpu().eval()  # 不和训练中的模型共享参数
+    embedding = nn.Embedding.from_pretrained(embedding_table(word2vec, model.config.num_vocab), freeze=True)
+    if variant == 'topic_control':
+        return TopicControlEncode(model, embedding).eval(), DecoderStep(model, embedding).eval()
+    encode = KeywordCategoryEncode(model, embedding, with_prior=(variant == 'cvae'))
+    return encode.eval(), AttentionDecoderStep(model, embedding).eval()
+
+
+def export_onnx(model, word2vec, variant, output_dir, example_inputs, opset_version=12):
+    r""" 导出encode.onnx和step.onnx，example_inputs为encode图的输入字典，配置写在config.json """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    encode, step = onnx_modules(model, word2vec, variant)
+    input_names, output_names = ENCODE_SPECS[variant]
+
+    batch_axes = {'posts': {0: 'batch', 1: 'len_post'}, 'keywords': {0: 'batch', 1: 'num_keywords'},
+                  'category': {0: 'batch', 1: 'len_category'}, 'topic': {0: 'batch'},
+                  'len_posts': {0: 'batch'}, 'len_keywords': {0: 'batch'}, 'len_category': {0: 'batch'},
+                  'sampled_latents': {0: 'batch'}, 'h': {1: 'batch'}, 'c': {1: 'batch'},
+                  'memory': {0: 'len_post', 1: 'batch'}, 'keys': {0: 'len_post', 1: 'batch'},
+                  'attn_bias': {0: 'len_post', 1: 'batch'}, 'mu': {0: 'batch'}, 'logvar': {0: 'batch'}}
+    encode_inputs = tuple(example_inputs[name].cpu() for name in input_names)
+    with torch.no_grad():
+        torch.onnx.export(encode, encode_inputs, os.path.join(output_dir, 'encode.onnx'),
+                          input_names=input_names, output_names=output_names,
+                          dynamic_axes={name: batch_axes[name] for name in input_names + output_names},
+                          opset_version=opset_version)
+        encoded = dict(zip(output_names, encode(*encode_inputs)))
+
+        step_inputs = ['token', 'h', 'c'] + [name for name in MEMORY_NAMES if name in output_names]
+        step_outputs = ['log_probs', 'h_out', 'c_out']
+        token = torch.full((encoded['h'].size(1),), model.config.start_id, dtype=torch.long)
+        torch.onnx.export(step, tuple([token] + [encoded[name] for name in step_inputs[1:]]),
+                          os.path.join(output_dir, 'step.onnx'),
+                          input_names=step_inputs, output_names=step_outputs,
+                          dynamic_axes=dict({name: batch_axes[name] for name in step_inputs[1:]},
+                                            token={0: 'batch'}, log_probs={0: 'batch'},
+                                            h_out={1: 'batch'}, c_out={1: 'batch'}),
+                          opset_version=opset_version)
+
+    config = {key: getattr(model.config, key) for key in dir(model.config) if not key.startswith('_')}
+    config['variant'] = variant
+    with open(os.path.join(output_dir, 'config.json'), 'w', encoding='utf8') as fw:
+        json.dump(config, fw, ensure_ascii=False, indent=2)
+    return encode, step
@@ -0,0 +1,20 @@
+import torch
+
+
+class MixedPrecision(object):
+    r""" 混合精度训练：cpu上用bf16，gpu上用fp16并用GradScaler缩放损失；enabled=False时和float32训练完全一样 """
+    def __init__(self, enabled,  # 是否开启
+                 gpu):  # 是否在gpu上训练
+        self.enabled = enabled
+        self.device_type = 'cuda' if gpu else 'cpu'
+        self.dtype = torch.float16 if gpu else torch.bfloat16
+        # bf16的指数范围和float32一样，不需要缩放损失
+        self.scaler = torch.cuda.amp.GradScaler(enabled=enabled and gpu)
+
+    def autocast(self):
+        r""" 前向传播的上下文，里面的矩阵乘法、rnn等按self.dtype计算 """
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def backward(self, loss):
+        r""" 反向传播，fp16时先放大损失防止梯度下溢 """
+        self.scaler.scale(loss).backward()
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from model.util.checkpoint import save_checkpoint
+
+
+class AsyncCheckpointWriter(object):
+    r""" 先把参数拷到cpu上的缓冲区，再由后台线程写文件(先写临时文件再改名)。
+    缓冲区有max_in_flight份，都在写的时候下一次保存会等最早的一次写完；keep_last>0时只保留最近的keep_last个文件 """
+    def __init__(self, max_in_flight=2,  # 最多同时有几次保存没写完
+                 keep_last=0,  # 保留最近几个模型文件，0表示全部保留
+                 enabled=True):  # False时和model.save_model一样同步保存
+        assert max_in_flight >= 1
+        self.max_in_flight = max_in_flight
+        self.keep_last = keep_last
+        self.enabled = enabled
+        self.executor = ThreadPoolExecutor(max_workers=1)  # 一个线程按顺序写，保留策略才不会乱
+        self.slots = threading.Semaphore(max_in_flight)
+        self.free_buffers = [{} for _ in range(max_in_flight)]  # 每份缓冲区: 名字 -> cpu张量，形状不变时重复使用
+        self.lock = threading.Lock()
+        self.pending = []
+        self.saved_paths = []
+        self.snapshot_time = 0  # 训练线程上拷贝和等待花的时间
+        self.write_time = 0  # 后台写文件花的时间
+
+    def save(self, model, epoch, global_step, path):
+        r""" 拷贝完参数就返回，之后训练可以继续更新参数 """
+        start_time = time.time()
+        if not self.enabled:
+            model.save_model(epoch, global_step, path)
+            self._retain(path)
+            self.snapshot_time += time.time() - start_time
+            return
+        for future in self.pending:
+            if future.done():
+                future.result()  # 之前的保存出错在这里抛出
+        self.pending = [future for future in self.pending if not future.done()]
+        self.slots.acquire()  # 缓冲区都在用时等最早的一次写完
+        with self.lock:
+            buffers = self.free_buffers.pop()
+        try:
+            snapshot = self._snapshot(model.checkpoint_dict(epoch, global_step), buffers)
+            self.pending.append(self.executor.submit(self._write, snapshot, path, buffers))
+        except BaseException:  # 没交给后台线程时要自己还回缓冲区，否则之后的保存会一直等
+            with self.lock:
+                self.free_buffers.append(buffers)
+            self.slots.release()
+            raise
+        self.snapshot_time += time.time() - start_time
+
+    def _snapshot(self, checkpoint, buffers):
+        snapshot = {}
+        for name, value in checkpoint.items():
+            if isinstance(value, dict):  # state_dict
+                snapshot[name] = {key: self._copy(f'{name}.{key}', tensor, buffers) for key, tensor in value.items()}
+            elif isinstance(value, torch.Tensor):
+                copy = self._copy(name, value, buffers)
+                if isinstance(value, torch.nn.Parameter):  # 保持参数的标记，不额外拷贝
+                    copy = torch.nn.Parameter(copy, requires_grad=value.requires_grad)
+                snapshot[name] = copy
+            else:
+                snapshot[name] = value
+        return snapshot
+
+    @staticmethod
+    def _copy(name, tensor, buffers):
+        tensor = tensor.detach()
+        buffer = buffers.get(name)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            # gpu上的参数拷到锁页内存更快
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=tensor.is_cuda)
+            buffers[name] = buffer
+        buffer.copy_(tensor)
+        return buffer
+
+    def _write(self, snapshot, path, buffers):
+        start_time = time.time()
+        try:
+            save_checkpoint(snapshot, path)
+            self._retain(path)
+        finally:
+            with self.lock:
+                self.free_buffers.append(buffers)
+            self.slots.release()
+            self.write_time += time.time() - start_time
+
+    def _retain(self, path):
+        self.saved_paths.append(path)
+        while self.keep_last > 0 and len(self.saved_paths) > self.keep_last:
+            old_path = self.saved_paths.pop(0)
+            if os.path.exists(old_path) and old_path != path:
+                os.remove(old_path)
+
+    def wait(self):
+        r""" 等所有保存写完，写文件时的异常在这里抛出 """
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
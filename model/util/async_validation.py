@@ -0,0 +1,123 @@
+import copy
+import queue
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+
+class AsyncValidator(object):
+    r""" 在另一个进程里用参数快照验证，训练不用等验证结束。快照放在max_pending份共享内存的模型副本里，
+    验证进程取走快照后副本就可以再用；副本都没被取走时下一次提交会等。结果带着提交时的global_step取回。
+    验证进程用spawn启动，evaluate要放在能导入的模块里，词向量、设置等都从evaluate_args传入，不依赖驱动脚本的全局变量 """
+    def __init__(self, model, evaluate,  # evaluate(model, *evaluate_args, global_step, quick)，要能被pickle(可导入模块里的函数)
+                 evaluate_args=(),
+                 max_pending=2,  # 最多有几份快照等着验证
+                 enabled=True):  # False时在当前进程同步验证，调用方式不变
+        assert max_pending >= 1
+        self.evaluate = evaluate
+        self.evaluate_args = evaluate_args
+        self.enabled = enabled
+        self.results = []  # 已经取回、还没交给调用方的结果 (global_step, quick, metrics)
+        self.pending = 0  # 提交了还没出结果的次数
+        if not enabled:
+            return
+        state_cache = getattr(model, 'state_cache', None)
+        model.state_cache = None  # 编码状态缓存不跟着快照复制
+        try:
+            snapshot = copy.deepcopy(model).cpu().eval()
+        finally:
+            model.state_cache = state_cache
+        self.slots = [snapshot] + [copy.deepcopy(snapshot) for _ in range(max_pending - 1)]
+        for slot in self.slots:
+            slot.share_memory()
+        self.free_slots = list(range(max_pending))
+        device = next(model.parameters()).device
+        context = mp.get_context('spawn')
+        self.jobs = context.Queue()
+        self.messages = context.Queue()
+        self.process = context.Process(target=_worker, daemon=True,
+                                       args=(self.slots, str(device), evaluate, evaluate_args, self.jobs, self.messages))
+        self.process.start()
+
+    def submit(self, model, global_step,
+               quick=False):  # 是否只在抽样的验证集上验证，由evaluate决定怎么抽样
+        r""" 拷贝完参数就返回 """
+        if not self.enabled:
+            training = model.training
+            model.eval()
+            try:
+                self.results.append((global_step, quick,
+                                     self.evaluate(model, *self.evaluate_args, global_step, quick)))
+            finally:
+                model.train(training)
+            return
+        while not self.free_slots:  # 快照都还没被取走
+            self._receive(block=True)
+        slot = self.free_slots.pop()
+        with torch.no_grad():
+            for target, source in zip(self.slots[slot].state_dict().values(), model.state_dict().values()):
+                target.copy_(source)
+        self.jobs.put((slot, global_step, quick))
+        self.pending += 1
+
+    def poll(self):
+        r""" 返回已经验证完的结果，不等待。验证进程里的异常在这里抛出 """
+        if self.enabled:
+            while self._receive(block=False):
+                pass
+        results, self.results = self.results, []
+        return results
+
+    def wait(self):
+        r""" 等所有提交的快照验证完，返回结果 """
+        if self.enabled:
+            while self.pending > 0:
+                self._receive(block=True)
+        return self.poll()
+
+    def close(self):
+        r""" 等验证完再结束验证进程，返回剩下的结果 """
+        results = self.wait()
+        if self.enabled and self.process.is_alive():
+            self.jobs.put(None)
+            self.process.join()
+        return results
+
+    def _receive(self, block):
+        while True:
+            try:
+                message = self.messages.get(block=block, timeout=1)
+                break
+            except queue.Empty:
+                if not block:
+                    return False
+                if not self.process.is_alive():  # 比如显存不够被杀掉，不能一直等
+                    raise RuntimeError(f'验证进程意外退出，exitcode={self.process.exitcode}')
+        if message[0] == 'free':
+            self.free_slots.append(message[1])
+        elif message[0] == 'result':
+            self.pending -= 1
+            self.results.append(message[1:])
+        else:
+            self.pending -= 1
+            raise RuntimeError('验证进程出错:\n' + message[1])
+        return True
+
+
+def _worker(slots, device, evaluate, evaluate_args, jobs, messages):
+    model = copy.deepcopy(slots[0]).to(device).eval()  # 验证用的私有副本，共享内存的快照拷进来就可以再用
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        slot, global_step, quick = job
+        try:
+            model.load_state_dict(slots[slot].state_dict())
+        finally:
+            messages.put(('free', slot))
+        try:
+            with torch.no_grad():
+                metrics = evaluate(model, *evaluate_args, global_step, quick)
+            messages.put(('result', global_step, quick, metrics))
+        except Exception:
+            messages.put(('error', traceback.format_exc()))
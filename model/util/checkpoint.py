@@ -0,0 +1,165 @@
+import json
+import mmap
+import os
+import struct
+import numpy as np
+import torch
+
+MAGIC = b'TPCKPT01'  # 文件头，用来和torch.save的旧格式区分
+ALIGNMENT = 64  # 每个张量的起始位置按64字节对齐
+
+# torch类型 -> 同样字节数的numpy类型，bfloat16按int16存取再view回来
+DTYPES = {'float32': (torch.float32, np.float32), 'float16': (torch.float16, np.float16),
+          'bfloat16': (torch.bfloat16, np.int16), 'float64': (torch.float64, np.float64),
+          'int64': (torch.int64, np.int64), 'int32': (torch.int32, np.int32), 'int16': (torch.int16, np.int16),
+          'int8': (torch.int8, np.int8), 'uint8': (torch.uint8, np.uint8), 'bool': (torch.bool, np.bool_)}
+
+
+def is_checkpoint(path):
+    r""" 是否是save_checkpoint写的文件 """
+    with open(path, 'rb') as fr:
+        return fr.read(len(MAGIC)) == MAGIC
+
+
+def save_checkpoint(checkpoint,  # 同save_model里torch.save的字典：子模块名 -> state_dict、张量或者普通的值
+                    path):
+    r""" 文件头 + json索引 + 对齐的张量数据。张量一律以cpu上连续的形式写入，读的时候可以放到任意设备上 """
+    index, meta, tensors = {}, {}, []
+    offset = 0
+    for name, value in checkpoint.items():
+        if isinstance(value, dict) and all(isinstance(v, torch.Tensor) for v in value.values()):  # state_dict
+            group = {}
+            for key, tensor in value.items():
+                group[key], offset = _entry(tensor, offset, tensors)
+            index[name] = {'tensors': group}
+        elif isinstance(value, torch.Tensor):
+            entry, offset = _entry(value, offset, tensors)
+            index[name] = {'tensor': entry, 'parameter': isinstance(value, torch.nn.Parameter),
+                           'requires_grad': value.requires_grad}
+        else:
+            meta[name] = value
+    header = json.dumps({'index': index, 'meta': meta}, ensure_ascii=False).encode('utf8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fw:
+        fw.write(MAGIC)
+        fw.write(struct.pack('<Q', len(header)))
+        fw.write(header)
+        fw.write(b'\0' * (data_start - fw.tell()))
+        for entry, tensor in tensors:
+            fw.write(b'\0' * (data_start + entry['offset'] - fw.tell()))
+            fw.write(_to_bytes(tensor))
+    os.replace(tmp_path, path)  # 写完再改名，中途失败不会留下半个文件
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _entry(tensor, offset, tensors):
+    tensor = tensor.detach().cpu().contiguous()
+    dtype = str(tensor.dtype).replace('torch.', '')
+    assert dtype in DTYPES, f'不支持的类型{tensor.dtype}'
+    entry = {'dtype': dtype, 'shape': list(tensor.shape), 'offset': offset,
+             'nbytes': tensor.numel() * tensor.element_size()}
+    tensors.append((entry, tensor))
+    return entry, _align(offset + entry['nbytes'])
+
+
+def _to_bytes(tensor):
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy().tobytes()
+
+
+class CheckpointReader(object):
+    r""" 按需读取save_checkpoint的文件：只解析索引，张量在被访问时才从内存映射里取出，可以当字典用 """
+    def __init__(self, path,
+                 map_location='cpu'):  # 张量放到哪个设备上
+        self.path = path
+        self.map_location = map_location
+        with open(path, 'rb') as fr:
+            assert fr.read(len(MAGIC)) == MAGIC, f'{path}不是save_checkpoint写的文件'
+            header_size, = struct.unpack('<Q', fr.read(8))
+            header = json.loads(fr.read(header_size).decode('utf8'))
+            # ACCESS_COPY: 读到的页按需换入，修改也不会写回文件
+            self.buffer = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.index = header['index']
+        self.meta = header['meta']
+        self.data_start = _align(len(MAGIC) + 8 + header_size)
+        self.loaded_bytes = 0  # 实际取出的张量字节数
+
+    def tensor(self, entry):
+        torch_dtype, numpy_dtype = DTYPES[entry['dtype']]
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        array = np.frombuffer(self.buffer, numpy_dtype, count, self.data_start + entry['offset'])
+        tensor = torch.from_numpy(array).view(torch_dtype).reshape(entry['shape'])
+        self.loaded_bytes += entry['nbytes']
+        if self.map_location is not None and torch.device(self.map_location).type != 'cpu':
+            tensor = tensor.to(self.map_location)
+        return tensor
+
+    def __getitem__(self, name):
+        if name in self.meta:
+            return self.meta[name]
+        item = self.index[name]
+        if 'tensors' in item:  # state_dict
+            return {key: self.tensor(entry) for key, entry in item['tensors'].items()}
+        tensor = self.tensor(item['tensor'])
+        if item['parameter']:
+            return torch.nn.Parameter(tensor, requires_grad=item['requires_grad'])
+        return tensor
+
+    def __contains__(self, name):
+        return name in self.meta or name in self.index
+
+    def keys(self):
+        return list(self.index.keys()) + list(self.meta.keys())
+
+    def close(self):
+        self.buffer.close()
+
+
+def load_checkpoint(path, map_location='cpu'):
+    r""" 新格式返回CheckpointReader，旧的torch.save文件用map_location载入，gpu上保存的模型也能在cpu上读 """
+    if is_checkpoint(path):
+        return CheckpointReader(path, map_location)
+    return torch.load(path, map_location=map_location)
+
+
+def export_inference(model, path,
+                     epoch=0, global_step=0,
+                     half=False):  # 浮点参数是否存成float16，载入时转回模型的类型
+    r""" 只保存生成用得到的部分(去掉model.TRAINING_ONLY)，并记下模型配置 """
+    checkpoint = {}
+    for name, module in model.checkpoint_modules().items():
+        if name in model.TRAINING_ONLY:
+            continue
+        state_dict = module.state_dict()
+        if half:
+            state_dict = {key: _half(value) for key, value in state_dict.items()}
+        checkpoint[name] = state_dict
+    config = model.config
+    checkpoint.update({'epoch': epoch,
+                       'global_step': global_step,
+                       'inference_only': True,
+                       'half': half,
+                       'config': {key: getattr(config, key) for key in dir(config) if not key.startswith('_')}})
+    save_checkpoint(checkpoint, path)
+
+
+def _half(tensor):
+    r""" 浮点张量转float16，超出float16范围的(比如没有初始化过的参数)保留原类型 """
+    if not tensor.is_floating_point() or tensor.numel() == 0:
+        return tensor
+    if not torch.isfinite(tensor).all() or tensor.abs().max() > torch.finfo(torch.float16).max:
+        return tensor
+    return tensor.half()
+
+
+def drop_training_only(model):
+    r""" 只做生成时释放model.TRAINING_ONLY里的子模块和参数，减少常驻内存，之后不能再训练 """
+    for name in model.TRAINING_ONLY:
+        setattr(model, name, None)
+    return model
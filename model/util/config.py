@@ -7,6 +7,7 @@ class Config(object):
     unk_id = 3
 
     nClusters = 4
+    gmm_em_passes = 2  # 流式EM初始化GMM时遍历数据的次数
 
     # 词汇表大小，根据预处理截取的词汇表设置
     num_vocab = 6918
@@ -50,5 +51,9 @@ class Config(object):
     kl_step = 10000  # 更新多少次参数之后kl项权值达到1
     dropout = 0.0  # 这里只有编解码器设置了dropout
 
+    # 层级编码器参数
+    global_sem_refresh_steps = 1  # 训练时全局语义向量每隔多少个batch重新编码一次，1为每个batch都编码，大于1时中间的batch用旧值
+    level_encoder_chunk_size = 256  # 词级编码时每块的句子数，峰值显存由它决定，<=0为整个语料一次编码
+
 
 
@@ -4,17 +4,31 @@ import random
 
 class DataProcessor(object):
     r""" 实现数据的预处理 """
-    def __init__(self, data, batch_size, sp, shuffle=True):
+    def __init__(self, data, batch_size, sp, shuffle=True,
+                 rank=0, world_size=1, seed=0):  # 多进程训练时本进程的编号、进程数和打乱顺序的随机种子
         self.sp = sp
         self.data = data
         self.batch_size = batch_size
         self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0  # 第几次遍历数据
 
     def get_batch_data(self):
         r""" 输出一个batch预处理的样本 """
+        data = self.data
         if self.shuffle:
-            random.shuffle(self.data)
-        it = DataIterator(self.data, self.batch_size)
+            if self.world_size > 1:  # 所有进程按同样的顺序打乱，再各取一份
+                random.Random(self.seed + self.epoch).shuffle(data)
+            else:
+                random.shuffle(data)
+        self.epoch += 1
+        if self.world_size > 1:
+            if self.shuffle:  # 训练时每个进程的batch数要相同，除不尽的样本这一轮不用
+                data = data[:len(data) // self.world_size * self.world_size]
+            data = data[self.rank::self.world_size]
+        it = DataIterator(data, self.batch_size)
 
         for batch_data in it.get_batch_data():
             str_posts, str_responses, str_responses_act, str_responses_emotion, str_keyword = [], [], [], [], []  # post和response的str表示
@@ -0,0 +1,99 @@
+import contextlib
+import os
+import socket
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def init_distributed(backend='gloo'):
+    r""" 按环境变量RANK/WORLD_SIZE(torchrun或launch设置)初始化进程组，返回(rank, world_size)，单进程时返回(0, 1) """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend, rank=int(os.environ['RANK']), world_size=world_size)
+    return dist.get_rank(), world_size
+
+
+def is_main_process():
+    r""" 只有rank 0写tensorboard、打印和保存模型 """
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def all_reduce_sum(values):  # 每个进程上的若干个数
+    r""" 所有进程上对应位置的数求和，单进程时原样返回 """
+    if not dist.is_initialized():
+        return [float(v) for v in values]
+    tensor = torch.tensor([float(v) for v in values], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def all_reduce_min(values):  # 每个进程上的若干个数
+    r""" 所有进程上对应位置的数取最小值，单进程时原样返回 """
+    if not dist.is_initialized():
+        return [float(v) for v in values]
+    tensor = torch.tensor([float(v) for v in values], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+    return tensor.tolist()
+
+
+def broadcast_object(obj):
+    r""" 所有进程都用rank 0上的obj(能被pickle)，单进程时原样返回 """
+    if not dist.is_initialized():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def all_mean(*arrays):  # 每个进程上自己那部分样本的指标 [num_examples]
+    r""" 所有进程的样本合在一起求平均 """
+    arrays = [np.asarray(a, dtype=np.float64) for a in arrays]
+    totals = all_reduce_sum([a.sum() for a in arrays] + [arrays[0].size])
+    return [total / max(totals[-1], 1) for total in totals[:-1]]
+
+
+def sync_context(model, sync):
+    r""" 累积梯度时不是最后一个micro-batch就不做all-reduce，model不是DistributedDataParallel时什么都不做 """
+    if sync or not isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return contextlib.suppress()
+    return model.no_sync()
+
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+
+def cleanup():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def free_port():
+    r""" 找一个本机空闲端口给进程组通信 """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _worker(rank, world_size, fn, fn_args):
+    os.environ['RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+    os.environ['LOCAL_RANK'] = str(rank)
+    try:
+        fn(*fn_args)
+    finally:
+        cleanup()
+
+
+def launch(fn, num_processes, *fn_args):
+    r""" 在本机起num_processes个进程运行fn(*fn_args)，每个进程先调用init_distributed。num_processes<=1时直接运行 """
+    if num_processes <= 1 or 'WORLD_SIZE' in os.environ:  # 已经是多进程中的一个(比如用torchrun启动)
+        return fn(*fn_args)
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(free_port()))
+    mp.spawn(_worker, args=(num_processes, fn, fn_args), nprocs=num_processes, join=True)
@@ -0,0 +1,103 @@
+import math
+import torch
+
+
+def gaussian_pdfs_log(x,  # [batch, latent]
+                      mu_c,  # 每个簇的均值 [nClusters, latent]
+                      log_sigma2_c):  # 每个簇的log方差 [nClusters, latent]
+    r""" 一次广播计算x在所有对角高斯簇下的log概率密度 [batch, nClusters] """
+    x = x.unsqueeze(1)  # [batch, 1, latent]
+    mu_c = mu_c.unsqueeze(0)  # [1, nClusters, latent]
+    log_sigma2_c = log_sigma2_c.unsqueeze(0)  # [1, nClusters, latent]
+    return -0.5 * torch.sum(math.log(math.pi * 2) + log_sigma2_c + (x - mu_c).pow(2) / log_sigma2_c.exp(), 2)
+
+
+def gmm_log_responsibility(z,  # [batch, latent]
+                           pi,  # 簇的先验概率 [nClusters]
+                           mu_c,  # [nClusters, latent]
+                           log_sigma2_c):  # [nClusters, latent]
+    r""" log q(c|z)，在log空间用log-sum-exp归一化，高维潜变量下不会因exp下溢而全为0 [batch, nClusters] """
+    logits = torch.log(pi).unsqueeze(0) + gaussian_pdfs_log(z, mu_c, log_sigma2_c)  # log p(c) + log p(z|c)
+    return logits - torch.logsumexp(logits, 1, keepdim=True)
+
+
+def gmm_vae_loss(z,  # 采样的潜变量 [batch, latent]
+                 mu,  # 后验均值 [batch, latent]
+                 logvar,  # 后验log方差 [batch, latent]
+                 pi,  # [nClusters]
+                 mu_c,  # [nClusters, latent]
+                 log_sigma2_c):  # [nClusters, latent]
+    r""" GMM先验下ELBO的潜变量部分，一次计算完所有项，返回(损失, q(c|z) [batch, nClusters]) """
+    log_yita_c = gmm_log_responsibility(z, pi, mu_c, log_sigma2_c)  # [batch, nClusters]
+    yita_c = log_yita_c.exp()
+
+    logvar = logvar.unsqueeze(1)  # [batch, 1, latent]
+    mu = mu.unsqueeze(1)  # [batch, 1, latent]
+    mu_c = mu_c.unsqueeze(0)  # [1, nClusters, latent]
+    log_sigma2_c = log_sigma2_c.unsqueeze(0)  # [1, nClusters, latent]
+
+    # E_q(c|z)[-log p(z|c)]，去掉常数项
+    kld_c = torch.sum(log_sigma2_c + torch.exp(logvar - log_sigma2_c) + (mu - mu_c).pow(2) / log_sigma2_c.exp(), 2)
+    loss = 0.5 * torch.mean(torch.sum(yita_c * kld_c, 1))
+    # -KL(q(c|z)||p(c)) 和 q(z|x,y)的熵
+    loss -= torch.mean(torch.sum(yita_c * (torch.log(pi).unsqueeze(0) - log_yita_c), 1)) \
+        + 0.5 * torch.mean(torch.sum(1 + logvar.squeeze(1), 1))
+    return loss, yita_c
+
+
+class StreamingGMM(object):
+    r""" 对角协方差GMM的在线(stepwise)EM，逐batch更新充分统计量，内存和数据集大小无关 """
+    def __init__(self, n_components,  # 簇数
+                 latent_size,  # 潜变量维度
+                 kappa=0.6,  # 步长衰减指数，步长为(t+2)^-kappa，取值(0.5, 1]
+                 reg_covar=1e-6):  # 方差下限，防止方差退化为0
+        self.n_components = n_components
+        self.latent_size = latent_size
+        self.kappa = kappa
+        self.reg_covar = reg_covar
+        self.num_steps = 0  # 已经更新的batch数
+        self.pi = None  # [nClusters]
+        self.mu = None  # [nClusters, latent]
+        self.var = None  # [nClusters, latent]
+
+    def _init_params(self, z):  # [batch, latent]
+        r""" 用第一个batch初始化：随机取样本作为均值，方差取样本方差 """
+        index = torch.randint(z.size(0), (self.n_components,), device=z.device)
+        self.pi = z.new_full((self.n_components,), 1.0 / self.n_components)
+        self.mu = z[index] + 1e-3 * torch.randn_like(z[index])  # 加扰动防止重复样本得到相同的簇
+        self.var = z.var(0, unbiased=False).clamp_min(self.reg_covar).unsqueeze(0).repeat(self.n_components, 1)
+        # 归一化的充分统计量
+        self.s0 = self.pi.clone()  # E[q(c|z)]
+        self.s1 = self.pi.unsqueeze(1) * self.mu  # E[q(c|z)z]
+        self.s2 = self.pi.unsqueeze(1) * (self.var + self.mu.pow(2))  # E[q(c|z)z^2]
+
+    def partial_fit(self, z):  # [batch, latent]
+        r""" 用一个batch做一步EM，返回这个batch在更新前参数下的簇分配 [batch] """
+        with torch.no_grad():
+            z = z.detach().double()
+            if self.pi is None:
+                self._init_params(z)
+
+            # E步
+            log_resp = gmm_log_responsibility(z, self.pi, self.mu, self.var.log())  # [batch, nClusters]
+            resp = log_resp.exp()
+
+            # 用步长把batch统计量融合进充分统计量
+            rho = (self.num_steps + 2) ** -self.kappa
+            self.num_steps += 1
+            self.s0 = (1 - rho) * self.s0 + rho * resp.mean(0)
+            self.s1 = (1 - rho) * self.s1 + rho * resp.t().mm(z) / z.size(0)
+            self.s2 = (1 - rho) * self.s2 + rho * resp.t().mm(z.pow(2)) / z.size(0)
+
+            # M步
+            s0 = self.s0.clamp_min(1e-10).unsqueeze(1)  # [nClusters, 1]
+            self.pi = self.s0 / self.s0.sum()
+            self.mu = self.s1 / s0
+            self.var = (self.s2 / s0 - self.mu.pow(2)).clamp_min(self.reg_covar)
+            return log_resp.argmax(1)
+
+    def assign(self, pi_, mu_c, log_sigma2_c):
+        r""" 把拟合结果直接写入模型的GMM参数 """
+        pi_.data = self.pi.to(device=pi_.device, dtype=pi_.dtype)
+        mu_c.data = self.mu.to(device=mu_c.device, dtype=mu_c.dtype)
+        log_sigma2_c.data = self.var.log().to(device=log_sigma2_c.device, dtype=log_sigma2_c.dtype)
@@ -0,0 +1,156 @@
+import os
+import resource
+import threading
+import numpy as np
+import torch
+
+MB = 1024 ** 2
+
+
+def rss_mb():
+    r""" 当前进程的常驻内存(MB)。读/proc/self/statm，没有时(非linux)用进程的峰值RSS代替 """
+    try:
+        with open('/proc/self/statm', 'r') as fr:
+            return int(fr.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def available_memory_mb(gpu=False):
+    r""" 当前还能用的显存(gpu)或系统内存(MB) """
+    if gpu:
+        return torch.cuda.mem_get_info()[0] / MB
+    try:
+        with open('/proc/meminfo', 'r') as fr:
+            for line in fr:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / MB
+
+
+class PeakMemory(object):
+    r""" 进入到退出之间比base多用的峰值内存(MB)，退出后在peak_mb里。gpu上用max_memory_allocated，是准确值；
+    cpu上由后台线程每interval秒采样一次RSS，很短的峰值可能漏掉 """
+    def __init__(self, gpu=False,
+                 base=None,  # 基数(MB)，None时为进入时的用量。cpu上连续测多次时应该用同一个基数，释放的内存不一定还给系统
+                 interval=0.001):
+        self.gpu = gpu
+        self.base = base
+        self.interval = interval
+        self.peak_mb = None
+
+    def __enter__(self):
+        if self.gpu:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            if self.base is None:
+                self.base = torch.cuda.memory_allocated() / MB
+        else:
+            if self.base is None:
+                self.base = rss_mb()
+            self.peak = rss_mb()
+            self.stop = threading.Event()
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+        return self
+
+    def _sample(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def __exit__(self, *exc):
+        if self.gpu:
+            torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated() / MB
+        else:
+            self.stop.set()
+            self.sampler.join()
+            peak = max(self.peak, rss_mb())
+        self.peak_mb = max(peak - self.base, 0.0)
+        return False
+
+
+def is_out_of_memory(e):
+    return isinstance(e, MemoryError) or (isinstance(e, RuntimeError) and 'out of memory' in str(e).lower())
+
+
+def profile_memory(step,  # step(batch_size, seq_len)：做一次前向和反向，结束时清掉梯度
+                   batch_sizes, seq_lens, gpu=False):
+    r""" 测每个(batch大小, 回复长度)下一次前向+反向的峰值内存，返回[{'batch_size', 'seq_len', 'peak_mb'}]。
+    按样本数*长度从小到大测，都相对开始前的用量；内存不够时peak_mb记为None，更大的组合不再测。
+    cpu上超出内存时进程可能直接被系统杀掉，所以应该在预算内测几个小的组合，再用fit_memory外推 """
+    grid = sorted([(batch_size, seq_len) for batch_size in batch_sizes for seq_len in seq_lens],
+                  key=lambda size: (size[0] * size[1], size))
+    base = torch.cuda.memory_allocated() / MB if gpu else rss_mb()
+    failed = []  # 内存不够的组合
+    records = []
+    for batch_size, seq_len in grid:
+        peak_mb = None
+        if not any(batch_size >= failed_batch and seq_len >= failed_len for failed_batch, failed_len in failed):
+            try:
+                with PeakMemory(gpu, base) as peak:
+                    step(batch_size, seq_len)
+                peak_mb = peak.peak_mb
+            except (RuntimeError, MemoryError) as e:
+                if not is_out_of_memory(e):
+                    raise
+                failed.append((batch_size, seq_len))
+                if gpu:
+                    torch.cuda.empty_cache()
+        records.append({'batch_size': batch_size, 'seq_len': seq_len, 'peak_mb': peak_mb})
+    return records
+
+
+def fit_memory(records):
+    r""" 用最小二乘把峰值内存拟合成 fixed + per_example*batch + per_token*batch*长度，返回各系数(MB)。
+    只测了一种长度时无法区分每个样本和每个token的部分，全部算在per_token里 """
+    records = [record for record in records if record['peak_mb'] is not None]
+    assert records, '没有测成功的组合'
+    batch = np.array([record['batch_size'] for record in records], dtype=np.float64)
+    tokens = np.array([record['batch_size'] * record['seq_len'] for record in records], dtype=np.float64)
+    peak = np.array([record['peak_mb'] for record in records], dtype=np.float64)
+    if len(set(record['seq_len'] for record in records)) > 1:
+        features = np.stack([np.ones_like(batch), batch, tokens], 1)
+        fixed, per_example, per_token = np.linalg.lstsq(features, peak, rcond=None)[0]
+    else:
+        features = np.stack([np.ones_like(batch), tokens], 1)
+        (fixed, per_token), per_example = np.linalg.lstsq(features, peak, rcond=None)[0], 0.0
+    return {'fixed_mb': float(fixed), 'per_example_mb': float(per_example), 'per_token_mb': float(per_token)}
+
+
+def predict_memory(fit, batch_size, seq_len):
+    return fit['fixed_mb'] + fit['per_example_mb'] * batch_size + fit['per_token_mb'] * batch_size * seq_len
+
+
+def recommend_batch_size(fit, budget_mb, seq_len,
+                         safety=0.8,  # 只用预算的这个比例，给碎片和拟合误差留余量
+                         reserved_mb=0.0,  # 测的时候还没分配、训练时会一直占着的内存，比如adam的状态
+                         max_batch_size=4096):
+    r""" 回复长度为seq_len时预算内最大的batch大小，一个样本都放不下时返回0 """
+    usable = budget_mb * safety - reserved_mb - fit['fixed_mb']
+    per_example = fit['per_example_mb'] + fit['per_token_mb'] * seq_len
+    if usable <= 0:
+        return 0
+    if per_example <= 0:  # 测的范围内看不出随batch增长，不外推
+        return max_batch_size
+    return int(min(usable // per_example, max_batch_size))
+
+
+def optimizer_state_mb(parameters, method):
+    r""" adam每个参数有两份状态，第一次更新参数时才分配 """
+    if method != 'adam':
+        return 0.0
+    return 2 * sum(param.numel() * param.element_size() for param in parameters if param.requires_grad) / MB
+
+
+def memory_table(records, fit=None):
+    r""" 每个组合的峰值内存，给了fit时一起列出拟合值 """
+    lines = ['{:>8s}{:>10s}{:>14s}{:>14s}'.format('batch', '回复长度', '峰值(MB)', '拟合(MB)')]
+    for record in records:
+        lines.append('{:>8d}{:>10d}{:>14s}{:>14s}'.format(
+            record['batch_size'], record['seq_len'],
+            '{:.1f}'.format(record['peak_mb']) if record['peak_mb'] is not None else '内存不够',
+            '{:.1f}'.format(predict_memory(fit, record['batch_size'], record['seq_len'])) if fit else '-'))
+    return '\n'.join(lines)
@@ -0,0 +1,93 @@
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from model.util.distributed import all_reduce_sum
+
+
+class MetricsAggregator(object):
+    r""" 训练指标在设备上累加，每个记录间隔只同步一次(多进程时顺便把各进程的和加起来)，
+    tensorboard和jsonl由后台线程写。吞吐按整个间隔的墙钟时间计算 """
+    def __init__(self, summary_writer=None,  # 为None时不写tensorboard，比如非rank 0的进程
+                 jsonl_path='',  # 每次记录追加一行json，为空时不写
+                 prefix='train_',  # tensorboard里的名字前缀
+                 exp_keys=('ppl',),  # 累加的是log值，记录时取exp
+                 start_step=0):  # 开始时的global_step，用来算每次更新参数的平均时间
+        self.summary_writer = summary_writer
+        self.jsonl_path = jsonl_path
+        self.prefix = prefix
+        self.exp_keys = exp_keys
+        self.executor = ThreadPoolExecutor(max_workers=1)  # 一个线程按顺序写
+        self.pending = []
+        self.last_step = start_step
+        self._reset()
+
+    def _reset(self):
+        self.names = None  # 设备上累加的指标名
+        self.sums = None  # 设备上的累加 [token数, 各指标之和]
+        self.host_sums = {}  # 本来就在cpu上的数(比如kl权重)，不用同步
+        self.steps = 0
+        self.examples = 0
+        self.start_time = time.time()
+
+    def add(self, examples,  # 这个batch的样本数
+            tokens,  # 这个batch要计算损失的token数，可以是设备上的张量
+            **metrics):  # 每个batch的平均值，张量在设备上累加，python数在cpu上累加
+        tensors = {name: value for name, value in metrics.items() if isinstance(value, torch.Tensor)}
+        if self.names is None:
+            self.names = list(tensors.keys())
+        device = next((value.device for value in tensors.values()), None)
+        values = torch.stack([torch.as_tensor(tokens, dtype=torch.float32, device=device).reshape(())]
+                             + [tensors[name].detach().float().reshape(()) for name in self.names])
+        self.sums = values if self.sums is None else self.sums + values
+        for name, value in metrics.items():
+            if name not in tensors:
+                self.host_sums[name] = self.host_sums.get(name, 0.0) + float(value)
+        self.steps += 1
+        self.examples += examples
+
+    def log(self, global_step, **extra):  # extra: 原样记录的值，比如epoch、lr
+        r""" 同步一次，返回这个间隔的平均指标和吞吐，并交给后台线程写入 """
+        self._raise_errors()
+        names = (self.names or []) + list(self.host_sums.keys())
+        device_sums = self.sums.tolist() if self.sums is not None else [0.0] * (len(self.names or []) + 1)
+        totals = all_reduce_sum(device_sums + [self.host_sums[name] for name in self.host_sums]
+                                + [self.steps, self.examples])
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        tokens, values, (steps, examples) = totals[0], totals[1:-2], totals[-2:]
+        record = {'global_step': global_step}
+        record.update(extra)
+        for name, value in zip(names, values):
+            value = value / max(steps, 1)
+            record[name] = math.exp(value) if name in self.exp_keys else value
+        record.update({'tokens_per_sec': tokens / elapsed,
+                       'examples_per_sec': examples / elapsed,
+                       'time_per_step': elapsed / max(global_step - self.last_step, 1)})  # 每次更新参数的平均墙钟时间
+        self.last_step = global_step
+        self._reset()
+        self.pending.append(self.executor.submit(self._write, record))
+        return record
+
+    def _write(self, record):
+        if self.summary_writer is not None:
+            for name, value in record.items():
+                if name != 'global_step' and isinstance(value, (int, float)):
+                    self.summary_writer.add_scalar(self.prefix + name, value, record['global_step'])
+            self.summary_writer.flush()
+        if self.jsonl_path:
+            with open(self.jsonl_path, 'a', encoding='utf8') as fw:
+                fw.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def _raise_errors(self):
+        for future in self.pending:
+            if future.done():
+                future.result()  # 后台写出错在这里抛出
+        self.pending = [future for future in self.pending if not future.done()]
+
+    def close(self):
+        r""" 等后台写完 """
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        self.executor.shutdown()
@@ -0,0 +1,123 @@
+import json
+import os
+import numpy as np
+import onnxruntime
+
+
+class OnnxGenerator(object):
+    r""" 在onnxruntime上驱动model.onnx_export导出的encode/step图，支持贪心、beam search和采样解码，只依赖numpy """
+    def __init__(self, model_dir,  # export_onnx的输出文件夹
+                 threads=0):  # 算子内线程数，0为onnxruntime默认
+        with open(os.path.join(model_dir, 'config.json'), 'r', encoding='utf8') as fr:
+            self.config = json.load(fr)
+        self.start_id = self.config['start_id']
+        self.end_id = self.config['end_id']
+
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        providers = ['CPUExecutionProvider']
+        self.encode_session = onnxruntime.InferenceSession(os.path.join(model_dir, 'encode.onnx'), options,
+                                                           providers=providers)
+        self.step_session = onnxruntime.InferenceSession(os.path.join(model_dir, 'step.onnx'), options,
+                                                         providers=providers)
+        self.encode_inputs = [i.name for i in self.encode_session.get_inputs()]
+        self.encode_outputs = [o.name for o in self.encode_session.get_outputs()]
+        # h、c之外传给step图的注意力输入，第1维是batch
+        self.memory_names = [i.name for i in self.step_session.get_inputs()][3:]
+
+    def encode(self, inputs):  # 输入名 -> numpy数组，和ENCODE_SPECS一致
+        r""" 返回encode图的输出字典，h/c [layers, batch, dim]，有注意力时还有memory、keys、attn_bias """
+        feeds = {}
+        for name in self.encode_inputs:
+            value = np.asarray(inputs[name])
+            feeds[name] = value.astype(np.float32 if name == 'sampled_latents' else np.int64)
+        return dict(zip(self.encode_outputs, self.encode_session.run(None, feeds)))
+
+    def step(self, token, h, c, memory=None):  # memory: 注意力输入名 -> 数组
+        r""" 一步解码，返回log概率 [batch, num_vocab] 和新状态 """
+        feeds = {'token': token.astype(np.int64), 'h': h, 'c': c}
+        feeds.update(memory or {})
+        return self.step_session.run(None, feeds)
+
+    def greedy(self, inputs, max_len=60):
+        r""" 贪心解码，返回[batch, seq]的id，和pytorch模型测试时的结果对应 """
+        encoded = self.encode(inputs)
+        h, c = encoded['h'], encoded['c']
+        memory = {name: encoded[name] for name in self.memory_names}
+        batch_size = h.shape[1]
+        token = np.full(batch_size, self.start_id, dtype=np.int64)
+        done = np.zeros(batch_size, dtype=bool)
+        results = []
+        for _ in range(max_len):
+            log_probs, h, c = self.step(token, h, c, memory)
+            token = log_probs.argmax(1)
+            results.append(token)
+            done |= token == self.end_id
+            if done.all():
+                break
+        return np.stack(results, 1)
+
+    def sample(self, inputs, max_len=60, temperature=1.0, top_k=0, seed=None):
+        r""" 按概率采样解码，top_k>0时只在概率最大的top_k个词里采样 """
+        rng = np.random.RandomState(seed)
+        encoded = self.encode(inputs)
+        h, c = encoded['h'], encoded['c']
+        memory = {name: encoded[name] for name in self.memory_names}
+        batch_size = h.shape[1]
+        token = np.full(batch_size, self.start_id, dtype=np.int64)
+        done = np.zeros(batch_size, dtype=bool)
+        results = []
+        for _ in range(max_len):
+            log_probs, h, c = self.step(token, h, c, memory)
+            log_probs = log_probs / temperature
+            if top_k > 0:  # 第top_k大之外的词概率置0
+                kth = -np.partition(-log_probs, top_k - 1, axis=1)[:, top_k - 1: top_k]
+                log_probs = np.where(log_probs >= kth, log_probs, -np.inf)
+            probs = np.exp(log_probs - log_probs.max(1, keepdims=True))
+            cumulative = np.cumsum(probs, 1)
+            threshold = rng.rand(batch_size, 1) * cumulative[:, -1:]
+            token = np.minimum((cumulative < threshold).sum(1), probs.shape[1] - 1)
+            token = np.where(done, self.end_id, token)  # 已经结束的句子不再变化
+            results.append(token)
+            done |= token == self.end_id
+            if done.all():
+                break
+        return np.stack(results, 1)
+
+    def beam(self, inputs, max_len=60, beam_size=5):
+        r""" beam search，返回每个样本得分最高的[batch, seq]的id """
+        encoded = self.encode(inputs)
+        h, c = encoded['h'], encoded['c']
+        memory = {name: encoded[name] for name in self.memory_names}
+        batch_size = h.shape[1]
+        h, c = np.repeat(h, beam_size, 1), np.repeat(c, beam_size, 1)  # [layers, batch*beam, dim]
+        memory = {name: np.repeat(value, beam_size, 1) for name, value in memory.items()}
+
+        scores = np.full((batch_size, beam_size), -np.inf, dtype=np.float32)
+        scores[:, 0] = 0  # 开始时每个样本只有一条beam
+        finished = np.zeros((batch_size, beam_size), dtype=bool)
+        history = np.zeros((batch_size, beam_size, 0), dtype=np.int64)
+        token = np.full(batch_size * beam_size, self.start_id, dtype=np.int64)
+        batch_index = np.arange(batch_size)[:, None]
+        for _ in range(max_len):
+            log_probs, h, c = self.step(token, h, c, memory)
+            num_vocab = log_probs.shape[1]
+            log_probs = log_probs.reshape(batch_size, beam_size, num_vocab)
+            # 已经结束的beam只能接end_id，得分不变
+            log_probs[finished] = -np.inf
+            log_probs[finished, self.end_id] = 0
+            total = (scores[:, :, None] + log_probs).reshape(batch_size, -1)  # [batch, beam*num_vocab]
+            top = np.argsort(-total, 1)[:, :beam_size]  # [batch, beam]
+            beam_index, token = top // num_vocab, top % num_vocab
+            scores = np.take_along_axis(total, top, 1)
+            history = np.concatenate([history[batch_index, beam_index], token[:, :, None]], 2)
+            finished = finished[batch_index, beam_index] | (token == self.end_id)
+
+            index = (batch_index * beam_size + beam_index).reshape(-1)  # 按选中的beam重排状态
+            h, c = h[:, index], c[:, index]
+            memory = {name: value[:, index] for name, value in memory.items()}
+            token = token.reshape(-1)
+            if finished.all():
+                break
+        return history[np.arange(batch_size), scores.argmax(1)]
@@ -0,0 +1,48 @@
+import torch
+from torch.nn.utils.rnn import pack_padded_sequence, PackedSequence
+
+
+class PackInfo(object):
+    r""" collate阶段为一个字段算好的pack信息：降序的长度(始终留在cpu上)和排序/还原的置换 """
+    def __init__(self, lengths,  # 降序排列的长度 [batch]
+                 sorted_indices=None,  # 排序后第i条是原batch的第几条 [batch]，None表示本来就是降序
+                 unsorted_indices=None,  # sorted_indices的逆置换 [batch]
+                 batch_lengths=None):  # 原batch顺序的长度 [batch]
+        self.lengths = lengths
+        self.sorted_indices = sorted_indices
+        self.unsorted_indices = unsorted_indices
+        if batch_lengths is None:
+            batch_lengths = lengths if unsorted_indices is None else lengths[unsorted_indices.cpu()]
+        self.batch_lengths = batch_lengths
+
+    @classmethod
+    def from_lengths(cls, lengths):
+        r""" 由每条样本的长度构造，只在collate时排序一次 """
+        lengths = torch.as_tensor(lengths).long().cpu()
+        sorted_lengths, sorted_indices = lengths.sort(descending=True)
+        unsorted_indices = torch.empty_like(sorted_indices)
+        unsorted_indices[sorted_indices] = torch.arange(sorted_indices.size(0))
+        return cls(sorted_lengths, sorted_indices, unsorted_indices, lengths)
+
+    def to(self, device):
+        r""" 置换随数据一起放到device上，长度不动 """
+        if self.sorted_indices is None:
+            return self
+        return PackInfo(self.lengths, self.sorted_indices.to(device), self.unsorted_indices.to(device),
+                        self.batch_lengths)
+
+    def cuda(self):
+        return self.to('cuda')
+
+    def size(self, dim=0):
+        return self.lengths.size(dim)
+
+    def pack(self, x):  # [seq, batch, dim]
+        r""" 按预先算好的顺序pack，不再排序，也不用把长度从gpu拷回cpu """
+        if self.sorted_indices is None:
+            return pack_padded_sequence(x, self.lengths, enforce_sorted=True)
+        x = x.index_select(1, self.sorted_indices.to(x.device))
+        packed = pack_padded_sequence(x, self.lengths, enforce_sorted=True)
+        # 带上置换，rnn的最终状态和pad_packed_sequence的输出都会还原成原batch的顺序
+        return PackedSequence(packed.data, packed.batch_sizes,
+                              self.sorted_indices.to(x.device), self.unsorted_indices.to(x.device))
@@ -0,0 +1,80 @@
+import math
+import torch
+from model.util.distributed import all_reduce_sum
+
+
+def gaussian_kld(recog_mu, recog_logvar, prior_mu, prior_logvar):  # [batch, latent]
+    r""" 两个高斯分布之间的kl散度，同驱动脚本compute_loss里的公式 """
+    return 0.5 * torch.sum(prior_logvar - recog_logvar - 1
+                           + recog_logvar.exp() / prior_logvar.exp()
+                           + (prior_mu - recog_mu).pow(2) / prior_logvar.exp(), 1)  # [batch]
+
+
+def split_outputs(outputs):
+    r""" 训练模式forward的输出 -> (output_vocab, (先验mu, 先验logvar, 后验mu, 后验logvar))。
+    model_seq只返回output_vocab，没有隐变量时第二项为None """
+    if isinstance(outputs, torch.Tensor):
+        return outputs, None
+    latents = outputs[1:5]
+    if len(latents) == 4 and all(isinstance(latent, torch.Tensor) for latent in latents):
+        return outputs[0], latents
+    return outputs[0], None
+
+
+def evaluate_perplexity(model, word2vec, feed_batches,  # 训练时格式的feed_data，要有responses和masks
+                        kld_weight=1.0,  # kl项乘的权重，只影响返回的kld
+                        gpu=False):
+    r""" inference_mode下计算语料级的NLL、KL和困惑度。各项在设备上累加，最后才同步一次，多进程时把各进程的和加起来。
+    返回每个样本平均的nll、kld，按样本平均的log_ppl、ppl和按token加权的log_token_ppl、token_ppl """
+    totals = None  # [nll之和, kl之和, token数, 每个样本log困惑度之和]
+    examples = 0
+    with torch.inference_mode():
+        for feed_data in feed_batches:
+            output_vocab, latents = split_outputs(model(feed_data, word2vec, gpu=gpu))  # [batch, len_decoder, num_vocab]
+            labels = feed_data['responses'][:, 1:]  # 去掉start_id [batch, len_decoder]
+            masks = feed_data['masks']  # [batch, len_decoder]
+            # 只取标签位置的概率再求log，不用对整个词表求log
+            probs = output_vocab.float().gather(2, labels.unsqueeze(2)).squeeze(2)  # [batch, len_decoder]
+            nll = -(probs.clamp_min(1e-12).log() * masks).sum(1)  # [batch]
+            tokens = masks.sum(1)  # [batch]
+            if latents is not None:
+                _mu, _logvar, mu, logvar = [latent.float() for latent in latents]
+                kld = gaussian_kld(mu, logvar, _mu, _logvar)  # [batch]
+            else:
+                kld = torch.zeros_like(nll)
+            batch_totals = torch.stack([nll.sum(), kld.sum(), tokens.sum(),
+                                        (nll / tokens.clamp_min(1e-12)).sum()])
+            totals = batch_totals if totals is None else totals + batch_totals
+            examples += labels.size(0)
+    if totals is None:
+        totals = torch.zeros(4)
+    nll_sum, kld_sum, num_tokens, log_ppl_sum, examples = all_reduce_sum(totals.tolist() + [examples])
+    examples, num_tokens = max(examples, 1), max(num_tokens, 1)
+    return {'nll': nll_sum / examples,
+            'kld': kld_sum / examples * kld_weight,
+            'log_ppl': log_ppl_sum / examples,
+            'ppl': math.exp(log_ppl_sum / examples),
+            'log_token_ppl': nll_sum / num_tokens,
+            'token_ppl': math.exp(nll_sum / num_tokens),
+            'examples': int(examples),
+            'tokens': int(num_tokens)}
+
+
+def evaluate_snapshot(model, word2vec,
+                      valid_batches, quick_batches,  # cpu上准备好的训练格式feed_data，全部验证集和抽样的验证集
+                      kl_step, gpu, global_step, quick):
+    r""" AsyncValidator调用的验证函数，需要的东西都从参数传进来，验证进程里不依赖驱动脚本的全局变量。
+    每次验证重新采样sampled_latents，quick时只在抽样的验证集上计算，kl权重和训练时一样按global_step-1周期性退火。
+    返回(nll, kld, log_ppl, log_token_ppl) """
+    global_step -= 1
+    kld_weight = min(1.0 * (global_step % (2*kl_step)) / kl_step, 1)
+
+    def feed_batches():
+        for feed_data in quick_batches if quick else valid_batches:
+            feed_data = dict(feed_data, sampled_latents=torch.randn_like(feed_data['sampled_latents']))
+            if gpu:  # 将数据转移到gpu上
+                feed_data = {key: value.cuda() for key, value in feed_data.items()}
+            yield feed_data
+
+    result = evaluate_perplexity(model, word2vec, feed_batches(), kld_weight, gpu=gpu)  # 多进程时合并所有进程的样本
+    return result['nll'], result['kld'], result['log_ppl'], result['log_token_ppl']
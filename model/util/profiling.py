@@ -0,0 +1,122 @@
+import contextlib
+import time
+import torch
+
+
+class _Region(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        timer = self.timer
+        timer.synchronize()  # 之前排队的gpu计算不算在这个区域里
+        timer.stack.append(self.name)
+        self.path = '/'.join(timer.stack)
+        self.record = torch.profiler.record_function(self.path) if timer.profiler is not None else None
+        if self.record is not None:
+            self.record.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        timer = self.timer
+        timer.synchronize()
+        elapsed = time.perf_counter() - self.start
+        if self.record is not None:
+            self.record.__exit__(*exc)
+        timer.stack.pop()
+        for stats in (timer.totals, timer.interval):
+            calls, total = stats.get(self.path, (0, 0.0))
+            stats[self.path] = (calls + 1, total + elapsed)
+        return False
+
+
+class StageTimer(object):
+    r""" 按名字计时的代码区域，可以嵌套，名字按层级用/连起来。关闭时region()返回什么都不做的上下文，几乎没有开销；
+    打开时进出区域都同步cuda，计的是真实耗时。设置了trace_path时用torch.profiler记录前几步，导出Chrome trace """
+    _null = contextlib.nullcontext()
+
+    def __init__(self):
+        self.enabled = False
+        self.gpu = False
+        self.stack = []
+        self.totals = {}  # 名字 -> (次数, 总秒数)，整个运行期间
+        self.interval = {}  # 同上，上次写tensorboard之后
+        self.profiler = None
+        self.trace_steps = 0
+
+    def enable(self, gpu=False,
+               trace_path='',  # Chrome trace的位置，为空时不用torch.profiler
+               trace_steps=5):  # 跳过第一步后记录多少步
+        self.enabled = True
+        self.gpu = gpu and torch.cuda.is_available()
+        if trace_path:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.gpu:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace_steps = trace_steps + 2
+            self.profiler = torch.profiler.profile(
+                activities=activities, schedule=torch.profiler.schedule(wait=1, warmup=1, active=trace_steps),
+                on_trace_ready=lambda profiler: profiler.export_chrome_trace(trace_path))
+            self.profiler.start()
+
+    def synchronize(self):
+        if self.gpu:
+            torch.cuda.synchronize()
+
+    def region(self, name):
+        if not self.enabled:
+            return self._null
+        return _Region(self, name)
+
+    def iterate(self, iterable, name):
+        r""" 遍历iterable，每次取下一个元素的时间记在name下，比如数据的迭代器 """
+        iterator = iter(iterable)
+        while True:
+            with self.region(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self):
+        r""" 每更新一次参数(或者生成一个batch)调用一次，推进torch.profiler的记录，记够了就导出 """
+        if self.profiler is None:
+            return
+        self.profiler.step()
+        self.trace_steps -= 1
+        if self.trace_steps <= 0:
+            self.profiler.stop()
+            self.profiler = None
+
+    def log(self, summary_writer, global_step):
+        r""" 上次记录之后每个区域平均每次的毫秒数写入tensorboard """
+        if not self.enabled:
+            return
+        if summary_writer is not None:
+            for path, (calls, total) in self.interval.items():
+                summary_writer.add_scalar('time/' + path, total / calls * 1000, global_step)
+        self.interval = {}
+
+    def summary(self):
+        r""" 每个区域的次数、总时间、平均时间和占最外层区域总时间的比例 """
+        if not self.enabled or not self.totals:
+            return ''
+        outer = sum(total for path, (_, total) in self.totals.items() if '/' not in path)
+        lines = ['{:<40s}{:>10s}{:>12s}{:>12s}{:>8s}'.format('区域', '次数', '总时间(s)', '平均(ms)', '占比')]
+        for path in sorted(self.totals):
+            calls, total = self.totals[path]
+            name = '  ' * path.count('/') + path.split('/')[-1]
+            lines.append('{:<40s}{:>10d}{:>12.3f}{:>12.3f}{:>8.1%}'
+                         .format(name, calls, total, total / calls * 1000, total / max(outer, 1e-9)))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+
+timer = StageTimer()  # 驱动脚本和模型共用的计时器，默认关闭
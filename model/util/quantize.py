@@ -0,0 +1,29 @@
+import copy
+import io
+import torch
+import torch.nn as nn
+
+
+def quantize_dynamic(model):
+    r""" 训练后动态量化：LSTM和Linear的权值转成int8，激活值运行时量化。返回cpu上的新模型，原模型不变 """
+    model = copy.deepcopy(model).cpu().eval()
+    return torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def model_size(model):
+    r""" state_dict序列化后的字节数 """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def save_quantized(model, path):
+    r""" 保存量化后的参数，载入见load_quantized """
+    torch.save(model.state_dict(), path)
+
+
+def load_quantized(model, path):
+    r""" 在同样配置的浮点模型上先量化再载入参数 """
+    model = quantize_dynamic(model)
+    model.load_state_dict(torch.load(path, map_location='cpu'))
+    return model
@@ -0,0 +1,74 @@
+import torch
+
+
+def split_by_category(categories,  # 每个样本的类别 [batch]
+                      num_categories):  # 类别数
+    r""" 按类别把batch拆成若干组，返回[(类别, 样本下标)]，空的类别跳过 """
+    groups = []
+    for c in range(num_categories):
+        index = (categories == c).nonzero().view(-1)  # 属于类别c的样本下标 [n_c]
+        if index.numel() > 0:
+            groups.append((c, index))
+    return groups
+
+
+def routed_teacher_forcing(branches,  # 每个类别的(prior_net, recognize_net, prepare_state, decoder, projector)
+                           x,  # post编码 [batch, dim]
+                           y,  # response编码 [batch, dim]
+                           embed_responses,  # [batch, seq, embed_size]
+                           sampled_latents,  # [batch, latent_size]
+                           categories):  # 每个样本的类别 [batch]
+    r""" 混合类别batch的训练前向：按类别gather样本送入对应分支，再把结果scatter回原位置 """
+    categories = categories.view(-1).long().to(x.device)
+    assert int(categories.max()) < len(branches)  # 每个样本都必须有对应的分支
+    batch_size = x.size(0)
+    len_decoder = embed_responses.size(1) - 1
+    decoder_inputs = embed_responses[:, :-1, :].transpose(0, 1)  # [seq-1, batch, embed_size]
+
+    _mu, _logvar, mu, logvar, output_vocab = None, None, None, None, None
+    for c, index in split_by_category(categories, len(branches)):
+        prior_net, recognize_net, prepare_state, decoder, projector = branches[c]
+        x_c = x.index_select(0, index)  # [n_c, dim]
+        y_c = y.index_select(0, index)  # [n_c, dim]
+
+        _mu_c, _logvar_c = prior_net(x_c)  # p(z|x) [n_c, latent]
+        mu_c, logvar_c = recognize_net(x_c, y_c)  # p(z|x,y) [n_c, latent]
+        z_c = mu_c + (0.5 * logvar_c).exp() * sampled_latents.index_select(0, index)  # 重参数化 [n_c, latent]
+
+        # 训练时解码器输入已知，整段送入rnn，和逐步解码等价
+        state = prepare_state(torch.cat([z_c, x_c], 1))  # [num_layer, n_c, dim_out]
+        outputs_c, _ = decoder(decoder_inputs.index_select(1, index), state)  # [seq-1, n_c, dim_out]
+        output_vocab_c = projector(outputs_c.transpose(0, 1))  # [n_c, seq-1, num_vocab]
+
+        if output_vocab is None:  # 第一次遇到时按输出大小申请结果
+            _mu = _mu_c.new_zeros(batch_size, _mu_c.size(1))
+            _logvar = _logvar_c.new_zeros(batch_size, _logvar_c.size(1))
+            mu = mu_c.new_zeros(batch_size, mu_c.size(1))
+            logvar = logvar_c.new_zeros(batch_size, logvar_c.size(1))
+            output_vocab = output_vocab_c.new_zeros(batch_size, len_decoder, output_vocab_c.size(2))
+        # index_copy不是原地操作，梯度可以回传到各个分支
+        _mu = _mu.index_copy(0, index, _mu_c)
+        _logvar = _logvar.index_copy(0, index, _logvar_c)
+        mu = mu.index_copy(0, index, mu_c)
+        logvar = logvar.index_copy(0, index, logvar_c)
+        output_vocab = output_vocab.index_copy(0, index, output_vocab_c)
+
+    return output_vocab, _mu, _logvar, mu, logvar
+
+
+def routed_latents(recognize_nets,  # 每个类别的识别网络
+                   x,  # post编码 [batch, dim]
+                   y,  # response编码 [batch, dim]
+                   sampled_latents,  # [batch, latent_size]
+                   categories):  # 每个样本的类别 [batch]
+    r""" 按类别把样本送入对应的识别网络，返回重参数化后的z [batch, latent]，每个样本都必须有对应的分支 """
+    categories = categories.view(-1).long().to(x.device)
+    assert int(categories.max()) < len(recognize_nets)
+    z = None
+    for c, index in split_by_category(categories, len(recognize_nets)):
+        mu_c, logvar_c = recognize_nets[c](x.index_select(0, index), y.index_select(0, index))  # [n_c, latent]
+        z_c = mu_c + (0.5 * logvar_c).exp() * sampled_latents.index_select(0, index)  # [n_c, latent]
+        if z is None:
+            z = z_c.new_zeros(x.size(0), z_c.size(1))
+        z = z.index_copy(0, index, z_c)
+    return z
@@ -0,0 +1,87 @@
+import torch
+from model.util.packing import PackInfo
+
+
+class DialogueSession(object):
+    r""" 一段多轮对话的推理会话：保存post编码器的运行状态，每轮只编码最新的一句话，接在之前的状态后面。
+    适用于model_topic、model_topic_control、model_topic_level_encoder """
+    def __init__(self, model, word2vec, sentence_processor, config,
+                 max_len=60,  # 最大解码步数
+                 gpu=False,
+                 **forward_kwargs):  # 原样传给model.forward，例如level_encoder_data
+        self.model = model
+        self.word2vec = word2vec
+        self.sp = sentence_processor
+        self.config = config
+        self.max_len = max_len
+        self.gpu = gpu
+        # 层级编码器的语料整个会话不变，global_sem按语料内容缓存，每轮直接命中
+        self.forward_kwargs = forward_kwargs
+        self.state = None  # post编码器的运行状态 [layers, 1, dim]，LSTM为(h, c)
+        self.turns = 0  # 已经并入状态的句子数
+
+    def reset(self):
+        r""" 开始一段新的对话 """
+        self.state = None
+        self.turns = 0
+
+    def observe(self, utterance):  # 单词列表
+        r""" 只把一句话并入对话状态，不生成回复，例如模型自己的回复或者已知的历史 """
+        id_post, len_post = self.prepare_post(utterance)
+        self.encode(id_post, len_post)
+
+    def step(self, post,  # 这一轮的post，单词列表
+             keywords,  # 关键词，单词列表
+             act,  # 回复的act，如['3']
+             sampled_latents=None):  # [1, latent_size]
+        r""" 并入这一轮的post并生成回复，返回回复的单词列表 """
+        assert not self.model.training  # 只在测试模式下使用
+        assert len(keywords) > 0  # topic编码器需要至少一个关键词
+        id_post, len_post = self.prepare_post(post)
+        id_keywords, len_keywords = self.sp.word2index(keywords)
+        id_act, _ = self.sp.word2index(act)
+        if sampled_latents is None:
+            sampled_latents = torch.randn((1, self.config.latent_size))
+        feed_data = {'posts': id_post,  # [1, seq]
+                     'len_posts': len_post,
+                     'keywords': torch.tensor([id_keywords]).long(),  # [1, num_keywords]
+                     'len_keywords': PackInfo.from_lengths([len_keywords]),
+                     'topic': torch.tensor([id_act]).long(),  # [1, 1]
+                     'sampled_latents': sampled_latents}
+        if self.gpu:
+            for key, value in feed_data.items():
+                feed_data[key] = value.cuda()
+
+        state_posts = self.encode(feed_data['posts'], feed_data['len_posts'])  # post编码器从上一轮的状态接着编码
+        with torch.no_grad():
+            output_vocab = self.model(feed_data, self.word2vec, inference=True, max_len=self.max_len, gpu=self.gpu,
+                                      state_posts=state_posts, **self.forward_kwargs)[0]  # [1, seq, num_vocab]
+        return self.sp.index2word(output_vocab.argmax(2)[0].tolist())
+
+    def prepare_post(self, utterance):
+        r""" 单词列表转成加了start/end的id [1, seq]和长度 """
+        id_post, len_post = self.sp.word2index(utterance)
+        id_post = torch.tensor([self.sp.pad_sentence(id_post, len_post + 2)]).long()
+        len_post = PackInfo.from_lengths([len_post + 2])
+        if self.gpu:
+            id_post, len_post = id_post.cuda(), len_post.cuda()
+        return id_post, len_post
+
+    def encode(self, id_post, len_post):
+        r""" 把一句话接在对话状态后面编码，返回post编码器的最终状态 [layers, 1, dim]，LSTM为(h, c) """
+        with torch.no_grad():
+            embed_post = self.word2vec.embedding(id_post)  # [1, seq, embed_size]
+            state = self.model.encode_state(self.model.post_encoder, id_post, len_post, embed_post, state=self.state)
+        self.state = self.carry(self.model.post_encoder, state)
+        self.turns += 1
+        return state
+
+    @staticmethod
+    def carry(encoder, state):
+        r""" 延续到下一轮的状态：前向读完了整段历史可以延续，双向时后向只读这一句，下一轮从0开始 """
+        if isinstance(state, tuple):
+            return tuple(DialogueSession.carry(encoder, s) for s in state)
+        if not encoder.bidirectional:
+            return state
+        state_forward, state_back = state.chunk(2, 2)  # [layers, 1, dim/2]
+        return torch.cat([state_forward, torch.zeros_like(state_back)], 2)
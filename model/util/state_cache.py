@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+import torch
+from model.util.packing import PackInfo
+
+
+class EncoderStateCache(object):
+    r""" 编码器最终状态的LRU缓存，键为(编码器, 参数版本, token id序列)，只在测试模式下使用 """
+    def __init__(self, capacity=100000):  # 最多缓存多少条句子的状态
+        self.capacity = capacity
+        self.states = OrderedDict()  # 键 -> 单条句子的最终状态 [layers, dim] 或 LSTM的(h, c)
+        self.versions = {}  # id(编码器) -> 缓存里这个编码器状态的参数版本
+        self.hits = 0  # 命中的句子数
+        self.misses = 0  # 实际编码的句子数
+        self.encode_time = 0.0  # 实际编码花的时间(秒)
+
+    def encode(self, encoder,
+               ids,  # [batch, seq]
+               length,  # [batch] 或 PackInfo
+               embed):  # [batch, seq, embed_size]
+        r""" 和encoder(embed.transpose(0, 1), length)[1]结果相同，只编码缓存里没有的句子 """
+        # 优化器原地更新参数、load_state_dict都会增加_version，参数一变旧状态自动失效
+        version = sum(p._version for p in encoder.parameters())
+        if self.versions.get(id(encoder), version) != version:  # 旧参数下的状态再也不会命中，直接删掉
+            self.states = OrderedDict((key, state) for key, state in self.states.items() if key[0] != id(encoder))
+        self.versions[id(encoder)] = version
+        lengths = length.batch_lengths if isinstance(length, PackInfo) else torch.as_tensor(length).cpu()
+        keys = [(id(encoder), version, tuple(row[: l]))
+                for row, l in zip(ids.cpu().tolist(), lengths.tolist())]
+
+        miss_index = OrderedDict()  # 需要编码的句子，batch内重复的只编码一次
+        for idx, key in enumerate(keys):
+            if key in self.states:
+                self.states.move_to_end(key)
+            elif key not in miss_index:
+                miss_index[key] = idx
+        self.hits += len(keys) - len(miss_index)
+        self.misses += len(miss_index)
+
+        if miss_index:
+            start = time.time()
+            index = torch.tensor(list(miss_index.values()))
+            miss_lengths = PackInfo.from_lengths(lengths[index]).to(embed.device)
+            _, state = encoder(embed.index_select(0, index.to(embed.device)).transpose(0, 1), miss_lengths)
+            if embed.is_cuda:  # 统计时间需要等gpu算完
+                torch.cuda.synchronize(embed.device)
+            self.encode_time += time.time() - start
+
+            for j, key in enumerate(miss_index):
+                if isinstance(state, tuple):
+                    self.states[key] = tuple(s[:, j].detach().clone() for s in state)
+                else:
+                    self.states[key] = state[:, j].detach().clone()  # 不保留计算图
+
+        states = [self.states[key] for key in keys]
+        while len(self.states) > self.capacity:  # 淘汰最久没用过的
+            self.states.popitem(last=False)
+        if isinstance(states[0], tuple):
+            return tuple(torch.stack(s, 1) for s in zip(*states))  # ([layers, batch, dim], [layers, batch, dim])
+        return torch.stack(states, 1)  # [layers, batch, dim]
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def time_saved(self):
+        r""" 按实际编码的平均耗时估计命中省下的时间(秒) """
+        return self.encode_time / self.misses * self.hits if self.misses > 0 else 0.0
+
+    def report(self):
+        return '编码状态缓存: 命中{}/{}条, 命中率{:.2%}, 实际编码{:.2f}秒, 估计节省{:.2f}秒'.format(
+            self.hits, self.hits + self.misses, self.hit_rate(), self.encode_time, self.time_saved())